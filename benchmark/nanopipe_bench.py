@@ -0,0 +1,273 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Benchmarks for the polymorphism step (nanopipe_calc_polymorphism.py) on synthetic data.
+Every stage runs in its own process, so the wall time, the CPU time and the peak memory (RSS) are measured per
+stage. The throughput is given in items (positions, SNPs, alignments) per second. The results can be stored as
+baseline (benchmark/baselines/<name>.json) and later runs are compared against it. Stages slower or bigger than
+the baseline by more than the tolerance are reported as regressions (exit status 1)."""
+
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CALC_DIR = os.path.join(BENCH_DIR, "..", "calculate")
+sys.path.insert(0, CALC_DIR)
+
+import nanopipe_benchdata
+
+
+STAGES = ["calling", "calling_binary", "plasmodb_build", "plasmodb", "quality", "mafindex", "quality_indexed",
+          "script_python", "script_numpy"]
+
+USAGE = """Usage:
+
+    nanopipe_bench.py [-c contigs] [-l length] [-d depth] [-s snp_density] [-r read_length] [-n repeats]
+                      [-stages stage,...] [-dir directory] [-save name] [-baseline name] [-tol tolerance]
+
+Stages:
+    calling          SNP calling of the text nuccounts files (numpy engine)
+    calling_binary   SNP calling of the binary nuccounts files (numpy engine)
+    plasmodb_build   compile the PlasmoDB index
+    plasmodb         PlasmoDB lookup of the SNP positions
+    quality          alignment quality of the SNPs, the MAF file is parsed
+    mafindex         build the MAF index
+    quality_indexed  alignment quality of the SNPs by the MAF index
+    script_python    nanopipe_calc_polymorphism.py -s plasf -q -e python
+    script_numpy     nanopipe_calc_polymorphism.py -s plasf -q -e numpy
+"""
+
+# Stages running the whole script and their engine
+SCRIPT_STAGES = {"script_python": "python", "script_numpy": "numpy"}
+
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+# Accepted slow down/growth compared to the baseline
+TOLERANCE = 0.2
+
+
+def runStage(stage, work_dir):
+    """Runs an internal stage in the current process. Returns (items, seconds)."""
+
+    with open(os.path.join(work_dir, "bench.json"), "r") as f:
+        manifest = json.load(f)
+    snps = manifest["snps"]
+    maf_file = os.path.join(work_dir, "calc.lastalign.maf")
+    db_dir = os.path.join(work_dir, "SNPdbPlasf")
+    nuccounts_files = [os.path.join(work_dir, "calc.nuccounts.%d" % enc) for enc in range(1, len(snps) + 1)]
+
+    if stage == "quality":
+        # The MAF file has to be parsed
+        if os.path.exists(maf_file + ".idx"):
+            os.remove(maf_file + ".idx")
+
+    start = time.time()
+
+    if stage in ("calling", "calling_binary"):
+        import nanopipe_snpcall
+        import nanopipe_nuccounts
+        if stage == "calling_binary":
+            nuccounts_files = [file_name + nanopipe_nuccounts.BINARY_EXT for file_name in nuccounts_files]
+        for file_name in nuccounts_files:
+            nanopipe_snpcall.callNuccounts(file_name, 0.8, 0.2, 2)
+        items = manifest["positions"]
+
+    elif stage == "plasmodb_build":
+        import nanopipe_plasmodb
+        items = 0
+        for name in snps:
+            items += nanopipe_plasmodb.buildIndex(os.path.join(db_dir, name + ".txt"))
+
+    elif stage == "plasmodb":
+        import nanopipe_plasmodb
+        items = 0
+        for name in snps:
+            nanopipe_plasmodb.lookup(db_dir, str(name), [str(pos) for pos in snps[name]])
+            items += len(snps[name])
+
+    elif stage == "mafindex":
+        import nanopipe_mafindex
+        items = nanopipe_mafindex.buildIndex(maf_file)
+
+    elif stage in ("quality", "quality_indexed"):
+        import nanopipe_qualreg
+        res_dict = {"**header**": ""}
+        for name in snps:
+            res_dict[str(name)] = dict([(str(pos), ["-\t"] * 10) for pos in snps[name]])
+        nanopipe_qualreg.addQuality(res_dict, maf_file)
+        items = sum([len(snps[name]) for name in snps])
+
+    else:
+        raise ValueError("Unknown stage: %s" % stage)
+
+    return items, time.time() - start
+
+
+def measure(stage, work_dir):
+    """Runs a stage in a child process. Returns a dictionary with the seconds (wall time of the stage), the CPU
+    seconds and the peak RSS (MB) of the child, the number of items and the items per second."""
+
+    with open(os.path.join(work_dir, "bench.json"), "r") as f:
+        manifest = json.load(f)
+
+    if stage in SCRIPT_STAGES:
+        # The script works in the current directory
+        for file_name in os.listdir(work_dir):
+            if file_name.endswith(".poly"):
+                os.remove(os.path.join(work_dir, file_name))
+        command = [sys.executable, os.path.join(CALC_DIR, "nanopipe_calc_polymorphism.py"), "-s", "plasf", "-q",
+                   "-d", os.path.join(work_dir, "SNPdbPlasf"), "-e", SCRIPT_STAGES[stage]]
+    else:
+        command = [sys.executable, os.path.abspath(__file__), "-stage", stage, work_dir]
+
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.PIPE, stderr=devnull)
+        output = process.stdout.read()
+
+        # Resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = status
+    wall = time.time() - start
+
+    if status != 0:
+        raise RuntimeError("Stage %s failed with exit status %d" % (stage, status >> 8))
+
+    if stage in SCRIPT_STAGES:
+        items, seconds = manifest["positions"], wall
+    else:
+        result = json.loads(output.decode("ascii").strip().split("\n")[-1])
+        items, seconds = result["items"], result["seconds"]
+
+    return {"seconds": seconds, "cpu": usage.ru_utime + usage.ru_stime, "rss": usage.ru_maxrss / 1024.0,
+            "items": items, "rate": items / seconds if seconds else 0.0}
+
+
+def compare(results, baseline, tolerance):
+    """Prints the results and the comparison with the baseline. Returns the list of regressions."""
+
+    regressions = []
+    sys.stdout.write("%-16s %10s %10s %14s %10s %12s\n" % ("stage", "seconds", "cpu", "items/s", "rss MB",
+                                                          "vs baseline"))
+    for stage in [stage for stage in STAGES if stage in results]:
+        result = results[stage]
+        note = ""
+        if baseline and stage in baseline["stages"]:
+            base = baseline["stages"][stage]
+            ratio = result["seconds"] / base["seconds"] if base["seconds"] else 1.0
+            note = "%.2fx" % ratio
+            if ratio > 1 + tolerance:
+                regressions.append("%s: %.2fx slower" % (stage, ratio))
+                note += " SLOWER"
+            if base.get("rss") and result["rss"] > base["rss"] * (1 + tolerance):
+                regressions.append("%s: %.1f MB peak RSS (baseline %.1f MB)" % (stage, result["rss"], base["rss"]))
+                note += " BIGGER"
+        sys.stdout.write("%-16s %10.3f %10.3f %14.0f %10.1f %12s\n" % (stage, result["seconds"], result["cpu"],
+                                                                       result["rate"], result["rss"], note))
+    return regressions
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+def main(arg_list):
+    if "-h" in arg_list or "--help" in arg_list:
+        sys.stdout.write(USAGE)
+        return 0
+
+    # Internal calls: run or measure a single stage
+    if "-stage" in arg_list:
+        items, seconds = runStage(arg_list[arg_list.index("-stage") + 1], arg_list[-1])
+        sys.stdout.write(json.dumps({"items": items, "seconds": seconds}) + "\n")
+        return 0
+
+    settings = {
+        "contigs": getOption(arg_list, "-c", nanopipe_benchdata.CONTIGS, int),
+        "length": getOption(arg_list, "-l", nanopipe_benchdata.LENGTH, int),
+        "depth": getOption(arg_list, "-d", nanopipe_benchdata.DEPTH, int),
+        "density": getOption(arg_list, "-s", nanopipe_benchdata.DENSITY, float),
+        "read_length": getOption(arg_list, "-r", nanopipe_benchdata.READ_LENGTH, int)
+    }
+    repeats = getOption(arg_list, "-n", 1, int)
+    stages = getOption(arg_list, "-stages", ",".join(STAGES)).split(",")
+    tolerance = getOption(arg_list, "-tol", TOLERANCE, float)
+    save_name = getOption(arg_list, "-save", None)
+    baseline_name = getOption(arg_list, "-baseline", None)
+
+    for stage in stages:
+        if stage not in STAGES:
+            sys.stderr.write("Unknown stage: %s\n" % stage)
+            return 1
+
+    baseline = None
+    if baseline_name:
+        with open(os.path.join(BASELINE_DIR, baseline_name + ".json"), "r") as f:
+            baseline = json.load(f)
+        if baseline["settings"] != settings:
+            sys.stdout.write("Warning: the baseline %s was measured with other settings: %s\n"
+                             % (baseline_name, baseline["settings"]))
+
+    work_dir = getOption(arg_list, "-dir", None)
+    isTemp = work_dir is None
+    if isTemp:
+        work_dir = tempfile.mkdtemp(prefix="nanopipe_bench.")
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        sys.stdout.write("Generating data: %s\n" % ", ".join(["%s=%s" % item for item in sorted(settings.items())]))
+        manifest = nanopipe_benchdata.generate(work_dir, settings["contigs"], settings["length"], settings["depth"],
+                                               settings["density"], settings["read_length"])
+        sys.stdout.write("%d positions, %d SNPs, %d alignments in %s\n\n"
+                         % (manifest["positions"], sum([len(snps) for snps in manifest["snps"].values()]),
+                            manifest["blocks"], work_dir))
+
+        # Best wall time and highest peak RSS of the repeats
+        results = {}
+        for stage in stages:
+            for _ in range(repeats):
+                result = measure(stage, work_dir)
+                if stage in results:
+                    result["rss"] = max(result["rss"], results[stage]["rss"])
+                    if result["seconds"] > results[stage]["seconds"]:
+                        result = dict(results[stage], rss=result["rss"])
+                results[stage] = result
+    finally:
+        if isTemp:
+            shutil.rmtree(work_dir)
+
+    regressions = compare(results, baseline, tolerance)
+
+    if save_name:
+        if not os.path.isdir(BASELINE_DIR):
+            os.makedirs(BASELINE_DIR)
+        with open(os.path.join(BASELINE_DIR, save_name + ".json"), "w") as out:
+            json.dump({"settings": settings, "python": sys.version.split()[0], "date": time.strftime("%Y-%m-%d"),
+                       "stages": results}, out, indent=1, sort_keys=True)
+        sys.stdout.write("\nBaseline saved: %s\n" % save_name)
+
+    if regressions:
+        sys.stdout.write("\nRegressions (tolerance %d%%):\n" % (tolerance * 100))
+        for regression in regressions:
+            sys.stdout.write("    %s\n" % regression)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
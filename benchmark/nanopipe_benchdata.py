@@ -0,0 +1,209 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Synthetic input data for the benchmarks of the polymorphism step.
+Writes a run directory like the calculate step does: calc.tidmap, calc.nuccounts.N (text and/or binary),
+calc.lastalign.maf and a SNPdbPlasf-style database in the subdirectory SNPdbPlasf. The targets are named like the
+Plasmodium falciparum chromosomes, so the PlasmoDB lookup is part of the runs. The size is given by the number of
+contigs, the contig length, the read depth and the SNP density. A manifest (bench.json) holds the settings, the
+SNP positions and the counts of the generated items."""
+
+
+import sys
+import os
+import json
+import random
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "calculate"))
+import nanopipe_nuccounts
+
+
+USAGE = """Usage: nanopipe_benchdata.py directory [-c contigs] [-l length] [-d depth] [-s snp_density]
+                             [-r read_length] [-f text|binary|both] [-seed n]
+"""
+
+# Default size of the data
+CONTIGS = 4
+LENGTH = 100000
+DEPTH = 20
+DENSITY = 0.001
+READ_LENGTH = 2000
+
+# Consensus like analyze.pm: minimum count and equal counts (n1 * equal <= n2)
+MINCOUNT = 10
+EQUAL = 0.8
+TWONUCS = {"AC": "M", "AG": "R", "AT": "W", "CG": "S", "CT": "Y", "GT": "K"}
+THREENUCS = {"ACG": "V", "ACT": "H", "AGT": "D", "CGT": "B"}
+
+NUCS = "ACGT"
+
+
+def getConsensus(counts):
+    """Returns the consensus symbol for the counts of A, C, G, T like analyze.pm."""
+
+    n = sorted(zip(counts, NUCS), key=lambda count: -count[0])
+    base = n[0][0] * EQUAL
+    if base > n[1][0]:
+        return n[0][1]
+    if base > n[2][0]:
+        return TWONUCS["".join(sorted(n[0][1] + n[1][1]))]
+    if base > n[3][0]:
+        return THREENUCS["".join(sorted(n[0][1] + n[1][1] + n[2][1]))]
+    return "X"
+
+
+def makeCounts(ref, alt, depth, rand):
+    """Returns the counts of A, C, G, T and gaps of a position with the reference nucleotide ref. If alt is given,
+    the position is a SNP."""
+
+    total = max(0, int(rand.gauss(depth, depth / 4.0)))
+    counts = [0, 0, 0, 0]
+    if alt is not None:
+        alt_count = int(total * rand.uniform(0.3, 0.7))
+        counts[NUCS.index(alt)] = alt_count
+        total -= alt_count
+
+    # Sequencing errors
+    for _ in range(int(total * 0.05)):
+        counts[rand.randrange(4)] += 1
+        total -= 1
+    counts[NUCS.index(ref)] += total
+
+    return counts, rand.randrange(3)
+
+
+def writeBinary(file_name, tid, rows):
+    """Writes the rows (position, A, C, G, T, gaps, consensus, target) as one fragment in the binary format of
+    analyze.pm."""
+
+    count = len(rows)
+    name = tid.encode("ascii")
+    with open(file_name, "wb") as out:
+        out.write(nanopipe_nuccounts.HEADER.pack(nanopipe_nuccounts.MAGIC, nanopipe_nuccounts.VERSION, 1, count,
+                                                 len(name)))
+        out.write(name + b"\0" * (-len(name) % 4))
+        out.write(struct.pack("<2I", 0, count))
+        for column in range(6):
+            out.write(struct.pack("<%dI" % count, *[row[column] for row in rows]))
+        out.write("".join([row[6] for row in rows]).encode("ascii"))
+        out.write("".join([row[7] for row in rows]).encode("ascii"))
+
+
+def generate(out_dir, contigs=CONTIGS, length=LENGTH, depth=DEPTH, density=DENSITY, read_length=READ_LENGTH,
+             nuc_format="both", seed=1):
+    """Writes the synthetic data to out_dir and returns the manifest."""
+
+    rand = random.Random(seed)
+    db_dir = os.path.join(out_dir, "SNPdbPlasf")
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+
+    # Quality symbols, slices are taken for the "p" lines
+    qualities = "".join([chr(rand.randrange(33, 74)) for _ in range(100000 + read_length)])
+
+    names = ["Pf3D7_%02d_v3" % (i + 1) for i in range(contigs)]
+    snps = {}
+    blocks = 0
+
+    with open(os.path.join(out_dir, "calc.tidmap"), "w") as tidmap:
+        for enc, name in enumerate(names, 1):
+            tidmap.write("%s\t%d\n" % (name, enc))
+
+    maf = open(os.path.join(out_dir, "calc.lastalign.maf"), "w")
+    maf.write("# LAST version 1 (synthetic)\n#\n")
+
+    for enc, name in enumerate(names, 1):
+        reference = "".join([rand.choice(NUCS) for _ in range(length)])
+        snp_list = sorted(rand.sample(range(1, length + 1), int(length * density)))
+        alts = dict([(pos, rand.choice(NUCS.replace(reference[pos - 1], ""))) for pos in snp_list])
+        snps[name] = snp_list
+
+        # Nucleotide counts: one fragment over the whole contig
+        rows = []
+        for pos in range(1, length + 1):
+            counts, gaps = makeCounts(reference[pos - 1], alts.get(pos), depth, rand)
+            total = sum(counts)
+            if gaps > total:
+                consensus = "-"
+            elif total < MINCOUNT:
+                consensus = "N"
+            else:
+                consensus = getConsensus(counts)
+            rows.append((pos, counts[0], counts[1], counts[2], counts[3], gaps, consensus, reference[pos - 1]))
+
+        file_name = os.path.join(out_dir, "calc.nuccounts.%d" % enc)
+        if nuc_format in ("text", "both"):
+            with open(file_name, "w") as nuccounts:
+                nuccounts.write(">%s\n" % name)
+                nuccounts.write("".join(["%d\t%d\t%d\t%d\t%d\t%s\t%s\t%d\n" % (row[0], row[1], row[2], row[3],
+                                                                             row[4], row[6], row[7], row[5])
+                                         for row in rows]))
+        if nuc_format in ("binary", "both"):
+            writeBinary(file_name + nanopipe_nuccounts.BINARY_EXT, name, rows)
+
+        # Alignments of the reads, half of the reads carry the alternative alleles
+        query = list(reference)
+        for pos in snp_list:
+            query[pos - 1] = alts[pos]
+        query = "".join(query)
+        for read in range(depth * length // read_length):
+            span = min(read_length, length)
+            start = rand.randrange(0, length - span + 1)
+            source = query if read % 2 else reference
+            offset = rand.randrange(0, len(qualities) - span)
+            maf.write("a score=%d\n" % rand.randrange(span, 2 * span))
+            maf.write("s %s %d %d + %d %s\n" % (name, start, span, length, reference[start:start + span]))
+            maf.write("s read%d.%d 0 %d + %d %s\n" % (enc, read, span, span, source[start:start + span]))
+            maf.write("p %s\n\n" % qualities[offset:offset + span])
+            blocks += 1
+
+        # PlasmoDB: half of the SNPs and further positions
+        db_list = sorted(set([pos for pos in snp_list if rand.random() < 0.5] +
+                             rand.sample(range(1, length + 1), int(length * density))))
+        with open(os.path.join(db_dir, name + ".txt"), "w") as db:
+            db.write("[SNP Id]\t[Major Allele]\t[Major Allele Frequency]\t[Minor Allele]\t"
+                     "[Minor Allele Frequency]\t\n")
+            for pos in db_list:
+                db.write("NGS_SNP.%s.%d\t%s\t0.8\t%s\t0.2\t\n" % (name, pos, reference[pos - 1],
+                                                                 alts.get(pos, rand.choice(NUCS))))
+
+    maf.close()
+
+    manifest = {
+        "settings": {"contigs": contigs, "length": length, "depth": depth, "density": density,
+                     "read_length": read_length, "format": nuc_format, "seed": seed},
+        "positions": contigs * length,
+        "blocks": blocks,
+        "snps": snps
+    }
+    with open(os.path.join(out_dir, "bench.json"), "w") as out:
+        json.dump(manifest, out)
+
+    return manifest
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+if __name__ == "__main__":
+    arg_list = sys.argv[1:]
+    if not arg_list or arg_list[0].startswith("-"):
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    manifest = generate(arg_list[0], getOption(arg_list, "-c", CONTIGS, int), getOption(arg_list, "-l", LENGTH, int),
+                        getOption(arg_list, "-d", DEPTH, int), getOption(arg_list, "-s", DENSITY, float),
+                        getOption(arg_list, "-r", READ_LENGTH, int), getOption(arg_list, "-f", "both"),
+                        getOption(arg_list, "-seed", 1, int))
+    sys.stdout.write("%s: %d positions, %d SNPs, %d alignments\n"
+                     % (arg_list[0], manifest["positions"], sum([len(snps) for snps in manifest["snps"].values()]),
+                        manifest["blocks"]))
@@ -0,0 +1,82 @@
+"""Panel definitions (BED files) for the region restricted calling of the polymorphism step.
+The intervals of a BED file are merged and kept per target as sorted start and end lists (0-based, end
+exclusive), so a position is checked by binary search and the positions of a whole nuccounts file by one
+searchsorted of NumPy. Target names are compared without "chr" like in calc.tidmap."""
+
+
+import bisect
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Regions(object):
+
+    """The merged intervals of one target."""
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def size(self):
+        """Returns the number of bases in the intervals."""
+        return sum([end - start for start, end in zip(self.starts, self.ends)])
+
+    def contains(self, pos):
+        """Returns True, if the position (1-based) is in an interval."""
+        index = bisect.bisect_right(self.starts, pos - 1) - 1
+        return index >= 0 and pos - 1 < self.ends[index]
+
+    def mask(self, positions):
+        """Returns a boolean array, which is True for the positions (1-based, array of integers or strings) in an
+        interval."""
+
+        positions = np.asarray(positions).astype(np.int64) - 1
+        if not self.starts:
+            return np.zeros(len(positions), dtype=bool)
+        index = np.searchsorted(np.array(self.starts, dtype=np.int64), positions, side="right") - 1
+        ends = np.array(self.ends, dtype=np.int64)
+        return (index >= 0) & (positions < ends[np.maximum(index, 0)])
+
+
+class Panel(object):
+
+    """The regions of a panel per target."""
+
+    def __init__(self, regions):
+        self.regions = regions
+
+    def getRegions(self, target):
+        """Returns the Regions of a target, empty Regions for targets outside the panel."""
+        return self.regions.get(target.replace("chr", ""), Regions())
+
+    def size(self):
+        """Returns the number of bases in the panel."""
+        return sum([regions.size() for regions in self.regions.values()])
+
+
+def loadBED(bed_file):
+    """Reads a BED file (target, start, end and optional further columns) and returns the Panel. Header lines
+    ("track", "browser", "#") are skipped."""
+
+    intervals = {}
+    with open(bed_file, "r") as f:
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            line_data = line.split()
+            target = line_data[0].replace("chr", "")
+            intervals.setdefault(target, []).append((int(line_data[1]), int(line_data[2])))
+
+    return Panel(dict([(target, Regions(intervals[target])) for target in intervals]))
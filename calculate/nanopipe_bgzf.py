@@ -0,0 +1,334 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Block-compressed output files with a coordinate index.
+The text outputs (calc.nuccounts.N, calc.consensus.N and the .poly files) are compressed into BGZF files (<file>.gz,
+gzip members of at most 64 KB like bgzip, readable by zcat). A position in the file is a virtual offset: the offset
+of the block in the compressed file shifted by 16 bits plus the offset in the uncompressed block. The index
+(<file>.gz.idx) holds the first coordinate and the virtual offset of the first record starting in every block, so a
+range of positions is read by seeking straight to its block. A record is a line with its position (nuccounts, poly)
+or a fragment of the consensus (header and sequence line, the range of the header). The offsets of the .help file of
+a nuccounts file are translated into virtual offsets, so it still points to every 1000th position.
+
+Compress the outputs of a run (the plain files are replaced):
+
+    nanopipe_bgzf.py calc.nuccounts.1 calc.consensus.1 calc.nuccounts.1.poly ...
+
+Read a range of positions:
+
+    nanopipe_bgzf.py -fetch calc.nuccounts.1.gz 1000 2000"""
+
+
+import sys
+import os
+import re
+import zlib
+import struct
+import bisect
+
+
+# Header of a BGZF block: gzip header with the extra field "BC" holding the block size - 1
+BLOCK_HEADER = struct.Struct("<4BI2BH2BHH")
+BLOCK_FOOTER = struct.Struct("<II")
+
+# Uncompressed bytes per block (like bgzip)
+BLOCK_SIZE = 0xff00
+
+# The empty block at the end of a BGZF file
+EOF_BLOCK = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# Header of the index files: magic, version, kind of the records and number of entries; an entry is the first
+# coordinate and the virtual offset
+MAGIC = b"NPBGZIDX"
+VERSION = 1
+HEADER = struct.Struct("<8sIII")
+ENTRY = struct.Struct("<IQ")
+
+# Extensions of the compressed files and their index
+GZ_EXT = ".gz"
+INDEX_EXT = ".idx"
+
+# Kinds of records
+NUCCOUNTS = 1
+POLY = 2
+CONSENSUS = 3
+
+# Header line of a consensus fragment: >tid (start:end)
+FRAGMENT = re.compile(r"^>\S+ \((\d+):(\d+)\)")
+
+
+def getKind(file_name):
+    """Returns the kind of records of an output file by its name, None for files without coordinates."""
+
+    name = os.path.basename(file_name)
+    if name.endswith(".poly"):
+        return POLY
+    if re.search(r"^calc\.nuccounts\.\d+$", name):
+        return NUCCOUNTS
+    if re.search(r"^calc\.consensus\.\d+$", name):
+        return CONSENSUS
+    return None
+
+
+class BGZFWriter(object):
+
+    """Writes a BGZF file. tell() returns the virtual offset of the next byte written."""
+
+    def __init__(self, file_name, level=6):
+        self.output_file = open(file_name, "wb")
+        self.level = level
+        self.block_offset = 0
+        self.buffer = []
+        self.buffer_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tell(self):
+        return (self.block_offset << 16) | self.buffer_size
+
+    def write(self, data):
+        while data:
+            part = data[:BLOCK_SIZE - self.buffer_size]
+            self.buffer.append(part)
+            self.buffer_size += len(part)
+            data = data[len(part):]
+            if self.buffer_size >= BLOCK_SIZE:
+                self.flush()
+
+    def flush(self):
+        """Writes the buffered data as a block."""
+
+        if not self.buffer_size:
+            return
+        data = b"".join(self.buffer)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        block_size = BLOCK_HEADER.size + len(compressed) + BLOCK_FOOTER.size
+        self.output_file.write(BLOCK_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2,
+                                                 block_size - 1))
+        self.output_file.write(compressed)
+        self.output_file.write(BLOCK_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data)))
+        self.block_offset += block_size
+        self.buffer = []
+        self.buffer_size = 0
+
+    def close(self):
+        if self.output_file is not None:
+            self.flush()
+            self.output_file.write(EOF_BLOCK)
+            self.output_file.close()
+            self.output_file = None
+
+
+class BGZFReader(object):
+
+    """Reads the lines of a BGZF file, from the start or from a virtual offset (seek). Only the current block is
+    held in memory."""
+
+    def __init__(self, file_name):
+        self.input_file = open(file_name, "rb")
+        self.block_offset = 0
+        self.next_offset = 0
+        self.data = b""
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def readBlock(self, offset):
+        """Reads the block at offset. Returns False at the end of the file."""
+
+        self.input_file.seek(offset)
+        header = self.input_file.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return False
+        block_size = BLOCK_HEADER.unpack(header)[-1] + 1
+        compressed = self.input_file.read(block_size - BLOCK_HEADER.size)
+        self.data = zlib.decompress(compressed[:-BLOCK_FOOTER.size], -15)
+        self.block_offset = offset
+        self.next_offset = offset + block_size
+        self.position = 0
+        return True
+
+    def seek(self, voffset):
+        self.readBlock(voffset >> 16)
+        self.position = voffset & 0xffff
+
+    def tell(self):
+        if self.position == len(self.data):
+            return self.next_offset << 16
+        return (self.block_offset << 16) | self.position
+
+    def readline(self):
+        """Returns the next line (str) or "" at the end of the file."""
+
+        parts = []
+        while True:
+            if self.position >= len(self.data):
+                if not self.readBlock(self.next_offset):
+                    break
+                continue
+            end = self.data.find(b"\n", self.position)
+            if end >= 0:
+                parts.append(self.data[self.position:end + 1])
+                self.position = end + 1
+                break
+            parts.append(self.data[self.position:])
+            self.position = len(self.data)
+        line = b"".join(parts)
+        return line if isinstance(line, str) else line.decode("ascii")
+
+    def readlines(self):
+        return list(self)
+
+    def close(self):
+        self.input_file.close()
+
+
+def openText(file_name):
+    """Opens a plain or block-compressed (.gz) text file for reading its lines."""
+    if file_name.endswith(GZ_EXT):
+        return BGZFReader(file_name)
+    return open(file_name, "r")
+
+
+def iterRecords(reader, kind):
+    """Yields the records (start, end, lines) of an output file from the current position of the reader."""
+
+    line = reader.readline()
+    while line:
+        if kind == CONSENSUS:
+            match = FRAGMENT.match(line)
+            if match:
+                sequence = reader.readline()
+                yield int(match.group(1)), int(match.group(2)), line + sequence
+        elif line[0] != ">" and line[0].isdigit():
+            pos = int(line.split("\t", 1)[0])
+            yield pos, pos, line
+        line = reader.readline()
+
+
+def compressFile(file_name, remove=True):
+    """Compresses an output file into <file>.gz and writes the index of its records (if the file has coordinates).
+    The .help file of a nuccounts file gets the virtual offsets. Returns the name of the compressed file."""
+
+    kind = getKind(file_name)
+    gz_file = file_name + GZ_EXT
+    help_offsets = {}
+    if kind == NUCCOUNTS and os.path.isfile(file_name + ".help"):
+        help_offsets = readHelp(file_name + ".help")
+
+    entries = []
+    last_block = -1
+    offset = 0
+    with open(file_name, "rb") as input_file, BGZFWriter(gz_file + ".tmp") as writer:
+        for line in input_file:
+            voffset = writer.tell()
+            if offset in help_offsets:
+                help_offsets[offset] = voffset
+            offset += len(line)
+
+            text = line if isinstance(line, str) else line.decode("ascii")
+            start = None
+            if kind == CONSENSUS:
+                match = FRAGMENT.match(text)
+                if match:
+                    start = int(match.group(1))
+            elif kind is not None and text[0].isdigit():
+                start = int(text.split("\t", 1)[0])
+            if start is not None and voffset >> 16 != last_block:
+                entries.append((start, voffset))
+                last_block = voffset >> 16
+            writer.write(line)
+    os.rename(gz_file + ".tmp", gz_file)
+
+    if kind is not None:
+        with open(gz_file + INDEX_EXT, "wb") as index_file:
+            index_file.write(HEADER.pack(MAGIC, VERSION, kind, len(entries)))
+            for entry in entries:
+                index_file.write(ENTRY.pack(*entry))
+    if help_offsets:
+        writeHelp(file_name + ".help", help_offsets)
+    if remove:
+        os.remove(file_name)
+
+    return gz_file
+
+
+def readHelp(help_file):
+    """Returns the offsets of the .help file of a nuccounts file: offset -> None."""
+
+    with open(help_file, "r") as f:
+        line_data = f.read().split()
+    return dict([(int(entry.split(":")[1]), None) for entry in line_data[2:]])
+
+
+def writeHelp(help_file, offsets):
+    """Replaces the offsets of the .help file by the virtual offsets of the compressed file."""
+
+    with open(help_file, "r") as f:
+        line_data = f.read().split()
+    entries = []
+    for entry in line_data[2:]:
+        pos, offset = entry.split(":")
+        entries.append("%s:%d" % (pos, offsets[int(offset)]))
+    with open(help_file, "w") as f:
+        f.write(" ".join(line_data[:2] + entries) + "\n")
+
+
+def readIndex(gz_file):
+    """Returns the kind of records and the entries (first coordinate, virtual offset) of the index of a compressed
+    file."""
+
+    with open(gz_file + INDEX_EXT, "rb") as f:
+        data = f.read()
+    magic, version, kind, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a valid index: %s" % (gz_file + INDEX_EXT))
+    return kind, [ENTRY.unpack_from(data, HEADER.size + i * ENTRY.size) for i in range(count)]
+
+
+def fetch(gz_file, start, end):
+    """Yields the records (start, end, lines) of a compressed output file overlapping the positions start to end
+    (1-based, inclusive). Only the blocks from the last index entry before start are read."""
+
+    kind, entries = readIndex(gz_file)
+    if not entries:
+        return
+    index = max(0, bisect.bisect_right([entry[0] for entry in entries], start) - 1)
+    with BGZFReader(gz_file) as reader:
+        reader.seek(entries[index][1])
+        for record in iterRecords(reader, kind):
+            if record[0] > end:
+                break
+            if record[1] >= start:
+                yield record
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: %s file ... | -fetch file.gz start end\n" % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+
+    if sys.argv[1] == "-fetch":
+        for record in fetch(sys.argv[2], int(sys.argv[3]), int(sys.argv[4])):
+            sys.stdout.write(record[2])
+        sys.exit(0)
+
+    for file_name in sys.argv[1:]:
+        if os.path.isfile(file_name):
+            compressFile(file_name)
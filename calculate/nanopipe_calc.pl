@@ -15,6 +15,7 @@
 #   calc.nuccounts
 #   calc.nuccounts.help
 #   calc.consensus
+#   (block-compressed as .gz files with a .gz.idx index, if compress=Y)
 #
 # Changes
 # [2018-02-14] Integrate "hot spots" / locations
@@ -60,6 +61,10 @@ my $TARGETFILE     = qq(input.target);
 
 # Calculate
 my $LASTFILE       = qq(calc.lastalign.maf);
+my $LIVEBATCHFILE  = qq(calc.live.batch);
+my $LIVEMAFFILE    = qq(calc.live.batch.maf);
+my $MANIFESTFILE   = qq(calc.nuccounts.manifest);
+my $OVERLAPERROR   = qq(calc.polymorphism.error);
 my $PIDFILE        = qq(calc.pid);
 my $STATISTICSFILE = qq(calc.statistics);
 
@@ -87,6 +92,9 @@ my $email;
 # The user's last parameters
 my $lastparams;
 
+# A batch of reads of a live run
+my $batch;
+
 #
 # ------------------------------------------------------------------------
 # Help
@@ -96,12 +104,15 @@ if (!@ARGV) {
 	my $pgm = basename $0;
 	print <<EOS;
 Usage: $pgm -q query -t target [-e emailaddr] [-p lastparams]
+       $pgm -b batch -t target
 
 Where
    query      - the query file (either a single file or archive like *.tgz)
    target     - the target for alaignment (dengue, plasmodium or a filename)
    emailaddr  - the email address (send if job finishes)
    lastparams - parameters for lastal call, surrounded with quotes (like "-A 13 -b 3")
+   batch      - a batch of reads (fasta or fastq) of a run still sequencing: the
+                reads are aligned and the .poly files are updated (see run.txt)
 EOS
 
 	exit 1;
@@ -155,7 +166,8 @@ sub init {
 			'q=s' => \$query,
 			't=s' => \$target,
 			'e=s' => \$email,
-			'p=s' => \$lastparams
+			'p=s' => \$lastparams,
+			'b=s' => \$batch
 		)
 	);
 
@@ -168,7 +180,13 @@ sub init {
 	$email      = nanopipe2::utils::readFile($EMAILFILE)      if (!$email);
 	$lastparams = nanopipe2::utils::readFile($LASTPARAMSFILE) if (!$lastparams);
 
-	if (!$query) {
+	if ($batch) {
+		if (!-r $batch) {
+			print STDERR qq(Cannot read batch file $batch!\n);
+			return 0;
+		}
+	}
+	elsif (!$query) {
 		print STDERR qq(Missing query file!\n);
 		return 0;
 	}
@@ -192,6 +210,107 @@ sub init {
 	return 1;
 }
 
+#
+# ------------------------------------------------------------------------
+# The arguments of the polymorphism step (nanopipe_calc_polymorphism.py)
+# ------------------------------------------------------------------------
+#
+sub polymorphismArgs {
+	my ($target) = @_;
+
+	my $param_s = $target =~ m/^(hg|Human)/ ? "-s human" : "";
+	$param_s = $target =~ m/^plasmodium/ ? "-s plasf" : "" if (!$param_s);
+	my $engine = $nanopipe2::config::values{polymorphism}->{engine};
+	my $param_e = $engine ? "-e $engine" : "";
+	my $plasmodb = $nanopipe2::config::values{polymorphism}->{plasmodb};
+	$plasmodb = "$nanopipe2::paths::PROJDIR/SNPdbPlasf" if (!$plasmodb);
+	my $workers = $nanopipe2::config::values{polymorphism}->{workers};
+	my $param_w = $workers ? "-w $workers" : "";
+	my $dbsnpcache = $nanopipe2::config::values{polymorphism}->{dbsnpcache};
+	my $param_c = $dbsnpcache ? "-c $dbsnpcache" : "";
+	my $dbsnpcachesize = $nanopipe2::config::values{polymorphism}->{dbsnpcachesize};
+	$param_c .= " -cs $dbsnpcachesize" if ($dbsnpcache && $dbsnpcachesize);
+	my %dbsnpoptions = (
+		dbsnpchunk   => "-dbchunk",
+		dbsnpthreads => "-dbthreads",
+		dbsnprate    => "-dbrate",
+		dbsnptimeout => "-dbtimeout",
+		dbsnpretries => "-dbretries"
+	);
+	for my $name (sort keys %dbsnpoptions) {
+		my $value = $nanopipe2::config::values{polymorphism}->{$name};
+		$param_c .= " $dbsnpoptions{$name} $value" if ($value);
+	}
+	$param_c .= " -dbcollapse" if ($nanopipe2::config::values{polymorphism}->{dbsnpcollapse});
+	if (($nanopipe2::config::values{polymorphism}->{annotation} || "") eq "vcf") {
+		my $vcfdb = $nanopipe2::config::values{polymorphism}->{vcfdb};
+		$vcfdb = qq($nanopipe2::paths::TARGETSDIR/$target/vcfdb) if (!$vcfdb);
+		$param_c .= " -vcf $vcfdb";
+	}
+	my $panel = $nanopipe2::config::values{polymorphism}->{panel};
+	$param_c .= " -bed $panel" if ($panel);
+	$param_c .= " -runcache calc.polymorphism.cache" if ($nanopipe2::config::values{polymorphism}->{runcache});
+	$param_c .= " -stream calc.polymorphism.stream" if ($nanopipe2::config::values{polymorphism}->{stream});
+	$param_c .= " -profile calc.polymorphism.prof" if ($nanopipe2::config::values{polymorphism}->{profile});
+	return qq(-q $param_s $param_e $param_w $param_c -d $plasmodb);
+}
+
+#
+# ------------------------------------------------------------------------
+# Live calling: align a batch of reads and update the .poly files
+# ------------------------------------------------------------------------
+#
+sub live {
+	print "==> Live calling of batch $batch\n";
+
+	my $start = time;
+
+	eval {
+		die qq(Live calling is not available for metagenomics!) if ($nanopipe2::config::values{common}->{metagenomics} eq "Y");
+
+		nanopipe2::calculate::query::prepareBatch($batch, $LIVEBATCHFILE);
+
+		nanopipe2::calculate::last::runBatch(
+			{
+				query       => $LIVEBATCHFILE,
+				target      => $target,
+				threads     => $nanopipe2::config::values{last}->{threads},
+				shards      => $nanopipe2::config::values{last}->{shards},
+				params      => $nanopipe2::config::values{last}->{params},
+				substmatrix => $nanopipe2::config::values{last}->{substmatrix}
+			},
+			$LIVEMAFFILE
+		);
+
+		# Merge the counts of the batch and publish the changed .poly files
+		my $analyze = $nanopipe2::config::values{analyze};
+		my $param_a = join(" ", map {"-$_ $analyze->{$_}"} grep {$analyze->{$_}} qw(mincount minlen maxgap maxN equal));
+		my $command = qq($nanopipe2::paths::CALCDIR/nanopipe_live.py $LIVEMAFFILE $param_a ) . polymorphismArgs($target);
+		my ($res, $error) = nanopipe2::utils::execute($command);
+		if ($res > 0 || $error) {
+			nanopipe2::utils::printError($command, $res, $error);
+
+			# Not merged: a retry of the batch must not append its alignments twice
+			die qq(Merging batch $batch failed!\n);
+		}
+
+		# The alignments of all batches for the bam file and a full calculation
+		open(IN,  "<",  $LIVEMAFFILE) or die qq(Cannot read $LIVEMAFFILE: $!\n);
+		open(OUT, ">>", $LASTFILE)    or die qq(Cannot append to $LASTFILE: $!\n);
+		print OUT while (<IN>);
+		close(OUT);
+		close(IN);
+		unlink($LIVEBATCHFILE, $LIVEMAFFILE);
+	};
+	if ($@) {
+		nanopipe2::messages::add(qq(An error occured in the live calling of batch $batch!));
+		print STDERR $@;
+	}
+	nanopipe2::messages::save();
+
+	print "Time: " . (time - $start) . " seconds\n";
+}
+
 #
 # ------------------------------------------------------------------------
 # Generate bam and bai files
@@ -207,14 +326,47 @@ sub calcBam {
 		exit 1;
 	}
 
-	my $command = qq($MAFCONVERT sam -d $LASTFILE >calc.sam
-$SAMTOOLS view -bS -o calc.bam calc.sam >/dev/null 2>&1
-$SAMTOOLS sort -o calc.bam-sorted calc.bam >/dev/null 2>&1
-mv calc.bam-sorted calc.bam
-$SAMTOOLS index calc.bam >/dev/null 2>&1);
-	my ($res, $error) = nanopipe2::utils::execute($command);
-	if ($res > 0 || $error) {
-		nanopipe2::utils::printError($command, $res, $error);
+	# The sam records are sorted as they are converted, without
+	# intermediate sam and unsorted bam files.  The sort uses threads *
+	# memory at most, larger data is merged from temporary files.
+	my $threads = $nanopipe2::config::values{bam}->{threads} || 1;
+	my $memory  = $nanopipe2::config::values{bam}->{memory}  || "768M";
+	my @steps   = (
+		[qq(convert and sort), qq(($MAFCONVERT sam -d $LASTFILE | $SAMTOOLS sort -@ $threads -m $memory -T calc.bam.tmp -o calc.bam - 2>/dev/null))],
+		[qq(index), qq($SAMTOOLS index calc.bam >/dev/null 2>&1)]
+	);
+	for my $step (@steps) {
+		my ($name, $command) = @$step;
+		my $stepstart = time;
+		my ($res, $error) = nanopipe2::utils::execute($command);
+		if ($res > 0 || $error) {
+			nanopipe2::utils::printError($command, $res, $error);
+			last;
+		}
+		print "Time ($name): " . (time - $stepstart) . " seconds\n";
+	}
+
+	print "Time: " . (time - $start) . " seconds\n";
+}
+
+#
+# ------------------------------------------------------------------------
+# Compress the nuccounts, consensus and .poly files (block-compressed .gz
+# files with a coordinate index, see nanopipe_bgzf.py)
+# ------------------------------------------------------------------------
+#
+sub compressOutputs {
+	print "==> Compress the output files\n";
+
+	my $start = time;
+
+	my @files = grep {/^calc\.(nuccounts|consensus)\.\d+(\.poly)?$/} glob("calc.nuccounts.* calc.consensus.*");
+	if (@files) {
+		my $command = qq($nanopipe2::paths::CALCDIR/nanopipe_bgzf.py @files);
+		my ($res, $error) = nanopipe2::utils::execute($command);
+		if ($res > 0 || $error) {
+			nanopipe2::utils::printError($command, $res, $error);
+		}
 	}
 
 	print "Time: " . (time - $start) . " seconds\n";
@@ -260,6 +412,7 @@ sub main {
 	my $start = time;
 
 	return if (!init());
+	return live() if ($batch);
 
 	nanopipe2::utils::writeFile($PIDFILE, $$);
 
@@ -284,6 +437,9 @@ sub main {
 
 	alarm $nanopipe2::config::values{common}->{timeout} * 3600;
 
+	# The process of the overlapped polymorphism step
+	my $polymorphism;
+
 	eval {
 		my $target = nanopipe2::utils::readFile(qq($TARGETFILE));
 		$target =~ s/^\s+//;
@@ -291,8 +447,9 @@ sub main {
 
 		nanopipe2::calculate::query::run(
 			{
-				query  => $query,
-				minlen => $nanopipe2::config::values{input}->{minlen}
+				query   => $query,
+				minlen  => $nanopipe2::config::values{input}->{minlen},
+				workers => $nanopipe2::config::values{input}->{workers}
 			}
 		);
 
@@ -302,6 +459,7 @@ sub main {
 				query        => $QUERYFILE,
 				target       => $target,
 				threads      => $nanopipe2::config::values{last}->{threads},
+				shards       => $nanopipe2::config::values{last}->{shards},
 				params       => $nanopipe2::config::values{last}->{params},
 				substmatrix  => $nanopipe2::config::values{last}->{substmatrix}
 			}
@@ -311,6 +469,18 @@ sub main {
 			nanopipe2::messages::add(qq(There are no results, because the basic alignment failed!));
 		}
 		else {
+			# Overlapped mode: the polymorphism step calls every target, as
+			# soon as analyze.pm has published it in the manifest, while the
+			# other targets and the bam files are generated
+			my $overlap = $nanopipe2::config::values{polymorphism}->{overlap}
+			  && $nanopipe2::config::values{common}->{metagenomics} ne "Y";
+			my $overlapcommand =
+			  qq($nanopipe2::paths::CALCDIR/nanopipe_calc_polymorphism.py ) . polymorphismArgs($target) . qq( -follow $MANIFESTFILE);
+			if ($overlap) {
+				unlink($MANIFESTFILE);
+				$polymorphism = nanopipe2::utils::executeBackground($overlapcommand, $OVERLAPERROR);
+			}
+
 			nanopipe2::calculate::analyze::run(
 				{
 					metagenomics => $nanopipe2::config::values{common}->{metagenomics},
@@ -321,26 +491,42 @@ sub main {
 					maxN         => $nanopipe2::config::values{analyze}->{maxN},
 					equal        => $nanopipe2::config::values{analyze}->{equal},
 					hscore       => $nanopipe2::config::values{analyze}->{hscore},
+					nuccounts    => $nanopipe2::config::values{analyze}->{nuccounts},
+					engine       => $nanopipe2::config::values{analyze}->{engine},
+					manifest     => ($overlap ? $MANIFESTFILE : undef),
 				}
 			);
 			if ($nanopipe2::config::values{common}->{metagenomics} ne "Y") {
 				calcBam();
 
+				if ($polymorphism) {
+					my ($res, $error) = nanopipe2::utils::waitBackground($polymorphism, $OVERLAPERROR);
+					$polymorphism = undef;
+					if ($res > 0 || $error) {
+						nanopipe2::utils::printError($overlapcommand, $res, $error);
+					}
+				}
+
 				# Check if tidmap has size > 0, meaning no data was generated
 				my $size = (stat(qq(calc.tidmap)))[7];
 				if ($size == 0) {
 					nanopipe2::messages::add(qq(No results had been generated!  Maybe the input data was too weak?));
 				}
-				else {
-					my $param_s = $target =~ m/^(hg|Human)/ ? "-s human" : "";
-					$param_s = $target =~ m/^plasmodium/ ? "-s plasf" : "" if (!$param_s);
-					my $command = qq($nanopipe2::paths::CALCDIR/nanopipe_calc_polymorphism.py -q $param_s);
-					my ($res, $error) = nanopipe2::utils::execute($command);
+				elsif (!$overlap) {
+					my $args = polymorphismArgs($target);
+					my $command = qq($nanopipe2::paths::CALCDIR/nanopipe_calc_polymorphism.py $args);
+					my ($res, $error);
+					my $worker = $nanopipe2::config::values{polymorphism}->{worker};
+					if ($worker && nanopipe2::utils::isWorkerRunning($worker)) {
+						($res, $error) = nanopipe2::utils::submitJob($worker, $args);
+					}
+					($res, $error) = nanopipe2::utils::execute($command) if (!defined($res));
 					if ($res > 0 || $error) {
 						nanopipe2::utils::printError($command, $res, $error);
 					}
 				}
 			}
+			compressOutputs() if ($nanopipe2::config::values{common}->{compress} eq "Y");
 		}
 
 		my $duration = time - $start;
@@ -354,6 +540,10 @@ sub main {
 	if ($@) {
 		nanopipe2::messages::add(qq(An error occured in the calculation of results!));
 		print STDERR $@;
+		if ($polymorphism) {
+			kill(15, $polymorphism);
+			waitpid($polymorphism, 0);
+		}
 		finnish(1);
 	}
 }
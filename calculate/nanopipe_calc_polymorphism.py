@@ -6,16 +6,34 @@ from __future__ import division
 """This script takes candidate polymorphisms from LAST alignments.
 From the raw counts of nucleotides, the script validates SNPs by relative frequencies. These are then weighted by the probabilities
 for base transitions (transitions vs. transversions). For human data, SNP positions are compared to dbSNP, extracting also reported
-alleles and rs-IDs."""
+alleles and rs-IDs. With a local VCF database (see nanopipe_vcfdb.py) the SNPs of any organism are annotated offline."""
 
 
 import sys
 import os
 import re
 import json
-from subprocess import Popen, PIPE, STDOUT
+import itertools
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import cProfile
+import multiprocessing
+import subprocess
 import time
 
+import nanopipe_bed
+import nanopipe_bgzf
+import nanopipe_dbsnp
+import nanopipe_metrics
+import nanopipe_nuccounts
+import nanopipe_plasmodb
+import nanopipe_qualreg
+import nanopipe_runcache
+import nanopipe_snpcall
+import nanopipe_vcfdb
+
 """Functions"""
 
 def calculateBchange(nuc, target, tt_ratio):
@@ -38,140 +56,698 @@ def calculateBchange(nuc, target, tt_ratio):
         return "Error: Non-DNA character encountered"
 
 
+def getOption(arg_list, option, default, convert=str):
+
+    """Returns the value following option in the command line arguments, converted by convert. Returns default,
+    if the option is missing or the value is invalid."""
+
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+def toNumber(value):
+    """Returns a parameter value as int, if it is integral, else as float."""
+    value = float(value)
+    if value == int(value):
+        return int(value)
+    return value
+
+
+def getGridOption(arg_list, option, default):
+    """Returns the list of values of a parameter in the comma separated value following option."""
+    values = getOption(arg_list, option, str(default)).split(",")
+    try:
+        return [toNumber(value) for value in values]
+    except ValueError:
+        return [default]
+
+
+def removeOptions(arg_list, options):
+    """Returns the command line arguments without the options and their values."""
+    result = []
+    arg_iter = iter(arg_list)
+    for arg in arg_iter:
+        if arg in options:
+            next(arg_iter, None)
+        else:
+            result.append(arg)
+    return result
+
+
 def getSNPwww(queries):
 
-    """A function to look up base multiple positions in the new API of dbSNP."""
+    """A function to look up base multiple positions in the new API of dbSNP. Positions in the local annotation cache
+    are not sent again, failed requests are retried by the client (see nanopipe_dbsnp.py)."""
+
+    return nanopipe_dbsnp.getSNPwww(queries, dbsnp_cache, dbsnp_client)
+
 
-    import urllib2
-    import urllib
+def getSNPplas(chr_numb, print_dict, call_key=None):
     
-    out_dict = {}
-    isDBerror = False
+    """Check candidate SNP positions in print_dict for reports in the local PlasmoDB database. The database is available for Plasmodium falciparum
+    and the version 3 (_v3). The positions are looked up by binary search in the compiled index of the database (see nanopipe_plasmodb.py).
+    With the key of the call set, the matches are kept in the run cache until the database files change.
+    The function will return a dictionary: outdict[snp]=[(dbID, [dbMaj: dbMajF, dbMin: dbMinF])]"""
     
-    try:
-        
-        query_str =""
-        assembly = "GCF_000001405.38"
-       
-        # Create post request string for API. Example: query_str = "10 557773 iD G N\n 10 557775 iD C C"
-        # 50,000 positions can be queried at once. I use 40,000 for security.
+    if run_cache is None or call_key is None:
+        return nanopipe_plasmodb.lookup(plas_dir, chr_numb, print_dict.keys())
+
+    db_version = [nanopipe_runcache.getDBVersion(os.path.join(plas_dir, chr_numb + ext)) for ext in (".txt", ".idx")]
+    key = nanopipe_runcache.makeKey(call_key, os.path.abspath(plas_dir), db_version)
+    plas_dict = run_cache.get("plasmodb", chr_numb, key)
+    if plas_dict is None:
+        plas_dict = nanopipe_plasmodb.lookup(plas_dir, chr_numb, print_dict.keys())
+        run_cache.put("plasmodb", chr_numb, key, plas_dict)
+    return plas_dict
+
+
+
+def iterCalls(file_name, regions=None):
 
-        for i in range (0, len(queries), 40000):
-            l=queries[i:i+40000]
-            query_str= "".join(l)
+    """Calls the polymorphisms of one nuccounts file line by line. Yields (position, coverage, print_list, nuc_dict)
+    for every position, print_list holds the output columns of a candidate SNP and is None for the other positions.
+    With regions (see nanopipe_bed.py) the positions outside the regions are skipped."""
 
-            api_link = "https://api.ncbi.nlm.nih.gov/variation/v0/vcf/file/set_rsids?assembly=" + assembly
+    # Read file (text or binary)....
+    with nanopipe_nuccounts.openNuccounts(file_name) as alignment_file:
+        for line in alignment_file:
+            print_list = []
+            nuc_dict = {}
+            isPoly = False
+            poly_dict = {}
+            line = line.replace("\n", "")
+            line_data = line.split("\t")
             
-            # Try if server responds
-            try:
-                site = urllib2.Request(api_link, query_str) 
-                resp = urllib2.urlopen(site).read().strip("\n")
-                
-                # Each list entry is one position
-                out_list = resp.split("\n") 
-            except urllib2.HTTPError:
-                isDBerror = True
-                print "HTTPError on website  %s." % api_link
-                break
-    
-            except urllib2.URLError:
-                isDBerror = True
-                print "URLError on website %s." % api_link
-                break
+            # .... and extract data
+            if ">" in line_data[0]:
+                continue
+            pos_start = line_data[0]
+            if regions is not None and not regions.contains(int(pos_start)):
+                continue
+            nuc_dict["a"] = int(line_data[1])
+            nuc_dict["c"] = int(line_data[2])
+            nuc_dict["g"] = int(line_data[3])
+            nuc_dict["t"] = int(line_data[4])
+            consensus = line_data[5].lower()
+            target = line_data[6].lower()
             
-            else:
-                # Retrieve and process results
-                for pos in out_list:    
-                    pos_data = pos.split("\t")
+            # Total amount of nucleotides per position
+            total_nuc = 0
+            for nuc_count in nuc_dict.values():
+                total_nuc = total_nuc + nuc_count
+            
+            if consensus not in ["-", "n"]:
+    
+                # SNP is accepted if: (1) target nuc < 0.8 [isPoly = True]; (2) one other nuc > 0.2 [poly_threshold]
+                ## Special consensus symbols according to IUPAC and "X" pass (1) automatically, (2) also fulfilled
+                if consensus in ["m", "r", "w", "s", "y", "k", "v", "h", "d", "b", "x"]:
+                    isPoly = True
+                else:
+                    if target in ["a", "c", "g", "t"]:
+                        if nuc_dict[target] / total_nuc <= target_threshold:
+                            isPoly = True
+                    else:
+                        isPoly = False
+    
+                ## Check for condition (2)       
+                if isPoly == True:
+                    for nuc in nuc_dict:   
+                        rel_nuc = nuc_dict[nuc] / total_nuc
+                        rel_nuc = round(rel_nuc, 3)
+                        if rel_nuc >= poly_threshold:
+                            poly_dict[nuc] = [rel_nuc, calculateBchange(nuc, target, tt_ratio)]  # obtain score for transitions vs transversions
+    
+                # Give weight to the relative occurence of a nuc
+                if poly_dict:
                     
-                    if len(pos_data) >= 5:
-                        chr = pos_data[0]
-                        base_pos = pos_data[1]
-                        rs_id = pos_data[2]
-                        allele = pos_data[3]+"/"+pos_data[4]
-                        
-                        # Get rid of NORSID and second part of error message
-                        if re.match(r"rs", rs_id):
-                            isID = False
-                            
-                            if chr in out_dict:
-                                
-                                if base_pos in out_dict[chr]:
-                                    
-                                    #Get to the tupels
-                                    for list_element in out_dict[chr][base_pos]:# outdict[base position]=[(rs_id, [allels])]
-                                        if rs_id in list_element[0]:
-                                            isID = True
-                                            
-                                            # Avoid multiple entries of the same alleles for the same rs_ID
-                                            if allele in list_element[1]:  
-                                                break
-                                            else:
-                                                list_element[1].append(allele)
-                                                
-                                    # The rs_ID was not at all in the list of values
-                                    if isID == False:
-                                        out_dict[chr][base_pos].append((rs_id, [allele]))
-                                        
+                    for nuc in poly_dict:
+                        poly_dict[nuc] = poly_dict[nuc][0] * poly_dict[nuc][1]
+    
+                    # Rescale weighted rel. occurences to 1
+                    weight_factor = sum(poly_dict.values()) / 1
+                    if weight_factor != 0:
+                        for nuc in ["a", "c", "g", "t"]:
+                            if nuc in poly_dict:
+                                resc_prob = round(poly_dict[nuc] / weight_factor, 3)
+                                if resc_prob > 0:
+                                    print_list.append(str(resc_prob)+"\t")
                                 else:
-                                    out_dict[chr][base_pos] = [(rs_id, [allele])]
-                                    
+                                    print_list.append("-\t") 
                             else:
-                                out_dict[chr] ={base_pos: [(rs_id, [allele])]}
-                        
-                    # Write error message from API
-                    else:
-                        print "".join(pos)
-                        
-            # At max two queries per second
-            time.sleep(0.5)
-        
-    finally:
-        return out_dict, isDBerror
+                                print_list.append("-\t")
+                        print_list.append(target+"\t")
+                        print_list.append("\n")
 
+            yield pos_start, total_nuc, print_list or None, nuc_dict
 
-def getSNPplas(chr_numb, print_dict):
-    
-    """Check candidate SNP positions in print_dict for reports in the local PlasmoDB database. The database is available for Plasmodium falciparum
-    and the version 3 (_v3). All IDs in a database file have to be sorted according to the position!
-    The function will return a dictionary: outdict[snp]=[(dbID, [dbMaj: dbMajF, dbMin: dbMinF])]"""
+
+def callNuccounts(file_name, regions=None):
+
+    """Calls the polymorphisms of one nuccounts file line by line. Returns the dictionaries print_dict (output columns
+    of the candidate SNPs), cover_dict (coverage -> positions) and raw_cov_dict (raw nucleotide counts of the SNPs).
+    With regions (see nanopipe_bed.py) the positions outside the regions are skipped."""
+
+    print_dict = {}
+    cover_dict = {} # for discarding low coverage data
+    raw_cov_dict = {} #for printing raw coverage
+
+    for pos_start, total_nuc, print_list, nuc_dict in iterCalls(file_name, regions):
+
+        # Save coverage for all positions
+        if total_nuc in cover_dict:
+            cover_dict[total_nuc].append(pos_start)
+        else:
+            cover_dict[total_nuc] = [pos_start]
+
+        if print_list:
+            print_dict[pos_start] = print_list
+            raw_cov_dict[pos_start] = nuc_dict
+
+    return print_dict, cover_dict, raw_cov_dict
+
+
+def getRegions(file_name):
+    """Returns the panel regions of the target of a nuccounts file, None without panel."""
+    if panel is None:
+        return None
+    chr_enc = file_name.split(".")[2]
+    # The process pool of the follow mode is started before the target is published
+    if chr_enc not in chr_enc_dict and follow_file:
+        readTargets(follow_file, True)
+    return panel.getRegions(chr_enc_dict[chr_enc])
+
+
+def processNuccounts(file_name):
+
+    """Calls the polymorphisms of one nuccounts file with the chosen engine and discards SNPs with low coverage.
+    Returns (file_name, print_dict, raw_cov_dict, isPolyFile, stats), where isPolyFile is False, if the file had no
+    polymorphisms before the coverage cutoff. stats holds the wall and CPU time of the calling and the coverage
+    cutoff and the number of candidates. Runs in the worker processes of the process pool."""
+
+    start_wall, start_cpu = time.time(), nanopipe_metrics.getCPU()
+    regions = getRegions(file_name)
+    if file_name in precomputed_calls:
+        print_dict, cover_dict, raw_cov_dict = precomputed_calls[file_name]
+    elif regions is not None and not regions:
+        # The target is not in the panel
+        print_dict, cover_dict, raw_cov_dict = {}, {}, {}
+    elif engine == "numpy":
+        print_dict, cover_dict, raw_cov_dict = nanopipe_snpcall.callNuccounts(file_name, target_threshold,
+                                                                              poly_threshold, tt_ratio, regions)
+    else:
+        print_dict, cover_dict, raw_cov_dict = callNuccounts(file_name, regions)
+    stats = {"calling": (time.time() - start_wall, nanopipe_metrics.getCPU() - start_cpu),
+             "candidates": len(print_dict), "cached": 0}
+
+    if not (cover_dict and print_dict):
+        stats["coverage"] = (0.0, 0.0)
+        return file_name, print_dict, raw_cov_dict, False, stats
+    start_wall, start_cpu = time.time(), nanopipe_metrics.getCPU()
+    applyCoverage(print_dict, cover_dict, raw_cov_dict, cover_threshold)
+
+    stats["coverage"] = (time.time() - start_wall, nanopipe_metrics.getCPU() - start_cpu)
+    return file_name, print_dict, raw_cov_dict, True, stats
+
+
+def applyCoverage(print_dict, cover_dict, raw_cov_dict, cover_threshold):
+
+    """Discards the SNPs of a file with a coverage below cover_threshold times the highest coverage of the file."""
+
+    # Get the highest coverage of an SNP within a file, calculate a minimum coverage for every SNP
+    cover_list = cover_dict.keys()
+    cover_list.sort()
+    highest_cover = cover_list[-1]
+    min_cover = highest_cover * cover_threshold
     
-    outdict = {}
-    snp_list = print_dict.keys()
-    dbPath = "/bioinf/projects/SNPdbPlasf/"+chr_numb+".txt"
-    with open(dbPath, "r") as plasmDB:
-        for line in plasmDB:
-            
-            # Skip header
-            if not "[" in line[0]:
-                
-                # Get ID
-                dbID = line.split("\t")[0]
-                dbPos = dbID.split(".")[-1]
-                
-                # Check if SNPs match
-                for snp in snp_list:
-                    if snp == dbPos:
-                        
-                        # Major allele and its frequency
-                        dbMaj = line.split("\t")[1]
-                        dbMajF = line.split("\t")[2]
-                        
-                        # Minor allele and its frequency
-                        dbMin = line.split("\t")[3]
-                        dbMinF = line.split("\t")[4]
-                        
-                        # Write to outdict
-                        if snp in outdict:
-                            outdict[snp].append((dbID, [dbMaj + ":" + dbMajF, dbMin + ":" + dbMinF]))
-                        else:
-                            outdict[snp]=[(dbID, [dbMaj + ":" + dbMajF, dbMin + ":" + dbMinF])]
-                            
-                    # Remove SNPs from the list that can't be found (anymore)      
-                    elif int(snp) < int(dbPos):
-                        snp_list.remove(snp)       
-    return outdict
+    for coverage in cover_dict:
+        if coverage < min_cover:
+            for position in cover_dict[coverage]:
+                if position in print_dict:
+                    del print_dict[position]
+                    del raw_cov_dict[position]
+
+
+def sweepNuccounts(file_name):
+
+    """Calls the polymorphisms of one nuccounts file for all parameter sets of the grid. The counts are read once,
+    the calling is repeated only for different target_threshold, poly_threshold and tt_ratio. Returns (file_name,
+    counts, call_sets), where counts holds (candidates, SNPs after the coverage cutoff) per parameter set and
+    call_sets the results of the selected parameter sets (set -> (print_dict, raw_cov_dict, isPolyFile,
+    candidates)). Runs in the worker processes of the process pool."""
+
+    regions = getRegions(file_name)
+    data = None
+    if regions is None or regions:
+        data = nanopipe_snpcall.loadNuccounts(file_name)
+    if regions is not None:
+        data = nanopipe_snpcall.restrictCounts(data, regions)
+    calls = {}
+    counts = []
+    call_sets = {}
+    for index, (target_threshold, poly_threshold, cover_threshold, tt_ratio) in enumerate(grid, 1):
+        params = (target_threshold, poly_threshold, tt_ratio)
+        if params not in calls:
+            calls[params] = nanopipe_snpcall.callCounts(data, target_threshold, poly_threshold, tt_ratio)
+        print_dict, cover_dict, raw_cov_dict = calls[params]
+        print_dict, raw_cov_dict = dict(print_dict), dict(raw_cov_dict)
+
+        candidates = len(print_dict)
+        isPolyFile = bool(cover_dict and print_dict)
+        if isPolyFile:
+            applyCoverage(print_dict, cover_dict, raw_cov_dict, cover_threshold)
+        counts.append((candidates, len(print_dict)))
+        if index in sweep_sets:
+            call_sets[index] = (print_dict, raw_cov_dict, isPolyFile, candidates)
+
+    return file_name, counts, call_sets
+
+
+def writeSpill(spill, print_dict, raw_cov_dict):
+    """Writes the candidate SNPs to a spill file in the order of their positions: position, raw counts of A, C, G, T,
+    the probabilities and the target."""
+
+    for pos in sorted(print_dict, key=int):
+        spill.write("%s\t%d\t%d\t%d\t%d\t%s\n" % ((pos,) + tuple([raw_cov_dict[pos][nuc] for nuc in "acgt"]) +
+                                                 ("".join(print_dict[pos][:5]),)))
+
+
+def readSpill(spill_file, min_cover, chunk_size):
+    """Yields the SNPs of a spill file with a coverage of at least min_cover in chunks of at most chunk_size SNPs as
+    (print_dict, raw_cov_dict) like processNuccounts."""
+
+    print_dict = {}
+    raw_cov_dict = {}
+    with open(spill_file, "r") as spill:
+        for line in spill:
+            line_data = line.split("\t")
+            nuc_dict = dict(zip("acgt", [int(count) for count in line_data[1:5]]))
+            if sum(nuc_dict.values()) < min_cover:
+                continue
+            print_dict[line_data[0]] = [column + "\t" for column in line_data[5:10]] + ["\n"]
+            raw_cov_dict[line_data[0]] = nuc_dict
+            if len(print_dict) >= chunk_size:
+                yield print_dict, raw_cov_dict
+                print_dict = {}
+                raw_cov_dict = {}
+    if print_dict:
+        yield print_dict, raw_cov_dict
+
+
+def streamNuccounts(file_name):
+
+    """Calls the polymorphisms of one nuccounts file for the streaming mode. The candidates are written to the spill
+    file <stream_dir>/<file_name>.snps instead of being returned and the highest coverage of the file is taken on the
+    way, so neither the positions nor the candidates of a file are held in memory. Returns (file_name, spill_file,
+    highest coverage, stats) with stats like processNuccounts. Runs in the worker processes of the process pool."""
+
+    start_wall, start_cpu = time.time(), nanopipe_metrics.getCPU()
+    regions = getRegions(file_name)
+    spill_file = os.path.join(stream_dir, file_name + ".snps")
+    highest_cover = 0
+    candidates = 0
+
+    with open(spill_file, "w") as spill:
+        if regions is not None and not regions:
+            # The target is not in the panel
+            pass
+        elif engine == "numpy":
+            for data in nanopipe_snpcall.iterNuccounts(file_name, stream_chunk):
+                if regions is not None:
+                    data = nanopipe_snpcall.restrictCounts(data, regions)
+                print_dict, cover_dict, raw_cov_dict = nanopipe_snpcall.callCounts(data, target_threshold,
+                                                                                   poly_threshold, tt_ratio)
+                highest_cover = max([highest_cover] + cover_dict.keys())
+                writeSpill(spill, print_dict, raw_cov_dict)
+                candidates += len(print_dict)
+        else:
+            print_dict = {}
+            raw_cov_dict = {}
+            for pos_start, total_nuc, print_list, nuc_dict in iterCalls(file_name, regions):
+                highest_cover = max(highest_cover, total_nuc)
+                if print_list:
+                    print_dict[pos_start] = print_list
+                    raw_cov_dict[pos_start] = nuc_dict
+                    if len(print_dict) >= stream_chunk:
+                        writeSpill(spill, print_dict, raw_cov_dict)
+                        candidates += len(print_dict)
+                        print_dict = {}
+                        raw_cov_dict = {}
+            writeSpill(spill, print_dict, raw_cov_dict)
+            candidates += len(print_dict)
+
+    stats = {"calling": (time.time() - start_wall, nanopipe_metrics.getCPU() - start_cpu),
+             "candidates": candidates, "cached": 0}
+    return file_name, spill_file, highest_cover, stats
+
+
+def readTargets(file_name, follow=False):
+
+    """Adds the targets of calc.tidmap or of the manifest of analyze.pm (lines "target<TAB>chr_enc", the manifest is
+    complete with the line "#end", or "#error" if the counting failed) to chr_enc_dict and chr_to_enc_dict. Returns
+    the chr_encs in the order of the file and the final line of the manifest (None, if not complete). With follow, a
+    line still being written is left for the next read."""
+
+    chr_encs = []
+    marker = None
+    with open(file_name, "r") as chr_file:
+        for line in chr_file:
+            if follow and not line.endswith("\n"):
+                break
+            if line.startswith("#"):
+                if line.strip() in ("#end", "#error"):
+                    marker = line.strip()
+                continue
+            line_list = line.strip("\n").split("\t")
+            chr_ = line_list[0]
+            chr_ = chr_.replace("chr", "")
+            chr_enc = line_list[1]
+            chr_enc_dict[chr_enc] = chr_
+            chr_to_enc_dict[chr_] = chr_enc
+            chr_encs.append(chr_enc)
+    return chr_encs, marker
+
+
+def followManifest(manifest_file):
+
+    """Yields the nuccounts files of the targets in the manifest of analyze.pm as soon as they are published, until
+    the manifest is complete. Binary files are preferred to text files like in the listing of the directory. Exits,
+    if the manifest ends with an error."""
+
+    published = 0
+    while True:
+        marker = None
+        if os.path.exists(manifest_file):
+            chr_encs, marker = readTargets(manifest_file, True)
+            for chr_enc in chr_encs[published:]:
+                file_name = "calc.nuccounts." + chr_enc
+                for name in [file_name + nanopipe_nuccounts.BINARY_EXT, file_name, file_name + nanopipe_bgzf.GZ_EXT]:
+                    if os.path.isfile(name):
+                        yield name
+                        break
+                else:
+                    print file_name + ": No nuccounts file."
+            published = len(chr_encs)
+        if marker == "#error":
+            print manifest_file + ": Counting the nucleotids failed."
+            sys.exit(1)
+        if marker == "#end":
+            return
+        time.sleep(follow_poll)
+
+
+def mergeResults(nuccounts_list, cached, results):
+
+    """Yields the results of processNuccounts in the order of nuccounts_list. The call sets of unchanged files are
+    taken from cached (file_name -> (print_dict, raw_cov_dict, isPolyFile, candidates)), the others from results."""
+
+    for file_name in nuccounts_list:
+        if file_name in cached:
+            print_dict, raw_cov_dict, isPolyFile, candidates = cached[file_name]
+            yield file_name, print_dict, raw_cov_dict, isPolyFile, {"calling": (0.0, 0.0), "coverage": (0.0, 0.0),
+                                                                   "candidates": candidates, "cached": 1}
+        else:
+            yield next(results)
+
+
+def annotateCalls(file_name, print_dict, raw_cov_dict, call_key=None):
+
+    """Adds the matches of the local databases (VCF database or PlasmoDB, else the placeholder of the database
+    column) and the raw coverage to the SNPs of one nuccounts file and sets the header of res_dict. Returns the chromosome/transcriptome ID of the file."""
+
+    # Get reference data for suspect SNPs from dbSNP
+    chr_enc = str(file_name.split(".")[2])  # file name: calc.nuccounts.chr_enc[.bin|.gz]
+    chr_numb = chr_enc_dict[chr_enc] #1
+
+    if not vcf_dir and organism != "Plasmodium falciparum" and organism != "Homo sapiens":
+        print file_name + ": %s, %s not in SNP databases." % (organism, chr_numb)
+        res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\traw A\traw C\traw G\traw T\n"
+
+    else:
+        for pos in print_dict:
+            print_dict[pos].pop(-1)
+            print_dict[pos].append("\t")
+
+    # Local VCF database, any organism
+    if vcf_dir:
+        res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\tMatches in VCF\traw A\traw C\traw G\traw T\n"
+        if nanopipe_vcfdb.hasTarget(vcf_dir, chr_numb):
+            metrics.start("vcf")
+            vcf_dict = nanopipe_vcfdb.lookup(vcf_dir, chr_numb, print_dict.keys())
+            metrics.stop("vcf", queries=len(print_dict), matches=len(vcf_dict))
+
+            # List_element is a tupel: (vcfID, [ref, alt, ...])
+            for vcf_pos in vcf_dict:
+                print_dict[vcf_pos].pop(-1)
+                print_dict[vcf_pos].append("; ".join([vcf_ID + ": " + " + ".join(alleles)
+                                                      for vcf_ID, alleles in vcf_dict[vcf_pos]]) + "\t")
+            print file_name + ": VCF local: %s match(es)." % str(len(vcf_dict))
+        else:
+            print file_name + ": %s, %s not in local VCF database." % (organism, chr_numb)
+            for pos in print_dict:
+                print_dict[pos].pop(-1)
+                print_dict[pos].append("N/A\t")
+
+    #Plasmodium falciparum            
+    elif organism == "Plasmodium falciparum":
+        res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\tMatches in PlasmoDB\traw A\traw C\traw G\traw T\n"
+        try:
+            chr_numb = chr_numb.split(":")[0]
+        except:
+            pass
+
+        # Local database features Plasmodium falciparum v3
+        if re.search(r"^Pf3D7_\d\d_v3", chr_numb):
+            metrics.start("plasmodb")
+            plas_dict = getSNPplas(chr_numb, print_dict, call_key)
+            metrics.stop("plasmodb", queries=len(print_dict), matches=len(plas_dict))
+
+            if plas_dict:
+                suc = 0
+                fail = 0
+                for plas_pos in plas_dict:
+                    plas_pos = str(plas_pos)
+                    if plas_pos in print_dict:
+                        print_dict[plas_pos].pop(-1)
+                        rs_counter = 0
+
+                        # List_element is a tupel: (plasID, [dbMaj: dbMajF, dbMin: dbMinF])
+                        plas_str = ""
+                        for list_element in plas_dict[plas_pos]:
+                            rs_counter += 1
+                            plas_ID = list_element[0]
+                            plas_str = plas_str + plas_ID + ": "
+                            allele_counter = 0
+                            for plas_allele in list_element[1]:
+                                allele_counter += 1
+                                plas_str = plas_str + plas_allele                                            
+                                # The last allele should not be followed by a separator
+                                if allele_counter < len(list_element[1]):
+                                    plas_str = plas_str + " + "
+                            if rs_counter < len(plas_dict[plas_pos]):
+                                plas_str = plas_str + "; "
+
+                        print_dict[plas_pos].append(plas_str+"\t")
+                        suc += 1
+                    else:  # Translation of dbSNP rs-ID to base position not successful = request artifact
+                        fail += 1
+                print file_name + ": PlasmoDB local: %s match(es); %s artifact(s)." % (str(suc), str(fail))
+            else:
+                print file_name + "PlasmoDB local: 0 matches."
+
+        else:
+            print file_name + ": %s, %s not in local PlasmoDB." % (organism, chr_numb)
+            for pos in print_dict:
+                print_dict[pos].pop(-1)
+                print_dict[pos].append("N/A\t")
+
+    # Write raw coverage to output
+    for pos in print_dict:
+        if print_dict[pos][-1] == "\n":
+            print_dict[pos].pop(-1)
+
+        for nuc in ["a", "c", "g", "t"]:
+            if raw_cov_dict[pos][nuc] >= rawCovThresh:
+                if nuc == "t":
+                    print_dict[pos].append(str(raw_cov_dict[pos][nuc])+"\n")
+                else:
+                    print_dict[pos].append(str(raw_cov_dict[pos][nuc])+"\t")
+            else:
+                if nuc == "t":
+                    print_dict[pos].append("-\n")
+                else:
+                    print_dict[pos].append("-\t")
+
+    return chr_numb
+
+
+def annotateDBSNP(res_dict):
+
+    """Looks up the SNPs of res_dict (human data) in dbSNP and sets the matches (rs-IDs and alleles) as database
+    column."""
+
+    global dbsnp_cache
+    isDBerror = False
+    db_dict = {}
+    res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\tMatches in dbSNP\traw A\traw C\traw G\traw T\n"
+
+    suc = 0
+    fail = 0
+    queries=[]
+
+    for chr in res_dict.keys():
+
+        # Variable header for outfiles dependent on database used for SNP lookup
+        if chr == "**header**":
+            pass
+        else:
+            if re.search(r"^\d{1,2}$", chr) or re.search(r"^[X,Y]$", chr) or re.match(r"^[A,N,X][C,G,T,W,Z,M,R][_]", chr):
+
+                # Create search string for dbSNP. For each chr and pos, the target allele and possible mutations have to be queried
+                for pos in res_dict[chr].keys():
+                    target = res_dict[chr][pos][4]
+                    target = target.strip("\t").upper()
+
+                    for mut in ["A", "C", "G", "T"]: 
+                        if mut != target:
+                            queries.append(chr + " " + pos + " "  + "iD" + " " + target + " " + mut + "\n")
+
+            else:
+                processed_f = "calc.nuccounts." + chr_to_enc_dict[chr]
+                print processed_f + ": %s, %s not in dbSNP." %(organism, chr)
+                for pos in res_dict[chr]:
+                    res_dict[chr][pos][-5] = "N/A\t"
+
+    if queries:                
+        metrics.start("dbsnp")
+        if dbsnp_cache_file:
+            dbsnp_cache = nanopipe_dbsnp.AnnotationCache(dbsnp_cache_file, dbsnp_cache_size)
+        db_dict, isDBerror = getSNPwww(queries)
+        metrics.stop("dbsnp", queries=len(queries), positions=sum([len(db_dict[chr]) for chr in db_dict]))
+
+        # Network round trips and cache hits
+        metrics.set("dbsnp_requests", dbsnp_client.requests)
+        metrics.set("dbsnp_failed_requests", dbsnp_client.failures)
+        if dbsnp_cache:
+            metrics.set("dbsnp_cache_hits", dbsnp_cache.hits)
+            metrics.set("dbsnp_cache_misses", dbsnp_cache.misses)
+            if dbsnp_cache.hits + dbsnp_cache.misses:
+                metrics.set("dbsnp_cache_hit_rate",
+                            dbsnp_cache.hits / (dbsnp_cache.hits + dbsnp_cache.misses))
+
+    # The query did not reach the db, even after the retries of the client
+    if isDBerror == True:
+        for chr_ in res_dict:
+            if chr_ != "**header**":
+                for pos in res_dict[chr_]:
+                    res_dict[chr_][pos][-5] ="db:error\t"
+
+    # No database error
+    if isDBerror == False: 
+
+        if db_dict:
 
+            for chr in db_dict:
+                fail = 0
+                suc = 0
+
+                for db_pos in db_dict[chr]:
+                    db_pos = str(db_pos)
+
+                    if chr in res_dict:
+
+                        # Should be the case, because I queried pos from res_dict
+                        if db_pos in res_dict[chr]:
+                            rs_counter = 0
+                            # List_element is a tupel: (db_rs, db_nuc)
+                            db_str = ""
+
+                            for list_element in db_dict[chr][db_pos]:
+                                rs_counter += 1
+                                db_rs = list_element[0]
+                                db_str = db_str + db_rs + ": "
+                                nuc_counter = 0
+
+                                for db_nuc in list_element[1]:
+                                    nuc_counter += 1
+                                    db_str = db_str + db_nuc
+
+                                    # The last allele should not be followed by a separator
+                                    if nuc_counter < len(list_element[1]):
+                                        db_str = db_str + "+"
+
+                                if rs_counter < len(db_dict[chr][db_pos]):
+                                    db_str = db_str + ";"
+
+                            res_dict[chr][db_pos][-5]= db_str+"\t" #res_dict[chr][db_pos][-10]= db_str+"\t"
+                            suc += 1
+
+                        # Request artifact
+                        else:  
+                            fail += 1
+
+                    # Request artifact
+                    else:
+                        fail += 1
+
+                processed_f = "calc.nuccounts." + chr_to_enc_dict[chr]
+                print processed_f + ": dbSNP: %s match(es); %s artifact(s)." % (str(suc), str(fail))
+
+        else:
+            sys.stdout.write("dbSNP: 0 matches.\n")
+
+    if dbsnp_cache:
+        dbsnp_cache.close()
+
+
+def addQualityHeader(res_dict):
+    """Adds the p-error column (in front of the raw counts) to the header of res_dict."""
+    header_list = res_dict["**header**"].split("\t")
+    header_list.insert(-4, "P-error (local alignment quality)")
+    res_dict["**header**"] = "\t".join(header_list)
+
+
+class PolyWriter(object):
+
+    """Writes the SNPs of one target to a .poly file: the header and the lines sorted by position. The SNPs can be
+    written in several parts with ascending positions. The file is opened with the first SNPs; the final line break
+    is kept back and only written for the output of the quality analysis."""
+
+    def __init__(self, file_name, keep_break):
+        self.file_name = file_name
+        self.keep_break = keep_break
+        self.output_file = None
+        self.last_line = ""
+
+    def write(self, header, print_dict):
+        """Writes the SNPs of print_dict (position -> output columns)."""
+
+        if not print_dict:
+            return
+        if self.output_file is None:
+            self.output_file = open(self.file_name, "w")
+            self.output_file.write(header)
+
+        lines = [self.last_line]
+        for pos in sorted([int(pos) for pos in print_dict]):
+            lines.append(str(pos) + "\t" + "".join(print_dict[str(pos)]))
+        self.last_line = lines.pop()
+        self.output_file.write("".join(lines))
+
+    def close(self):
+        """Writes the last line and closes the file. Returns True, if the file was written."""
+
+        if self.output_file is None:
+            return False
+        if not self.keep_break:
+            self.last_line = self.last_line.rstrip("\n")
+        self.output_file.write(self.last_line)
+        self.output_file.close()
+        self.output_file = None
+        return True
 
 
 res_dict={}
@@ -179,8 +755,15 @@ res_dict={}
 
 # Variables
 isQualityAnaly = False
-isRep = False
-isDBerror = False
+engine = "python"
+# Directory of the local PlasmoDB database (SNPdbPlasf)
+plas_dir = "/bioinf/projects/SNPdbPlasf"
+# Number of worker processes for the SNP calling
+workers = 1
+# Local cache for dbSNP results (file and maximum number of entries)
+dbsnp_cache = None
+dbsnp_cache_file = None
+dbsnp_cache_size = nanopipe_dbsnp.CACHE_SIZE
 target_threshold = 0.8
 poly_threshold = 0.2
 # Transitions are twice as likely as transversions
@@ -188,6 +771,33 @@ tt_ratio = 2
 cover_threshold = 0.3
 # Threshold for printing raw coverage
 rawCovThresh = 1 
+# Call sets computed elsewhere (nanopipe_live.py) and their p-errors
+calls_file = None
+precomputed_calls = {}
+precomputed_qualities = None
+# Run cache for the call sets and annotations of unchanged files (SQLite)
+run_cache = None
+run_cache_file = None
+# Sweep over a grid of the calling parameters: summary table and the parameter sets with .poly files
+sweep_file = None
+sweep_sets = []
+# Directory of the .poly files
+out_dir = None
+# Local VCF database, replaces dbSNP and PlasmoDB
+vcf_dir = None
+# Streaming mode: directory of the spill files and SNPs per chunk of the annotation
+stream_dir = None
+stream_chunk = 50000
+# Panel (BED file), only the positions in the panel are called
+panel = None
+panel_file = None
+panel_hash = None
+# Follow mode: manifest of analyze.pm and seconds between reading it
+follow_file = None
+follow_poll = 1.0
+# Metrics of the phases (JSON) and optional profile (pstats)
+metrics_file = "calc.polymorphism.metrics"
+profile_file = None
 
 #Get species argument from command line for dbSNP check
 ## script.py -s human ...
@@ -217,390 +827,404 @@ else:
 if "-q" in arg_list:
     isQualityAnaly = True
 
+# Engine for SNP calling: "python" (line by line) or "numpy" (arrays)
+## script.py -e numpy ...
+engine = getOption(arg_list, "-e", engine)
+
+# Directory of the local PlasmoDB database
+## script.py -d /path/to/SNPdbPlasf ...
+plas_dir = getOption(arg_list, "-d", plas_dir)
+
+# Number of worker processes
+## script.py -w 8 ...
+workers = getOption(arg_list, "-w", workers, int)
+
+# Cache for dbSNP results
+## script.py -c /path/to/dbsnp.cache -cs 1000000 ...
+dbsnp_cache_file = getOption(arg_list, "-c", dbsnp_cache_file)
+dbsnp_cache_size = getOption(arg_list, "-cs", dbsnp_cache_size, int)
+
+# Client for the dbSNP API: address (e.g. a local mirror), positions per request, parallel requests, requests per
+# second, timeout and retries of a request, one query line per position instead of per allele (-dbcollapse)
+## script.py -a http://localhost:8080/set_rsids -dbchunk 40000 -dbthreads 2 -dbrate 2 -dbtimeout 300 -dbretries 4 ...
+dbsnp_client = nanopipe_dbsnp.DBSNPClient(
+    api_link=getOption(arg_list, "-a", nanopipe_dbsnp.API_LINK),
+    chunk_size=getOption(arg_list, "-dbchunk", nanopipe_dbsnp.CHUNK_SIZE, int),
+    threads=getOption(arg_list, "-dbthreads", nanopipe_dbsnp.THREADS, int),
+    rate=getOption(arg_list, "-dbrate", nanopipe_dbsnp.RATE, float),
+    timeout=getOption(arg_list, "-dbtimeout", nanopipe_dbsnp.TIMEOUT, float),
+    retries=getOption(arg_list, "-dbretries", nanopipe_dbsnp.RETRIES, int),
+    collapse="-dbcollapse" in arg_list)
+
+# Calling parameters, a comma separated list of values for the sweep
+## script.py -tt 0.8 -pt 0.2 -ct 0.3 -ratio 2 ...
+target_threshold = getOption(arg_list, "-tt", target_threshold, toNumber)
+poly_threshold = getOption(arg_list, "-pt", poly_threshold, toNumber)
+cover_threshold = getOption(arg_list, "-ct", cover_threshold, toNumber)
+tt_ratio = getOption(arg_list, "-ratio", tt_ratio, toNumber)
+
+# Sweep mode: the SNP counts of all combinations of the parameter values are written to the sweep table, the .poly
+# files of the selected parameter sets (numbers in the table) to the directories calc.sweep.<set>
+## script.py -sweep calc.polymorphism.sweep -tt 0.7,0.8 -pt 0.1,0.2 -ct 0.2,0.3 -ratio 1,2 -sweeppoly 1,4 ...
+sweep_file = getOption(arg_list, "-sweep", sweep_file)
+sweep_sets = [int(value) for value in getOption(arg_list, "-sweeppoly", "").split(",") if value.isdigit()]
+
+# Directory of the .poly files (default: the current directory)
+## script.py -o calc.sweep.1 ...
+out_dir = getOption(arg_list, "-o", out_dir)
+
+# Panel definition, the positions outside the intervals of the BED file are skipped
+## script.py -bed panel.bed ...
+panel_file = getOption(arg_list, "-bed", panel_file)
+if panel_file:
+    panel = nanopipe_bed.loadBED(panel_file)
+    panel_hash = nanopipe_runcache.hashFile(panel_file)
+
+# Run cache, re-runs call only the changed nuccounts files
+## script.py -runcache calc.polymorphism.cache ...
+run_cache_file = getOption(arg_list, "-runcache", run_cache_file)
+
+# Local VCF database (built by nanopipe_vcfdb.py), the SNPs of all targets are looked up there without network access
+## script.py -vcf /path/to/vcfdb ...
+vcf_dir = getOption(arg_list, "-vcf", vcf_dir)
+
+# Streaming mode for big genomes: the candidates of a file are spilled to the directory and annotated and written
+# in chunks of SNPs, so the memory does not grow with the size of the contigs. The run cache is not used.
+## script.py -stream calc.polymorphism.stream -streamchunk 50000 ...
+stream_dir = getOption(arg_list, "-stream", stream_dir)
+stream_chunk = getOption(arg_list, "-streamchunk", stream_chunk, int)
+if stream_dir:
+    run_cache_file = None
+
+# Follow mode for the overlapped pipeline: the targets are taken from the manifest of analyze.pm and every nuccounts
+# file is called as soon as its target is published, while analyze.pm and the bam generation are still running. The
+# run cache is not used.
+## script.py -follow calc.nuccounts.manifest ...
+follow_file = getOption(arg_list, "-follow", follow_file)
+if follow_file:
+    run_cache_file = None
+
+# Call sets of the live calling: the nuccounts files are not read, the file holds the uncut call sets
+# "calls": {file_name: (print_dict, cover_dict, raw_cov_dict)} and the p-errors "qualities": {chr_enc: {pos: p_error}}
+## script.py -calls calc.live/calls.pickle ...
+calls_file = getOption(arg_list, "-calls", calls_file)
+if calls_file:
+    with open(calls_file, "rb") as f:
+        precomputed = pickle.load(f)
+    precomputed_calls = precomputed["calls"]
+    precomputed_qualities = precomputed.get("qualities")
+    run_cache_file = None
+    stream_dir = None
+    follow_file = None
+
+# Files for the metrics and the profile of the run (cProfile, only the main process)
+## script.py -m calc.polymorphism.metrics -profile calc.polymorphism.prof ...
+metrics_file = getOption(arg_list, "-m", metrics_file)
+profile_file = getOption(arg_list, "-profile", profile_file)
+
+metrics = nanopipe_metrics.Metrics()
+metrics.set("engine", engine)
+metrics.set("workers", workers)
+if panel:
+    metrics.set("panel_bases", panel.size())
+profiler = None
+if profile_file:
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+if engine == "numpy" and not nanopipe_snpcall.isAvailable():
+    print "NumPy is not available, using the python engine."
+    engine = "python"
+
     
-# Get encodings for chromosomes and scaffolds
+# Get encodings for chromosomes and scaffolds, in the follow mode they are added with the targets of the manifest
+metrics.start("tidmap")
 chr_enc_dict = {}
 chr_to_enc_dict = {}
-with open("calc.tidmap", "r") as chr_file:
-    for line in chr_file:
-        line = line.strip("\n")
-        line_list = line.split("\t")
-        chr_ = line_list[0]
-        chr_ = chr_.replace("chr", "")
-        chr_enc = line_list[1]
-        chr_enc_dict[chr_enc] = chr_
-        chr_to_enc_dict[chr_] = chr_enc
+if not follow_file:
+    readTargets("calc.tidmap")
+metrics.stop("tidmap", targets=len(chr_enc_dict))
 
 # The tidmap file was empty, because the data was insufficient. Exit without raising error.
-if not chr_enc_dict:
+if not chr_enc_dict and not follow_file:
     sys.exit(0)        
 
 # Get nuccount files from current directory, ignore ".help" files
 curr_dir = os.getcwd()
-for root, dirs, files in os.walk(curr_dir, topdown = True):
-    file_list = files
-    break
+file_list = [file_name for file_name in os.listdir(curr_dir) if os.path.isfile(os.path.join(curr_dir, file_name))]
 
-last_file = file_list[-1]
+# Call the nuccount files, in parallel by a process pool. The results are merged in the order of file_list.
+# Binary files (calc.nuccounts.chr_enc.bin) are preferred to the text files of the same chr_enc, block-compressed
+# text files (calc.nuccounts.chr_enc.gz) are only taken without any other file of the chr_enc.
+nuccounts_list = [file_name for file_name in file_list if re.search(r"^calc.nuccounts.\d+(\.bin|\.gz)?$", file_name)
+                  and not file_name + nanopipe_nuccounts.BINARY_EXT in file_list
+                  and not (file_name.endswith(nanopipe_bgzf.GZ_EXT) and
+                           set([file_name[:-3], file_name[:-3] + nanopipe_nuccounts.BINARY_EXT]) & set(file_list))]
+if calls_file:
+    nuccounts_list = sorted(precomputed_calls, key=lambda file_name: int(file_name.split(".")[2]))
+if follow_file:
+    nuccounts_list = followManifest(follow_file)
 
-for file_name in file_list:
-    
-    # Repetitions of erroneous queries after last element from first file_list was processed
-    if file_name == last_file:
-        isRep = True
-    match = re.search(r"^calc.nuccounts.\d+$", file_name)
-    if match:
-        print_dict = {}
-        cover_dict = {} # for discarding low coverage data
-        raw_cov_dict = {} #for printing raw coverage
-        
-        #sys.stdout.write("Processing: %s: " % file_name)
-        
-        # Read file....
-        with open(file_name, "r") as alignment_file:
-            for line in alignment_file.readlines():
-                print_list = []
-                nuc_dict = {}
-                isPoly = False
-                isSPECIALchar = False
-                poly_dict = {}
-                weight_dict = {}
-                result_list = []
-                line = line.replace("\n", "")
-                line_data = line.split("\t")
-                
-                # .... and extract data
-                if ">" in line_data[0]:
-                    chr_numb = line_data[0][-1]
-                    continue
-                pos_start = line_data[0]
-                nuc_dict["a"] = int(line_data[1])
-                nuc_dict["c"] = int(line_data[2])
-                nuc_dict["g"] = int(line_data[3])
-                nuc_dict["t"] = int(line_data[4])
-                consensus = line_data[5].lower()
-                target = line_data[6].lower()
-                
-                # Total amount of nucleotides per position
-                total_nuc = 0
-                for nuc_count in nuc_dict.values():
-                    total_nuc = total_nuc + nuc_count
-                    
-                # Save coverage for all positions
-                if total_nuc in cover_dict:
-                    cover_dict[total_nuc].append(pos_start)
-                else:
-                    cover_dict[total_nuc] = [pos_start]
-                
-                if consensus not in ["-", "n"]:
-        
-                    # SNP is accepted if: (1) target nuc < 0.8 [isPoly = True]; (2) one other nuc > 0.2 [poly_threshold]
-                    ## Special consensus symbols according to IUPAC and "X" pass (1) automatically, (2) also fulfilled
-                    if consensus in ["m", "r", "w", "s", "y", "k", "v", "h", "d", "b", "x"]:
-                        isPoly = True
-                    else:
-                        if target in ["a", "c", "g", "t"]:
-                            if nuc_dict[target] / total_nuc <= target_threshold:
-                                isPoly = True
-                        else:
-                            isPoly = False
-        
-                    ## Check for condition (2)       
-                    if isPoly == True:
-                        for nuc in nuc_dict:   
-                            rel_nuc = nuc_dict[nuc] / total_nuc
-                            rel_nuc = round(rel_nuc, 3)
-                            if rel_nuc >= poly_threshold:
-                                poly_dict[nuc] = [rel_nuc, calculateBchange(nuc, target, tt_ratio)]  # obtain score for transitions vs transversions
-        
-                    # Give weight to the relative occurence of a nuc
-                    if poly_dict:
-                        
-                        for nuc in poly_dict:
-                            poly_dict[nuc] = poly_dict[nuc][0] * poly_dict[nuc][1]
-        
-                        # Rescale weighted rel. occurences to 1
-                        weight_factor = sum(poly_dict.values()) / 1
-                        if weight_factor == 0:
-                            continue
-                        for nuc in ["a", "c", "g", "t"]:
-                            if nuc in poly_dict:
-                                resc_prob = round(poly_dict[nuc] / weight_factor, 3)
-                                if resc_prob > 0:
-                                    print_list.append(str(resc_prob)+"\t")
-                                else:
-                                    print_list.append("-\t") 
-                            else:
-                                print_list.append("-\t")
-                        print_list.append(target+"\t")
-                        print_list.append("\n")
-                        print_dict[pos_start] = print_list
-                        raw_cov_dict[pos_start] = nuc_dict
-                
-                else:
-                    continue
-               
-        # Following calculations only for polymorphic nuccount files
-        if cover_dict and print_dict: 
-            
-            # Get the highest coverage of an SNP within a file, calculate a minimum coverage for every SNP
-            cover_list = cover_dict.keys()
-            cover_list.sort()
-            highest_cover = cover_list[-1]
-            min_cover = highest_cover * cover_threshold
-            
-            for coverage in cover_dict:
-                if coverage < min_cover:
-                    for position in cover_dict[coverage]:
-                        if position in print_dict:
-                            del print_dict[position]
-                            
-            if print_dict:  
-                     
-                # Get reference data for suspect SNPs from dbSNP
-                chr_enc = str(file_name.split(".")[-1])  # file name: calc.nuccounts.chr_enc
-                chr_numb = chr_enc_dict[chr_enc] #1
-                
-                
-                
-                if organism != "Plasmodium falciparum" and organism != "Homo sapiens":
-                        print file_name + ": %s, %s not in SNP databases." % (organism, chr_numb)
-                        res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\traw A\traw C\traw G\traw T\n"
-               
-                else:
-                     for pos in print_dict:
-                            print_dict[pos].pop(-1)
-                            print_dict[pos].append("\t")
-                            
-                #Plasmodium falciparum            
-                if organism == "Plasmodium falciparum":
-                    res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\tMatches in PlasmoDB\traw A\traw C\traw G\traw T\n"
-                    try:
-                        chr_numb = chr_numb.split(":")[0]
-                    except:
-                        pass
-                    
-                    # Local database features Plasmodium falciparum v3
-                    if re.search(r"^Pf3D7_\d\d_v3", chr_numb):
-                        plas_dict = getSNPplas(chr_numb, print_dict)
-                    
-                        if plas_dict:
-                            suc = 0
-                            fail = 0
-                            for plas_pos in plas_dict:
-                                plas_pos = str(plas_pos)
-                                if plas_pos in print_dict:
-                                    print_dict[plas_pos].pop(-1)
-                                    rs_counter = 0
-                                    
-                                    # List_element is a tupel: (plasID, [dbMaj: dbMajF, dbMin: dbMinF])
-                                    plas_str = ""
-                                    for list_element in plas_dict[plas_pos]:
-                                        rs_counter += 1
-                                        plas_ID = list_element[0]
-                                        plas_str = plas_str + plas_ID + ": "
-                                        allele_counter = 0
-                                        for plas_allele in list_element[1]:
-                                            allele_counter += 1
-                                            plas_str = plas_str + plas_allele                                            
-                                            # The last allele should not be followed by a separator
-                                            if allele_counter < len(list_element[1]):
-                                                plas_str = plas_str + " + "
-                                        if rs_counter < len(plas_dict[plas_pos]):
-                                            plas_str = plas_str + "; "
-                                            
-                                    print_dict[plas_pos].append(plas_str+"\t")
-                                    suc += 1
-                                else:  # Translation of dbSNP rs-ID to base position not successful = request artifact
-                                    fail += 1
-                            print file_name + ": PlasmoDB local: %s match(es); %s artifact(s)." % (str(suc), str(fail))
-                        else:
-                           print file_name + "PlasmoDB local: 0 matches."
-                           
-                    else:
-                        print file_name + ": %s, %s not in local PlasmoDB." % (organism, chr_numb)
-                        for pos in print_dict:
-                            print_dict[pos].pop(-1)
-                            print_dict[pos].append("N/A\t")
-                        
-                
-                    
-                        
-                # Write raw coverage to output
-                for pos in print_dict:
-                    if print_dict[pos][-1] == "\n":
-                            print_dict[pos].pop(-1)
-
-                    for nuc in ["a", "c", "g", "t"]:
-                        if raw_cov_dict[pos][nuc] >= rawCovThresh:
-                            if nuc == "t":
-                                print_dict[pos].append(str(raw_cov_dict[pos][nuc])+"\n")
-                            else:
-                                print_dict[pos].append(str(raw_cov_dict[pos][nuc])+"\t")
-                        else:
-                            if nuc == "t":
-                                print_dict[pos].append("-\n")
-                            else:
-                                print_dict[pos].append("-\t")
+# Sweep mode: every file is read once and called for all parameter sets. The call sets of the selected parameter
+# sets are stored in the run cache and the .poly files are written by a run per set, which takes them from there.
+if sweep_file:
+    if not nanopipe_snpcall.isAvailable():
+        print "The sweep mode needs NumPy."
+        sys.exit(1)
+    if follow_file:
+        nuccounts_list = list(nuccounts_list)
+    grid = list(itertools.product(getGridOption(arg_list, "-tt", target_threshold),
+                                  getGridOption(arg_list, "-pt", poly_threshold),
+                                  getGridOption(arg_list, "-ct", cover_threshold),
+                                  getGridOption(arg_list, "-ratio", tt_ratio)))
+    sweep_sets = [index for index in sweep_sets if index <= len(grid)]
+    print "Sweep: %d parameter set(s), %d file(s)" % (len(grid), len(nuccounts_list))
 
-                
-                # Save all files in dictionary
-                res_dict[chr_numb]=print_dict
+    metrics.start("sweep")
+    pool = None
+    if workers > 1 and len(nuccounts_list) > 1:
+        pool = multiprocessing.Pool(min(workers, len(nuccounts_list)))
+        results = pool.imap(sweepNuccounts, nuccounts_list)
+    else:
+        results = itertools.imap(sweepNuccounts, nuccounts_list)
 
-            else:
-                
-                print file_name + ": No polymorphisms for coverage cutoff."
-        else:
+    if sweep_sets:
+        if not run_cache_file:
+            run_cache_file = "calc.polymorphism.cache"
+        # The call sets of all selected sets and the one of a normal run are kept side by side
+        run_cache = nanopipe_runcache.RunCache(run_cache_file, max(nanopipe_runcache.KEYS, len(sweep_sets) + 1))
+
+    # The keys of the call sets are the keys of the runs with the parameters of the set and the numpy engine
+    param_names = ["target_threshold", "poly_threshold", "cover_threshold", "tt_ratio"]
+    contigs = []
+    counts = []
+    for file_name, file_counts, call_sets in results:
+        contigs.append(chr_enc_dict[file_name.split(".")[2]])
+        counts.append(file_counts)
+        if call_sets:
+            content_hash = nanopipe_runcache.hashFile(file_name)
+        for index in call_sets:
+            params = dict(zip(param_names, grid[index - 1]), engine="numpy", rawCovThresh=rawCovThresh,
+                          panel=panel_hash)
+            run_cache.put("calls", file_name, nanopipe_runcache.makeKey(content_hash, params), call_sets[index])
+    if pool:
+        pool.close()
+        pool.join()
+    metrics.stop("sweep", files=len(nuccounts_list), sets=len(grid))
+
+    # One line per parameter set: the counts of all files and the SNPs after the coverage cutoff per contig
+    with open(sweep_file, "w") as output_file:
+        output_file.write("\t".join(["Set"] + param_names + ["Candidates", "SNPs"] + contigs) + "\n")
+        for index, params in enumerate(grid):
+            output_file.write("\t".join([str(index + 1)] + [str(value) for value in params] +
+                                        [str(sum([file_counts[index][0] for file_counts in counts])),
+                                         str(sum([file_counts[index][1] for file_counts in counts]))] +
+                                        [str(file_counts[index][1]) for file_counts in counts]) + "\n")
+    print "Sweep table written: %s" % sweep_file
+
+    if run_cache:
+        run_cache.close()
+
+    # The .poly files of the selected parameter sets
+    args = removeOptions(arg_list, ["-sweep", "-sweeppoly", "-tt", "-pt", "-ct", "-ratio", "-e", "-runcache", "-o",
+                                    "-m", "-profile", "-stream", "-streamchunk", "-follow"])
+    for index in sweep_sets:
+        sweep_dir = "calc.sweep.%d" % index
+        if not os.path.isdir(sweep_dir):
+            os.mkdir(sweep_dir)
+        command = [sys.executable, os.path.abspath(__file__)] + args + ["-e", "numpy", "-runcache", run_cache_file,
+                                                                       "-o", sweep_dir, "-m", sweep_dir +
+                                                                       "/calc.polymorphism.metrics"]
+        for option, value in zip(["-tt", "-pt", "-ct", "-ratio"], grid[index - 1]):
+            command += [option, str(value)]
+        print "Sweep set %d: %s" % (index, sweep_dir)
+        subprocess.call(command)
+
+        # The run of the set takes every call set from the cache, nothing is called again
+        try:
+            with open(sweep_dir + "/calc.polymorphism.metrics", "r") as metrics_input:
+                values = json.load(metrics_input)["values"]
+        except (IOError, ValueError, KeyError):
+            values = {}
+        metrics.set("sweep_%d_run_cache_hits" % index, values.get("run_cache_hits", 0))
+        if values.get("run_cache_hits", 0) < len(nuccounts_list):
+            print "Sweep set %d: %d of %d call set(s) taken from the run cache." % \
+                (index, values.get("run_cache_hits", 0), len(nuccounts_list))
+
+    metrics.save(metrics_file)
+    sys.exit(0)
+
+# Streaming mode: the files are called into spill files, the SNPs above the coverage cutoff are read back in chunks,
+# which are annotated and appended to the .poly file of the target
+if stream_dir:
+    if not os.path.isdir(stream_dir):
+        os.makedirs(stream_dir)
+    pool = None
+    if workers > 1 and (follow_file or len(nuccounts_list) > 1):
+        pool = multiprocessing.Pool(workers if follow_file else min(workers, len(nuccounts_list)))
+        results = pool.imap(streamNuccounts, nuccounts_list)
+    else:
+        results = itertools.imap(streamNuccounts, nuccounts_list)
+
+    poly_files = 0
+    for file_name, spill_file, highest_cover, stats in results:
+        metrics.add("calling", stats["calling"][0], stats["calling"][1], files=1, candidates=stats["candidates"],
+                    cached=0)
+        if not stats["candidates"]:
             print file_name + ": No polymorphisms."
+            os.remove(spill_file)
+            continue
+
+        chr_enc = file_name.split(".")[2]
+        writer = PolyWriter((out_dir or curr_dir) + "/" + "calc.nuccounts." + chr_enc + ".poly", isQualityAnaly)
+        scanner = None
+        snps = 0
+        for print_dict, raw_cov_dict in readSpill(spill_file, highest_cover * cover_threshold, stream_chunk):
+            snps += len(print_dict)
+            chr_numb = annotateCalls(file_name, print_dict, raw_cov_dict)
+            chunk_dict = {"**header**": res_dict.get("**header**"), chr_numb: print_dict}
+
+            # Only human data in dbSNP, unless a local VCF database is used
+            if organism == "Homo sapiens" and not vcf_dir:
+                annotateDBSNP(chunk_dict)
+
+            # The alignments of the target are read along with the chunks
+            if isQualityAnaly == True:
+                addQualityHeader(chunk_dict)
+                metrics.start("quality")
+                if scanner is None:
+                    scanner = nanopipe_qualreg.QualityScanner(
+                        nanopipe_qualreg.iterAlignments(curr_dir + "/calc.lastalign.maf", chr_numb))
+                nanopipe_qualreg.insertQualities(chunk_dict, {
+                    chr_numb: scanner.getQualities([int(pos) for pos in print_dict])})
+                metrics.stop("quality", snps=len(print_dict))
+
+            metrics.start("output")
+            writer.write(chunk_dict["**header**"], print_dict)
+            metrics.stop("output")
+
+        metrics.add("coverage", snps=snps)
+        if writer.close():
+            poly_files += 1
+        else:
+            print file_name + ": No polymorphisms for coverage cutoff."
+        os.remove(spill_file)
+
+    if pool:
+        pool.close()
+        pool.join()
+    metrics.add("output", files=poly_files)
+    if not os.listdir(stream_dir):
+        os.rmdir(stream_dir)
+
+    if poly_files:
+        print "Analyzing alignment quality: %s" %str(isQualityAnaly)
+        if isQualityAnaly == True:
+            print "Quality analysis finished!"
+
+    metrics.save(metrics_file)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+    sys.exit(0)
+
+# The call sets of files with unchanged content and calling parameters are taken from the run cache
+call_keys = {}
+cached = {}
+if run_cache_file:
+    run_cache = nanopipe_runcache.RunCache(run_cache_file)
+    params = {"engine": engine, "target_threshold": target_threshold, "poly_threshold": poly_threshold,
+              "cover_threshold": cover_threshold, "tt_ratio": tt_ratio, "rawCovThresh": rawCovThresh,
+              "panel": panel_hash}
+    for file_name in nuccounts_list:
+        call_keys[file_name] = nanopipe_runcache.getCallKey(file_name, params)
+        call_set = run_cache.get("calls", file_name, call_keys[file_name])
+        if call_set is not None:
+            cached[file_name] = call_set
+calling_list = [file_name for file_name in nuccounts_list if file_name not in cached] if not follow_file else \
+    nuccounts_list
+
+pool = None
+if workers > 1 and (follow_file or len(calling_list) > 1):
+    pool = multiprocessing.Pool(workers if follow_file else min(workers, len(calling_list)))
+    chunk_size = 1 if follow_file else max(1, len(calling_list) // (workers * 4))
+    results = pool.imap(processNuccounts, calling_list, chunk_size)
+else:
+    results = itertools.imap(processNuccounts, calling_list)
+if not follow_file:
+    results = mergeResults(nuccounts_list, cached, results)
+
+for file_name, print_dict, raw_cov_dict, isPolyFile, stats in results:
+    metrics.add("calling", stats["calling"][0], stats["calling"][1], files=1, candidates=stats["candidates"],
+                cached=stats["cached"])
+    metrics.add("coverage", stats["coverage"][0], stats["coverage"][1], snps=len(print_dict))
+    if run_cache and not stats["cached"]:
+        run_cache.put("calls", file_name, call_keys[file_name],
+                      (print_dict, raw_cov_dict, isPolyFile, stats["candidates"]))
+
+    # Following calculations only for polymorphic nuccount files
+    if isPolyFile: 
+        if print_dict:  
+                 
+            chr_numb = annotateCalls(file_name, print_dict, raw_cov_dict, call_keys.get(file_name))
+
+            # Save all files in dictionary
+            res_dict[chr_numb]=print_dict
+
+        else:
             
-            
-# Use the dictionary over all files to query dbSNP            
-if res_dict:
-    
-    # Only human data in dbSNP, besides only chromosomes/transcriptome ids can be looked up
-    if organism == "Homo sapiens":
-        res_dict["**header**"] = "Position\tA\tC\tG\tT\tTarget\tMatches in dbSNP\traw A\traw C\traw G\traw T\n"
+            print file_name + ": No polymorphisms for coverage cutoff."
+    else:
+        print file_name + ": No polymorphisms."
         
-        suc = 0
-        fail = 0
-        queries=[]
         
-        for chr in res_dict.keys():
-            
-            # Variable header for outfiles dependent on database used for SNP lookup
-            if chr == "**header**":
-                pass
-            else:
-                if re.search(r"^\d{1,2}$", chr) or re.search(r"^[X,Y]$", chr) or re.match(r"^[A,N,X][C,G,T,W,Z,M,R][_]", chr):
-                    
-                    # Create search string for dbSNP. For each chr and pos, the target allele and possible mutations have to be queried
-                    for pos in res_dict[chr].keys():
-                        target = res_dict[chr][pos][4]
-                        target = target.strip("\t").upper()
-                        
-                        for mut in ["A", "C", "G", "T"]: 
-                            if mut != target:
-                                queries.append(chr + " " + pos + " "  + "iD" + " " + target + " " + mut + "\n")
-                                
-                else:
-                    processed_f = "calc.nuccounts." + chr_to_enc_dict[chr]
-                    print processed_f + ": %s, %s not in dbSNP." %(organism, chr)
-                    for pos in res_dict[chr]:
-                        res_dict[chr][pos][-5] = "N/A\t"
-                    
-        if queries:                
-            db_dict, isDBerror = getSNPwww(queries)
-        
-        # The query did not reach the db
-        if isDBerror == True:
-            
-            # If an error occurred, try a second time
-            print "Retrying..."
-            time.sleep(30)
-            db_dict, isDBerror = getSNPwww(queries)
-            
-            if isDBerror == True:
-                for chr_ in res_dict:
-                    if chr_ != "**header**":
-                        for pos in res_dict[chr_]:
-                            res_dict[chr_][pos][-5] ="db:error\t"
-                    
-        # No database error
-        if isDBerror == False: 
-                       
-            if db_dict:
-                
-                for chr in db_dict:
-                    fail = 0
-                    suc = 0
-                    
-                    for db_pos in db_dict[chr]:
-                        db_pos = str(db_pos)
-                        
-                        if chr in res_dict:
-                            
-                            # Should be the case, because I queried pos from res_dict
-                            if db_pos in res_dict[chr]:
-                                rs_counter = 0
-                                # List_element is a tupel: (db_rs, db_nuc)
-                                db_str = ""
-                                
-                                for list_element in db_dict[chr][db_pos]:
-                                    rs_counter += 1
-                                    db_rs = list_element[0]
-                                    db_str = db_str + db_rs + ": "
-                                    nuc_counter = 0
-                                    
-                                    for db_nuc in list_element[1]:
-                                        nuc_counter += 1
-                                        db_str = db_str + db_nuc
-                                        
-                                        # The last allele should not be followed by a separator
-                                        if nuc_counter < len(list_element[1]):
-                                            db_str = db_str + "+"
-                                            
-                                    if rs_counter < len(db_dict[chr][db_pos]):
-                                        db_str = db_str + ";"
-                                        
-                                res_dict[chr][db_pos][-5]= db_str+"\t" #res_dict[chr][db_pos][-10]= db_str+"\t"
-                                suc += 1
-                            
-                            # Request artifact
-                            else:  
-                                fail += 1
-                        
-                        # Request artifact
-                        else:
-                            fail += 1
-                            
-                    processed_f = "calc.nuccounts." + chr_to_enc_dict[chr]
-                    print processed_f + ": dbSNP: %s match(es); %s artifact(s)." % (str(suc), str(fail))
-                    
-            else:
-                sys.stdout.write("dbSNP: 0 matches.\n")
+if pool:
+    pool.close()
+    pool.join()
 
+# Use the dictionary over all files to query dbSNP            
+if res_dict:
+    
+    # Only human data in dbSNP, unless a local VCF database is used
+    if organism == "Homo sapiens" and not vcf_dir:
+        annotateDBSNP(res_dict)
 
 
-    # Launch subsequent Perl script to analyze the alignment quality 
+    # Analyze the alignment quality around the SNPs (see nanopipe_qualreg.py)
     print "Analyzing alignment quality: %s" %str(isQualityAnaly)  
     if isQualityAnaly == True:
         
         # Add p-value column to header
-        header = res_dict["**header**"]
-        header_list = header.split("\t")
-        header_list.insert(-4, "P-error (local alignment quality)")
-        header = "\t".join(header_list)
-        res_dict["**header**"] = header
+        addQualityHeader(res_dict)
         
-        # Send res_dict as json to perl script
-        json_res = json.dumps(res_dict)
+        metrics.start("quality")
+        if precomputed_qualities is not None:
+            nanopipe_qualreg.insertQualities(res_dict, dict([(chr, precomputed_qualities[chr_to_enc_dict[chr]])
+                                                             for chr in res_dict if chr != "**header**"]))
+        else:
+            nanopipe_qualreg.addQuality(res_dict, curr_dir + "/calc.lastalign.maf")
+        metrics.stop("quality", snps=sum([len(res_dict[chr]) for chr in res_dict if chr != "**header**"]))
 
-        p = Popen(["/bioinf/projects/nanopipe2/calculate/nanopipe_qualreg.pl"], stdout=PIPE, stdin=PIPE, stderr=PIPE)
-        result, error = p.communicate(input=json_res)
-        print result
-        
-        if error:
-            print "Error: " + error
-       
+    # Print Data to separate output files
+    # Positions are sorted
+    metrics.start("output")
+    for chr in res_dict.keys():
+        if chr != "**header**":
+            encode = chr_to_enc_dict[chr]
+            writer = PolyWriter((out_dir or curr_dir) + "/" + "calc.nuccounts." + encode + ".poly", isQualityAnaly)
+            writer.write(res_dict["**header**"], res_dict[chr])
+            writer.close()
+    metrics.stop("output", files=len(res_dict) - 1)
 
-    else:
-        # Print Data to separate output files
-        # Positions are sorted
-        for chr in res_dict.keys():
-            if chr != "**header**":
-                print_string = res_dict["**header**"]
-                sorted_key_list = []
-                
-                for pos in res_dict[chr].keys():
-                    sorted_key_list.append(int(pos))
-                sorted_key_list.sort()
-                
-                for pos in sorted_key_list:
-                    print_string = print_string +str(pos) + "\t" + "".join(res_dict[chr][str(pos)])
-                    
-                print_string = print_string.strip("\n")
-                encode = chr_to_enc_dict[chr]
-                outfile = curr_dir + "/" + "calc.nuccounts." + encode + ".poly"
-                 
-                with open(outfile, "w") as output_file:
-                    output_file.write(print_string)
\ No newline at end of file
+    if isQualityAnaly == True:
+        print "Quality analysis finished!"
+
+if run_cache:
+    metrics.set("run_cache_hits", run_cache.hits)
+    metrics.set("run_cache_misses", run_cache.misses)
+    run_cache.close()
+
+metrics.save(metrics_file)
+if profiler:
+    profiler.disable()
+    profiler.dump_stats(profile_file)
@@ -0,0 +1,310 @@
+"""Lookup of SNP positions in dbSNP by the NCBI variation API with a persistent local annotation cache.
+The queries are sent concurrently under a rate limit, optionally collapsed per position (see DBSNPClient).
+The cache is a SQLite database keyed by assembly, chromosome, position, reference and alternative allele. It
+stores the reported rs-IDs as well as confirmed misses (positions without rs-ID), so repeated runs on the same
+regions send only the uncached positions to the API. The least recently used entries are evicted, if the cache
+holds more than max_entries entries."""
+
+
+import re
+import sys
+import time
+import json
+import socket
+import sqlite3
+import httplib
+import urllib2
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+# The assembly and the API, the assembly is added as parameter
+ASSEMBLY = "GCF_000001405.38"
+API_LINK = "https://api.ncbi.nlm.nih.gov/variation/v0/vcf/file/set_rsids"
+
+# 50,000 positions can be queried at once. I use 40,000 for security.
+CHUNK_SIZE = 40000
+
+# Parallel requests, requests per second, timeout of a request (seconds), retries of a failed chunk and the
+# first waiting time before a retry (seconds, doubled for every further retry)
+THREADS = 2
+RATE = 2
+TIMEOUT = 300
+RETRIES = 4
+BACKOFF = 5
+
+# The maximum number of entries in the annotation cache
+CACHE_SIZE = 1000000
+
+
+class AnnotationCache(object):
+
+    """Persistent cache for dbSNP results: (assembly, chr, pos, ref, alt) -> [(rs_id, allele), ...]. An empty
+    list is a confirmed miss. Counts the hits and misses of the lookups."""
+
+    # Number of keys per SQL statement
+    BATCH = 500
+
+    def __init__(self, path, max_entries=CACHE_SIZE, assembly=ASSEMBLY):
+        self.path = path
+        self.max_entries = max_entries
+        self.assembly = assembly
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.text_factory = str
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS annotation "
+                                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, atime REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS annotation_atime ON annotation (atime)")
+
+    def makeKey(self, key):
+        return "\t".join((self.assembly,) + tuple(key))
+
+    def get(self, keys):
+        """Returns the cached results for keys (chr, pos, ref, alt) as dictionary. Uncached keys are missing."""
+
+        result = {}
+        keys = list(set(keys))
+        now = time.time()
+        with self.connection:
+            for i in range(0, len(keys), self.BATCH):
+                db_keys = dict([(self.makeKey(key), key) for key in keys[i:i + self.BATCH]])
+                marks = ",".join(["?"] * len(db_keys))
+                rows = self.connection.execute("SELECT key, value FROM annotation WHERE key IN (%s)" % marks,
+                                               list(db_keys.keys())).fetchall()
+                for db_key, value in rows:
+                    result[db_keys[db_key]] = [tuple(entry) for entry in json.loads(value)]
+                self.connection.execute("UPDATE annotation SET atime = ? WHERE key IN (%s)" % marks,
+                                        [now] + list(db_keys.keys()))
+
+        self.hits += len(result)
+        self.misses += len(keys) - len(result)
+        return result
+
+    def put(self, results):
+        """Stores results: (chr, pos, ref, alt) -> [(rs_id, allele), ...] and evicts the oldest entries."""
+
+        if not results:
+            return
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO annotation (key, value, atime) VALUES (?, ?, ?)",
+                                        [(self.makeKey(key), json.dumps(value), now)
+                                         for key, value in results.items()])
+            count = self.connection.execute("SELECT COUNT(*) FROM annotation").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM annotation WHERE key IN "
+                                        "(SELECT key FROM annotation ORDER BY atime LIMIT ?)",
+                                        (count - self.max_entries,))
+
+    def close(self):
+        self.connection.close()
+
+
+def parseQuery(query):
+    """Returns the key (chr, pos, ref, alt) of a query line "chr pos iD ref alt"."""
+    query_data = query.split()
+    return query_data[0], query_data[1], query_data[3], query_data[4]
+
+
+class TokenBucket(object):
+
+    """Token bucket for the rate limit: on average at most rate requests per second, bursts up to capacity requests.
+    Thread safe."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DBSNPClient(object):
+
+    """Client for the API. The queries are sent in chunks by several threads under a token bucket rate limit.
+    Failed chunks are retried with exponential backoff, without sending the successful chunks again. By default
+    every alternative allele is a query line of its own, so an rs-ID is only credited to the allele it was found
+    for. With collapse, the queries are collapsed to one line per position (all alternative alleles comma
+    separated); only use it with an API answering every allele separately, an rs-ID of a collapsed answer is
+    credited to all alleles of the answer line."""
+
+    def __init__(self, api_link=API_LINK, assembly=ASSEMBLY, chunk_size=CHUNK_SIZE, threads=THREADS, rate=RATE,
+                 timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF, collapse=False):
+        self.url = api_link + "?assembly=" + assembly
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.collapse = collapse
+        self.bucket = TokenBucket(rate)
+
+        # Statistics: number of requests and failed requests
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def makeLines(self, keys):
+        """Returns the query lines for the keys (chr, pos, ref, alt), without duplicates."""
+
+        lines = []
+        alt_dict = {}
+        for chr, pos, ref, alt in keys:
+            position = (chr, pos, ref) if self.collapse else (chr, pos, ref, alt)
+            if position not in alt_dict:
+                alt_dict[position] = []
+                lines.append(position)
+            if alt not in alt_dict[position]:
+                alt_dict[position].append(alt)
+
+        return ["%s %s iD %s %s\n" % (position[0], position[1], position[2], ",".join(alt_dict[position]))
+                for position in lines]
+
+    def post(self, chunk):
+        """Sends one chunk of query lines. Returns the answer lines or None, if all retries failed."""
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.bucket.acquire()
+            with self.lock:
+                self.requests += 1
+
+            # Try if server responds
+            try:
+                site = urllib2.Request(self.url, "".join(chunk))
+                resp = urllib2.urlopen(site, timeout=self.timeout).read().strip("\n")
+
+                # Each list entry is one position
+                return resp.split("\n")
+            except urllib2.HTTPError:
+                print "HTTPError on website  %s." % self.url
+            except urllib2.URLError:
+                print "URLError on website %s." % self.url
+            except (socket.error, httplib.HTTPException):
+                print "Connection error on website %s." % self.url
+            with self.lock:
+                self.failures += 1
+
+        return None
+
+    def fetch(self, keys):
+        """Sends the keys (chr, pos, ref, alt) to the API. Returns (results, isDBerror), where results maps the keys
+        of all answered queries to their rs-IDs and alleles. Keys answered without rs-ID (NORSID) are confirmed
+        misses and map to an empty list. isDBerror is True, if a chunk failed after all retries."""
+
+        results = {}
+        isDBerror = False
+
+        lines = self.makeLines(keys)
+        chunks = [lines[i:i + self.chunk_size] for i in range(0, len(lines), self.chunk_size)]
+        if not chunks:
+            return results, isDBerror
+
+        pool = ThreadPool(min(self.threads, len(chunks)))
+        try:
+            for chunk, out_list in zip(chunks, pool.imap(self.post, chunks)):
+                if out_list is None:
+                    isDBerror = True
+                    continue
+
+                answered = set()
+                for pos in out_list:
+                    pos_data = pos.split("\t")
+
+                    if len(pos_data) >= 5:
+                        rs_id = pos_data[2]
+                        answered.add((pos_data[0], pos_data[1], pos_data[3]))
+                        for alt in pos_data[4].split(","):
+                            key = (pos_data[0], pos_data[1], pos_data[3], alt)
+                            if key not in results:
+                                results[key] = []
+
+                            # Get rid of NORSID and second part of error message
+                            if re.match(r"rs", rs_id):
+                                results[key].append((rs_id, pos_data[3] + "/" + alt))
+
+                    # Write error message from API
+                    else:
+                        print "".join(pos)
+
+                # Alleles of answered positions without rs-ID are misses as well
+                for line in chunk:
+                    chr, pos, _, ref, alts = line.split()
+                    if (chr, pos, ref) in answered:
+                        for alt in alts.split(","):
+                            if (chr, pos, ref, alt) not in results:
+                                results[(chr, pos, ref, alt)] = []
+        finally:
+            pool.close()
+            pool.join()
+
+        return results, isDBerror
+
+
+def addResult(out_dict, chr, base_pos, rs_id, allele):
+    """Adds an rs-ID and its allele to out_dict[chr][base_pos]=[(rs_id, [alleles])]."""
+
+    if chr not in out_dict:
+        out_dict[chr] = {}
+    if base_pos not in out_dict[chr]:
+        out_dict[chr][base_pos] = []
+
+    for list_element in out_dict[chr][base_pos]:
+        if rs_id in list_element[0]:
+
+            # Avoid multiple entries of the same alleles for the same rs_ID
+            if allele not in list_element[1]:
+                list_element[1].append(allele)
+            return
+
+    out_dict[chr][base_pos].append((rs_id, [allele]))
+
+
+def getSNPwww(queries, cache=None, client=None):
+    """Looks up the queries ("chr pos iD ref alt\\n") in the cache and sends the rest to the API by client (default:
+    a DBSNPClient with the default settings). Returns (out_dict, isDBerror) with
+    out_dict[chr][base pos]=[(rs_id, [alleles])]. The results are merged in the order of the queries."""
+
+    keys = [parseQuery(query) for query in queries]
+
+    results = {}
+    if cache is not None:
+        results = cache.get(keys)
+
+    isDBerror = False
+    open_keys = [key for key in keys if key not in results]
+    if open_keys:
+        if client is None:
+            client = DBSNPClient()
+        fetched, isDBerror = client.fetch(open_keys)
+        if cache is not None:
+            cache.put(fetched)
+        results.update(fetched)
+    elif queries:
+        sys.stdout.write("dbSNP: all %d queries found in cache.\n" % len(queries))
+
+    # Answers for keys which were not queried (e.g. other alleles) follow at the end
+    key_set = set(keys)
+    out_dict = {}
+    for key in keys + [key for key in results if key not in key_set]:
+        for rs_id, allele in results.get(key, []):
+            addResult(out_dict, key[0], key[1], rs_id, allele)
+
+    return out_dict, isDBerror
@@ -0,0 +1,345 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+from __future__ import division
+"""Joint polymorphism matrix of several runs against the same target (e.g. isolates against the Plasmodium
+chromosomes). The targets of the runs are matched by the names in calc.tidmap (without "chr"). The nuccounts files
+of a target (binary, text or block-compressed, see nanopipe_calc_polymorphism.py) are read in lockstep by position,
+every chunk of positions is called for every sample with the array calling of nanopipe_snpcall.py and the coverage
+cutoff of each sample. A position is in the matrix, if it is a SNP in at least one sample; then the allele
+frequencies and raw counts of all samples are written. Every position is looked up once in the database (VCF
+database, PlasmoDB or dbSNP), not once per sample. Needs NumPy.
+
+    nanopipe_joint.py joint.tsv run_dir1 run_dir2 ... [-s plasf|human] [-d SNPdbPlasf] [-vcf vcfdb]
+                      [-tt 0.8] [-pt 0.2] [-ct 0.3] [-ratio 2] [-chunk 50000] [-c dbsnp.cache]
+                      [-a API] [-dbrate 2] ...
+
+The matrix has one line per position: target, position, target nucleotide, the database matches and the number
+of samples with a SNP, then per sample the SNP flag (Y/N), the frequencies of A, C, G, T and the raw counts of A,
+C, G, T ("-" for samples without coverage of the position)."""
+
+
+import sys
+import os
+import re
+import heapq
+import itertools
+
+import nanopipe_bgzf
+import nanopipe_dbsnp
+import nanopipe_nuccounts
+import nanopipe_plasmodb
+import nanopipe_snpcall
+import nanopipe_vcfdb
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+USAGE = """Usage: nanopipe_joint.py joint.tsv run_dir1 run_dir2 ... [-s plasf|human] [-d SNPdbPlasf] [-vcf vcfdb]
+                         [-tt 0.8] [-pt 0.2] [-ct 0.3] [-ratio 2] [-chunk 50000] [-c dbsnp.cache] [-a API] ...
+"""
+
+TIDMAP_FILE = "calc.tidmap"
+
+# Calling parameters (defaults of nanopipe_calc_polymorphism.py)
+TARGET_THRESHOLD = 0.8
+POLY_THRESHOLD = 0.2
+COVER_THRESHOLD = 0.3
+TT_RATIO = 2
+
+# Default directory of the local PlasmoDB database (like nanopipe_calc_polymorphism.py)
+PLASMODB = "/bioinf/projects/SNPdbPlasf"
+
+# Positions called at once
+CHUNK_SIZE = 50000
+
+NUCS = nanopipe_snpcall.NUCS
+
+
+def readTidmap(run_dir):
+    """Returns the targets of a run as list of (name without "chr", chr_enc)."""
+
+    targets = []
+    with open(os.path.join(run_dir, TIDMAP_FILE), "r") as f:
+        for line in f:
+            line_data = line.strip("\n").split("\t")
+            if len(line_data) > 1:
+                targets.append((line_data[0].replace("chr", ""), line_data[1]))
+    return targets
+
+
+def getNuccountsFile(run_dir, chr_enc):
+    """Returns the nuccounts file of a target of a run: the binary file, else the text file, else the
+    block-compressed file. Returns None, if the run has no file of the target."""
+
+    file_name = os.path.join(run_dir, "calc.nuccounts." + chr_enc)
+    for path in [file_name + nanopipe_nuccounts.BINARY_EXT, file_name, file_name + nanopipe_bgzf.GZ_EXT]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def iterRows(file_name, sample):
+    """Yields the positions of a nuccounts file as (position, sample, counts of A, C, G, T, consensus, target)."""
+
+    with nanopipe_nuccounts.openNuccounts(file_name) as alignment_file:
+        for line in alignment_file:
+            if line[0] == ">":
+                continue
+            line_data = line.rstrip("\n").split("\t")
+            yield (int(line_data[0]), sample, [int(count) for count in line_data[1:5]], line_data[5].lower(),
+                   line_data[6].lower())
+
+
+def iterPositions(files):
+    """Reads the nuccounts files of the samples (None: no file) in lockstep. Yields (position, rows) with the rows
+    of the samples covering the position: sample -> (counts, consensus, target)."""
+
+    streams = [iterRows(file_name, sample) for sample, file_name in enumerate(files) if file_name]
+    for pos, rows in itertools.groupby(heapq.merge(*streams), lambda row: row[0]):
+        yield pos, dict([(row[1], row[2:]) for row in rows])
+
+
+def callChunk(chunk, sample_count, params):
+    """Calls the positions of a chunk of iterPositions() for every sample. Returns the sets of samples with a SNP
+    per position."""
+
+    positions = np.array([pos for pos, rows in chunk], dtype=np.int64)
+    index = dict([(str(pos), i) for i, (pos, rows) in enumerate(chunk)])
+    called = [set() for pos in chunk]
+    for sample in range(sample_count):
+        # Positions without coverage of the sample have no counts and no consensus
+        counts = np.array([rows[sample][0] if sample in rows else [0, 0, 0, 0] for pos, rows in chunk],
+                          dtype=np.int64)
+        consensus = np.array([rows[sample][1] if sample in rows else "-" for pos, rows in chunk])
+        target = np.array([rows[sample][2] if sample in rows else "n" for pos, rows in chunk])
+        print_dict = nanopipe_snpcall.callCounts((positions, counts, consensus, target), *params)[0]
+        for pos in print_dict:
+            called[index[pos]].add(sample)
+    return called
+
+
+def callTarget(files, params, chunk_size=CHUNK_SIZE):
+    """Calls the nuccounts files of a target (one per sample, None: no file). Returns the candidates as list of
+    (position, target nucleotide, counts per sample or None, samples with a SNP) and the highest coverage of every
+    sample."""
+
+    candidates = []
+    highest_cover = [0] * len(files)
+    positions = iterPositions(files)
+    while True:
+        chunk = list(itertools.islice(positions, chunk_size))
+        if not chunk:
+            break
+        for pos, rows in chunk:
+            for sample in rows:
+                highest_cover[sample] = max(highest_cover[sample], sum(rows[sample][0]))
+        for (pos, rows), called in zip(chunk, callChunk(chunk, len(files), params)):
+            if called:
+                candidates.append((pos, rows.values()[0][2],
+                                   [rows[sample][0] if sample in rows else None for sample in range(len(files))],
+                                   called))
+    return candidates, highest_cover
+
+
+def applyCoverage(candidates, highest_cover, cover_threshold):
+    """Discards the SNPs of every sample with a coverage below cover_threshold times the highest coverage of the
+    sample (like the coverage cutoff of a nuccounts file), positions without SNP are dropped."""
+
+    result = []
+    for pos, target, counts, called in candidates:
+        called = set([sample for sample in called if sum(counts[sample]) >= highest_cover[sample] * cover_threshold])
+        if called:
+            result.append((pos, target, counts, called))
+    return result
+
+
+def formatMatches(matches, separator, allele_separator):
+    """Returns the matches of a position [(ID, [allele, ...]), ...] as database column."""
+    return separator.join([db_ID + ": " + allele_separator.join(alleles) for db_ID, alleles in matches])
+
+
+def annotateTarget(name, positions, options):
+    """Looks up the positions (strings) of a target once in the database of the organism. Returns the header of the
+    database column (None without database) and the matches: position -> column value."""
+
+    if options["vcf_dir"]:
+        if not nanopipe_vcfdb.hasTarget(options["vcf_dir"], name):
+            print "%s: not in local VCF database." % name
+            return "Matches in VCF", dict([(pos, "N/A") for pos in positions])
+        vcf_dict = nanopipe_vcfdb.lookup(options["vcf_dir"], name, positions)
+        print "%s: VCF local: %d match(es) for %d position(s)." % (name, len(vcf_dict), len(positions))
+        return "Matches in VCF", dict([(pos, formatMatches(vcf_dict[pos], "; ", " + ")) for pos in vcf_dict])
+
+    if options["organism"] == "plasf":
+        chr_numb = name.split(":")[0]
+        if not re.search(r"^Pf3D7_\d\d_v3", chr_numb):
+            print "%s: not in local PlasmoDB." % name
+            return "Matches in PlasmoDB", dict([(pos, "N/A") for pos in positions])
+        plas_dict = nanopipe_plasmodb.lookup(options["plas_dir"], chr_numb, positions)
+        print "%s: PlasmoDB local: %d match(es) for %d position(s)." % (name, len(plas_dict), len(positions))
+        return "Matches in PlasmoDB", dict([(pos, formatMatches(plas_dict[pos], "; ", " + ")) for pos in plas_dict])
+
+    if options["organism"] == "human":
+        if not (re.search(r"^\d{1,2}$", name) or re.search(r"^[X,Y]$", name) or
+                re.match(r"^[A,N,X][C,G,T,W,Z,M,R][_]", name)):
+            print "%s: not in dbSNP." % name
+            return "Matches in dbSNP", dict([(pos, "N/A") for pos in positions])
+        queries = []
+        for pos, target in positions.items():
+            for mut in ["A", "C", "G", "T"]:
+                if mut != target.upper():
+                    queries.append(name + " " + pos + " " + "iD" + " " + target.upper() + " " + mut + "\n")
+        db_dict, isDBerror = nanopipe_dbsnp.getSNPwww(queries, options["dbsnp_cache"], options["dbsnp_client"])
+        if isDBerror:
+            return "Matches in dbSNP", dict([(pos, "db:error") for pos in positions])
+        matches = db_dict.get(name, {})
+        print "%s: dbSNP: %d match(es) for %d position(s)." % (name, len(matches), len(positions))
+        return "Matches in dbSNP", dict([(str(pos), formatMatches(matches[pos], ";", "+")) for pos in matches])
+
+    return None, {}
+
+
+def formatSample(counts, isCalled):
+    """Returns the columns of one sample at a position: SNP flag, frequencies and raw counts of A, C, G, T."""
+
+    if counts is None:
+        return ["-"] * 9
+    total = sum(counts)
+    if not total:
+        return ["N"] + ["-"] * 4 + [str(count) for count in counts]
+    return (["Y" if isCalled else "N"] + [str(round(count / total, 3)) for count in counts] +
+            [str(count) for count in counts])
+
+
+def getHeader(samples, db_header):
+    """Returns the header line of the matrix."""
+
+    columns = ["Target", "Position", "Target nuc"] + ([db_header] if db_header else []) + ["Samples with SNP"]
+    for sample in samples:
+        columns += [sample + " SNP"] + [sample + " " + nuc.upper() for nuc in NUCS] + \
+                   [sample + " raw " + nuc.upper() for nuc in NUCS]
+    return "\t".join(columns) + "\n"
+
+
+def getTargets(run_dirs):
+    """Returns the targets of the runs in the order of their first appearance: [(name, [nuccounts file of every
+    run or None]), ...]."""
+
+    names = []
+    files = {}
+    for sample, run_dir in enumerate(run_dirs):
+        for name, chr_enc in readTidmap(run_dir):
+            if name not in files:
+                names.append(name)
+                files[name] = [None] * len(run_dirs)
+            files[name][sample] = getNuccountsFile(run_dir, chr_enc)
+    return [(name, files[name]) for name in names]
+
+
+def getSampleNames(run_dirs):
+    """Returns the names of the samples: the names of the run directories, numbered if they are not unique."""
+
+    names = [os.path.basename(os.path.normpath(run_dir)) for run_dir in run_dirs]
+    if len(set(names)) < len(names):
+        names = ["%d:%s" % (sample, name) for sample, name in enumerate(names, 1)]
+    return names
+
+
+def writeMatrix(out_file, run_dirs, options):
+    """Calls the runs jointly and writes the matrix. Returns the number of positions."""
+
+    params = (options["target_threshold"], options["poly_threshold"], options["tt_ratio"])
+    samples = getSampleNames(run_dirs)
+    total = 0
+    header = None
+    with open(out_file + ".tmp", "w") as out:
+        for name, files in getTargets(run_dirs):
+            candidates, highest_cover = callTarget(files, params, options["chunk_size"])
+            candidates = applyCoverage(candidates, highest_cover, options["cover_threshold"])
+            print "%s: %d position(s) with SNPs in %d sample(s)." % (name, len(candidates),
+                                                                    len([f for f in files if f]))
+            if not candidates:
+                continue
+
+            db_header, matches = annotateTarget(name, dict([(str(pos), target)
+                                                            for pos, target, counts, called in candidates]), options)
+            if header is None:
+                header = getHeader(samples, db_header)
+                out.write(header)
+
+            for pos, target, counts, called in candidates:
+                columns = [name, str(pos), target] + ([matches.get(str(pos), "")] if db_header else [])
+                columns.append(str(len(called)))
+                for sample in range(len(samples)):
+                    columns += formatSample(counts[sample], sample in called)
+                out.write("\t".join(columns) + "\n")
+            total += len(candidates)
+    os.rename(out_file + ".tmp", out_file)
+
+    return total
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+if __name__ == "__main__":
+    arg_list = sys.argv[1:]
+    run_dirs = []
+    for arg in arg_list[1:]:
+        if arg.startswith("-"):
+            break
+        run_dirs.append(arg)
+    if not arg_list or arg_list[0].startswith("-") or not run_dirs:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    if not nanopipe_snpcall.isAvailable():
+        print "The joint mode needs NumPy."
+        sys.exit(1)
+
+    for run_dir in run_dirs:
+        if not os.path.isfile(os.path.join(run_dir, TIDMAP_FILE)):
+            sys.stderr.write("%s: missing %s\n" % (run_dir, TIDMAP_FILE))
+            sys.exit(1)
+
+    options = {
+        "organism": getOption(arg_list, "-s", None),
+        "plas_dir": getOption(arg_list, "-d", PLASMODB),
+        "vcf_dir": getOption(arg_list, "-vcf", None),
+        "target_threshold": getOption(arg_list, "-tt", TARGET_THRESHOLD, float),
+        "poly_threshold": getOption(arg_list, "-pt", POLY_THRESHOLD, float),
+        "cover_threshold": getOption(arg_list, "-ct", COVER_THRESHOLD, float),
+        "tt_ratio": getOption(arg_list, "-ratio", TT_RATIO, float),
+        "chunk_size": getOption(arg_list, "-chunk", CHUNK_SIZE, int),
+        "dbsnp_cache": None,
+        "dbsnp_client": nanopipe_dbsnp.DBSNPClient(
+            api_link=getOption(arg_list, "-a", nanopipe_dbsnp.API_LINK),
+            chunk_size=getOption(arg_list, "-dbchunk", nanopipe_dbsnp.CHUNK_SIZE, int),
+            threads=getOption(arg_list, "-dbthreads", nanopipe_dbsnp.THREADS, int),
+            rate=getOption(arg_list, "-dbrate", nanopipe_dbsnp.RATE, float),
+            timeout=getOption(arg_list, "-dbtimeout", nanopipe_dbsnp.TIMEOUT, float),
+            retries=getOption(arg_list, "-dbretries", nanopipe_dbsnp.RETRIES, int),
+            collapse="-dbcollapse" in arg_list)}
+    if getOption(arg_list, "-c", None):
+        options["dbsnp_cache"] = nanopipe_dbsnp.AnnotationCache(getOption(arg_list, "-c", None),
+                                                                getOption(arg_list, "-cs", nanopipe_dbsnp.CACHE_SIZE,
+                                                                          int))
+
+    try:
+        count = writeMatrix(arg_list[0], run_dirs, options)
+    finally:
+        if options["dbsnp_cache"]:
+            options["dbsnp_cache"].close()
+    print "%d position(s) in %s." % (count, arg_list[0])
@@ -0,0 +1,502 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Live SNP calling while a run is still sequencing.
+Every batch of reads is aligned on its own (nanopipe_calc.pl -b) and the alignments of the batch (a maf file) are
+merged into persisted per-target arrays in calc.live: the counts of A, C, G, T and gaps, the target nucleotides,
+the nuccounts rows and the sums of the quality p-errors. The arrays are memory mapped and sparse on disk.
+
+Only the fragments (see analyze.pm: covered positions with at most maxgap uncovered positions between them) around
+the changed positions are evaluated again. They are bounded by more than maxgap uncovered positions in blocks
+without new counts, so the fragments beyond them are the same as before. The candidate SNPs of the evaluated
+positions are replaced, the highest coverage of a target is kept per block of 1000 positions. So the cost of a
+batch grows with its size and not with the data seen before.
+
+After every batch the call sets of the changed targets are passed to nanopipe_calc_polymorphism.py (-calls) for
+the coverage cutoff and the annotation, and the new .poly files replace the old ones by renaming. calc.tidmap
+holds all targets seen so far with stable numbers. Highest scores only (hscore) and panels are not supported.
+
+    nanopipe_live.py batch.maf [-state calc.live] [-mincount 10] [-minlen 40] [-maxgap 20] [-maxN 10]
+                     [-equal 0.8] [options of nanopipe_calc_polymorphism.py]"""
+
+import sys
+import os
+import json
+import subprocess
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+
+import nanopipe_qualreg
+import nanopipe_runcache
+import nanopipe_snpcall
+
+
+USAGE = """Usage: nanopipe_live.py batch.maf [-state calc.live] [-mincount 10] [-minlen 40] [-maxgap 20] [-maxN 10]
+                        [-equal 0.8] [options of nanopipe_calc_polymorphism.py]
+"""
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nanopipe_calc_polymorphism.py")
+
+# Files in the run directory and in the state directory
+STATE_DIR = "calc.live"
+STATE_FILE = "state.json"
+STAGE_DIR = "stage"
+TIDMAP_FILE = "calc.tidmap"
+
+# Parameters of the nuccounts files like analyze.pm
+PARAMS = {"mincount": 10, "minlen": 40, "maxgap": 20, "maxN": 10, "equal": 0.8}
+
+# Calling parameters (defaults of nanopipe_calc_polymorphism.py)
+TARGET_THRESHOLD = 0.8
+POLY_THRESHOLD = 0.2
+TT_RATIO = 2
+
+# Positions per block like analyze.pm: a block is defined, if one of its positions has a count
+BLOCKSIZE = 1000
+
+# Blocks of the first window, which is searched for the bounds of the changed fragments
+WINDOW = 4
+
+# Index of the query nucleotides ACGT- (upper and lower case), 255: not counted
+NUC_INDEX = np.full(256, 255, dtype=np.uint8)
+for index, nuc in enumerate("ACGT-"):
+    NUC_INDEX[ord(nuc)] = NUC_INDEX[ord(nuc.lower())] = index
+
+# Consensus symbol of the nucleotides with the highest counts (bits A=1, C=2, G=4, T=8), see analyze.pm
+CONSENSUS = np.array(["X", "A", "C", "M", "G", "R", "S", "V", "T", "W", "Y", "H", "K", "D", "B", "X"], dtype="S1")
+
+P_ERROR = np.array(nanopipe_qualreg.P_ERROR)
+
+
+def openArray(file_name, dtype, shape):
+    """Returns the memory mapped array of a file. A new file is created with zeros (sparse)."""
+
+    if not os.path.exists(file_name):
+        with open(file_name, "wb") as out:
+            out.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(file_name, dtype=dtype, mode="r+", shape=shape)
+
+
+def writeAtomic(file_name, data):
+    """Writes a file by renaming a temporary file."""
+
+    with open(file_name + ".tmp", "wb") as out:
+        out.write(data)
+    os.rename(file_name + ".tmp", file_name)
+
+
+class Target(object):
+
+    """The persisted data of one target: counts (A, C, G, T, gaps), target nucleotides, the nuccounts rows (1: the
+    position is in a saved fragment), the sums and counts of the p-errors (index: SNP position), the highest
+    coverage of the rows per block and the candidate SNPs: position -> (print_list, raw counts, coverage)."""
+
+    def __init__(self, state_dir, enc, length):
+        prefix = os.path.join(state_dir, str(enc))
+        self.length = length
+        self.counts = openArray(prefix + ".counts", np.uint32, (length, 5))
+        self.target = openArray(prefix + ".target", np.uint8, (length,))
+        self.rows = openArray(prefix + ".rows", np.uint8, (length,))
+        self.qsum = openArray(prefix + ".qsum", np.float64, (length + 1,))
+        self.qcount = openArray(prefix + ".qcount", np.uint32, (length + 1,))
+        self.blockmax = openArray(prefix + ".blockmax", np.uint32, ((length + BLOCKSIZE - 1) // BLOCKSIZE,))
+
+        self.calls_file = prefix + ".calls"
+        self.calls = {}
+        if os.path.exists(self.calls_file):
+            with open(self.calls_file, "rb") as f:
+                self.calls = pickle.load(f)
+
+    def save(self):
+        for array in (self.counts, self.target, self.rows, self.qsum, self.qcount, self.blockmax):
+            array.flush()
+        writeAtomic(self.calls_file, pickle.dumps(self.calls, pickle.HIGHEST_PROTOCOL))
+
+
+def readBatch(maf_file):
+    """Yields the alignments of a maf file: (target id, start, target size, target sequence, query sequence,
+    quality or None)."""
+
+    alignment = None
+    with open(maf_file, "r") as maf:
+        for line in maf:
+            if line.startswith("a"):
+                if alignment is not None and len(alignment) == 5:
+                    yield tuple(alignment) + (None,)
+                alignment = []
+            elif alignment is None:
+                continue
+            elif line.startswith("s"):
+                line_data = line.split()
+                if not alignment:
+                    alignment = [line_data[1], int(line_data[2]), int(line_data[5]), line_data[6]]
+                elif len(alignment) == 4:
+                    alignment.append(line_data[6])
+            elif line.startswith("p") and len(alignment) == 5:
+                yield tuple(alignment) + (line.split()[-1],)
+                alignment = None
+    if alignment is not None and len(alignment) == 5:
+        yield tuple(alignment) + (None,)
+
+
+def addAlignment(target, start, tseq, qseq):
+    """Adds the query nucleotides of an alignment to the counts like add() of analyze.pm. Returns the first and
+    last changed position (0-based) or None."""
+
+    tseq = np.frombuffer(tseq.encode("ascii"), dtype=np.uint8)
+    nucs = NUC_INDEX[np.frombuffer(qseq.encode("ascii"), dtype=np.uint8)]
+
+    # Target gaps are skipped, every other column is the next target position
+    isTarget = tseq != ord("-")
+    positions = start + np.cumsum(isTarget) - 1
+    use = isTarget & (nucs != 255)
+    if not use.any():
+        return None
+
+    positions = positions[use]
+    target.counts[positions, nucs[use]] += 1
+    target.target[positions] = tseq[use]
+    return int(positions[0]), int(positions[-1])
+
+
+def addQuality(target, start, quality):
+    """Adds the p-errors of an alignment to the sums of the SNP positions like getQualities() of
+    nanopipe_qualreg.py: a SNP at start + i gets the symbols i - 10 ... i + 10 without i itself."""
+
+    p_errors = P_ERROR[np.frombuffer(quality.encode("ascii"), dtype=np.uint8)]
+    count = len(p_errors)
+    cumsum = np.concatenate(([0.0], np.cumsum(p_errors)))
+    index = np.arange(count)
+    lo = np.maximum(index - 10, 0)
+    hi = np.minimum(index + 11, count)
+
+    snps = start + index
+    keep = snps <= target.length
+    target.qsum[snps[keep]] += (cumsum[hi] - cumsum[lo] - p_errors)[keep]
+    target.qcount[snps[keep]] += (hi - lo - 1)[keep].astype(np.uint32)
+
+
+def loadWindow(target, start, stop, params):
+    """Returns the defined positions of [start, stop) (block aligned) and their counts, gaps, covered flags and
+    consensus symbols."""
+
+    counts = np.array(target.counts[start:stop], dtype=np.int64)
+    blocks = (np.arange(start, stop) - start) // BLOCKSIZE
+    defined = np.zeros((stop - start + BLOCKSIZE - 1) // BLOCKSIZE, dtype=bool)
+    defined[blocks[counts.any(axis=1)]] = True
+    positions = np.nonzero(defined[blocks])[0]
+
+    counts = counts[positions]
+    gaps = counts[:, 4]
+    counts = counts[:, :4]
+    total = counts.sum(axis=1)
+    covered = (total >= params["mincount"]) & (total > gaps)
+
+    # Consensus: the nucleotides with counts >= highest * equal
+    top = counts >= (counts.max(axis=1) * params["equal"])[:, None]
+    consensus = CONSENSUS[np.dot(top, [1, 2, 4, 8])]
+    consensus[total < params["mincount"]] = b"N"
+    consensus[gaps > total] = b"-"
+
+    return start + positions, counts, covered, consensus
+
+
+def findBound(positions, separator, maxgap, last):
+    """Returns the index of the first (last=False) or after the last (last=True) run of more than maxgap separator
+    positions, None if there is none."""
+
+    breaks = np.concatenate(([-1], np.nonzero(~separator)[0], [len(separator)]))
+    runs = np.nonzero(np.diff(breaks) - 1 > maxgap)[0]
+    if not len(runs):
+        return None
+    if last:
+        return int(breaks[runs[-1] + 1])
+    return int(breaks[runs[0]] + 1)
+
+
+def getRegion(target, lo, hi, touched, params):
+    """Returns the region [start, stop) around the changed blocks lo ... hi, whose fragments must be evaluated
+    again. The region ends at a run of more than maxgap uncovered positions in blocks without new counts or at
+    the end of the target."""
+
+    start = stop = None
+    size = WINDOW
+    length = target.length
+    while start is None or stop is None:
+        window_start = max(0, (lo - size) * BLOCKSIZE)
+        window_stop = min(length, (hi + 1 + size) * BLOCKSIZE)
+        positions, _, covered, _ = loadWindow(target, window_start, window_stop, params)
+        separator = ~covered & ~touched[positions // BLOCKSIZE]
+
+        if start is None:
+            before = positions < lo * BLOCKSIZE
+            index = findBound(positions[before], separator[before], params["maxgap"], True)
+            if index is not None:
+                start = int(positions[index - 1]) + 1
+            elif window_start == 0:
+                start = 0
+        if stop is None:
+            after = positions >= (hi + 1) * BLOCKSIZE
+            index = findBound(positions[after], separator[after], params["maxgap"], False)
+            if index is not None:
+                stop = int(positions[after][index])
+            elif window_stop == length:
+                stop = length
+        size *= 2
+    return start, stop
+
+
+def getRows(consensus, covered, params):
+    """Returns the rows of the saved fragments like saveData() of analyze.pm for the defined positions of a region
+    (the first position starts a new fragment)."""
+
+    rows = np.zeros(len(covered), dtype=bool)
+    covered = np.nonzero(covered)[0]
+    if not len(covered):
+        return rows
+
+    breaks = np.nonzero(np.diff(covered) - 1 > params["maxgap"])[0]
+    starts = covered[np.concatenate(([0], breaks + 1))]
+    stops = covered[np.concatenate((breaks, [len(covered) - 1]))]
+    n_counts = np.concatenate(([0], np.cumsum(consensus == b"N")))
+    for start, stop in zip(starts, stops):
+        length = stop - start + 1
+        if length >= params["minlen"] and int((n_counts[stop + 1] - n_counts[start]) * 100.0 / length) <= \
+                params["maxN"]:
+            rows[start:stop + 1] = True
+    return rows
+
+
+def updateRegion(target, start, stop, params, thresholds):
+    """Evaluates the fragments of the region [start, stop) again: rows, candidate SNPs and highest coverages."""
+
+    window_start = start - start % BLOCKSIZE
+    window_stop = min(target.length, stop + (-stop % BLOCKSIZE))
+    positions, counts, covered, consensus = loadWindow(target, window_start, window_stop, params)
+    inside = (positions >= start) & (positions < stop)
+    positions, counts, covered, consensus = positions[inside], counts[inside], covered[inside], consensus[inside]
+
+    rows = getRows(consensus, covered, params)
+    target.rows[start:stop] = 0
+    target.rows[positions[rows]] = 1
+
+    # Candidate SNPs of the rows
+    for pos in [pos for pos in target.calls if start < pos <= stop]:
+        del target.calls[pos]
+    if rows.any():
+        nucs = np.array(target.target[positions[rows]]).view("S1")
+        data = (positions[rows] + 1, counts[rows], np.char.lower(consensus[rows]), np.char.lower(nucs))
+        print_dict, cover_dict, raw_cov_dict = nanopipe_snpcall.callCounts(data, *thresholds)
+        coverages = dict([(pos, coverage) for coverage in cover_dict for pos in cover_dict[coverage]])
+        for pos in print_dict:
+            target.calls[int(pos)] = (print_dict[pos], raw_cov_dict[pos], coverages[pos])
+
+    # Highest coverage of the rows per block
+    for block in range(start // BLOCKSIZE, (stop - 1) // BLOCKSIZE + 1):
+        block_start = block * BLOCKSIZE
+        block_stop = min(target.length, block_start + BLOCKSIZE)
+        total = np.array(target.counts[block_start:block_stop, :4], dtype=np.int64).sum(axis=1)
+        total[target.rows[block_start:block_stop] == 0] = 0
+        target.blockmax[block] = total.max()
+
+
+def getCallSet(target):
+    """Returns the call set of a target like the calling of a nuccounts file: (print_dict, cover_dict,
+    raw_cov_dict)."""
+
+    print_dict = {}
+    raw_cov_dict = {}
+    cover_dict = {}
+    if target.calls:
+        cover_dict[int(target.blockmax.max())] = []
+    for pos in sorted(target.calls):
+        print_list, raw_cov, coverage = target.calls[pos]
+        print_dict[str(pos)] = list(print_list)
+        raw_cov_dict[str(pos)] = dict(raw_cov)
+        cover_dict.setdefault(coverage, []).append(str(pos))
+    return print_dict, cover_dict, raw_cov_dict
+
+
+def getQualities(target):
+    """Returns the average p-errors of the candidate SNPs like getQualities() of nanopipe_qualreg.py."""
+
+    qualities = {}
+    for pos in target.calls:
+        count = target.qcount[pos]
+        qualities[pos] = "%.4f" % (target.qsum[pos] / count) if count else "N/A"
+    return qualities
+
+
+class LiveRun(object):
+
+    """The live calling of a run directory: the targets (in the order of their first alignment, numbered from 1),
+    the parameters, the hashes of the merged batches and the targets, whose .poly files are not published yet."""
+
+    def __init__(self, state_dir, params):
+        self.state_dir = state_dir
+        self.state_file = os.path.join(state_dir, STATE_FILE)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as f:
+                self.state = json.load(f)
+            if self.state["params"] != params:
+                raise ValueError("The parameters differ from the ones of the merged batches (%s)"
+                                 % json.dumps(self.state["params"], sort_keys=True))
+        else:
+            self.state = {"params": params, "targets": [], "batches": [], "pending": []}
+        self.params = params
+        self.targets = {}
+
+    def getTarget(self, tid, length):
+        """Returns the number and the data of a target, a new target is added."""
+
+        names = [name for name, _ in self.state["targets"]]
+        if tid not in names:
+            self.state["targets"].append([tid, length])
+            names.append(tid)
+        enc = names.index(tid) + 1
+        if enc not in self.targets:
+            self.targets[enc] = Target(self.state_dir, enc, self.state["targets"][enc - 1][1])
+        return enc, self.targets[enc]
+
+    def addBatch(self, maf_file, thresholds):
+        """Merges the alignments of a batch and evaluates the changed regions. Returns the numbers of the changed
+        targets or None, if the batch was merged before."""
+
+        batch = nanopipe_runcache.hashFile(maf_file)
+        if batch in self.state["batches"]:
+            return None
+
+        changed = {}
+        for tid, start, length, tseq, qseq, quality in readBatch(maf_file):
+            enc, target = self.getTarget(tid, length)
+            span = addAlignment(target, start, tseq, qseq)
+            if span is not None:
+                changed.setdefault(enc, []).append((span[0] // BLOCKSIZE, span[1] // BLOCKSIZE))
+            if quality is not None:
+                addQuality(target, start, quality)
+
+        for enc in sorted(changed):
+            target = self.targets[enc]
+            touched = np.zeros(len(target.blockmax), dtype=bool)
+            for lo, hi in changed[enc]:
+                touched[lo:hi + 1] = True
+
+            # Regions around the runs of changed blocks, overlapping regions are merged
+            blocks = np.nonzero(touched)[0]
+            ends = np.nonzero(np.diff(blocks) > 1)[0]
+            regions = []
+            for lo, hi in zip(blocks[np.concatenate(([0], ends + 1))], blocks[np.concatenate((ends, [-1]))]):
+                start, stop = getRegion(target, lo, hi, touched, self.params)
+                if regions and start <= regions[-1][1]:
+                    regions[-1] = (regions[-1][0], max(stop, regions[-1][1]))
+                else:
+                    regions.append((start, stop))
+            for start, stop in regions:
+                updateRegion(target, start, stop, self.params, thresholds)
+            target.save()
+
+        self.state["batches"].append(batch)
+        self.state["pending"] = sorted(set(self.state["pending"]) | set(changed))
+        return sorted(changed)
+
+    def save(self):
+        writeAtomic(self.state_file, json.dumps(self.state, indent=1, sort_keys=True).encode("ascii"))
+
+    def publish(self, args):
+        """Annotates the call sets of the pending targets by nanopipe_calc_polymorphism.py and replaces their .poly
+        files. Returns the exit status of the script."""
+
+        changed = self.state["pending"]
+
+        stage_dir = os.path.join(self.state_dir, STAGE_DIR)
+        if not os.path.isdir(stage_dir):
+            os.makedirs(stage_dir)
+        for file_name in os.listdir(stage_dir):
+            os.remove(os.path.join(stage_dir, file_name))
+
+        writeAtomic(TIDMAP_FILE, "".join(["%s\t%d\n" % (name, enc)
+                                          for enc, (name, _) in enumerate(self.state["targets"], 1)]).encode("ascii"))
+
+        calls = {}
+        qualities = {}
+        for enc in changed:
+            target = self.getTarget(*self.state["targets"][enc - 1])[1]
+            calls["calc.nuccounts.%d" % enc] = getCallSet(target)
+            qualities[str(enc)] = getQualities(target)
+        calls_file = os.path.join(stage_dir, "calls.pickle")
+        with open(calls_file, "wb") as out:
+            pickle.dump({"calls": calls, "qualities": qualities}, out, pickle.HIGHEST_PROTOCOL)
+
+        status = subprocess.call([sys.executable, SCRIPT] + args + ["-calls", calls_file, "-o", stage_dir, "-m",
+                                                                   os.path.join(stage_dir, "metrics.json")])
+        if status:
+            return status
+
+        # Every .poly file is replaced at once, targets without SNPs lose their file
+        for enc in changed:
+            file_name = "calc.nuccounts.%d.poly" % enc
+            if os.path.exists(os.path.join(stage_dir, file_name)):
+                os.rename(os.path.join(stage_dir, file_name), file_name)
+            elif os.path.exists(file_name):
+                os.remove(file_name)
+        self.state["pending"] = []
+        self.save()
+        return 0
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+def removeOptions(arg_list, options):
+    """Returns the command line arguments without the options and their values."""
+    result = []
+    arg_iter = iter(arg_list)
+    for arg in arg_iter:
+        if arg in options:
+            next(arg_iter, None)
+        else:
+            result.append(arg)
+    return result
+
+
+if __name__ == "__main__":
+    arg_list = sys.argv[1:]
+    if not arg_list or arg_list[0].startswith("-"):
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    maf_file = arg_list[0]
+    params = dict([(name, getOption(arg_list, "-" + name, PARAMS[name], type(PARAMS[name]))) for name in PARAMS])
+    thresholds = (getOption(arg_list, "-tt", TARGET_THRESHOLD, float), getOption(arg_list, "-pt", POLY_THRESHOLD, float),
+                  getOption(arg_list, "-ratio", TT_RATIO, float))
+    args = removeOptions(arg_list[1:], ["-state", "-bed"] + ["-" + name for name in PARAMS])
+
+    try:
+        live = LiveRun(getOption(arg_list, "-state", STATE_DIR), params)
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    changed = live.addBatch(maf_file, thresholds)
+    if changed is None:
+        sys.stdout.write("%s: merged before\n" % maf_file)
+    else:
+        live.save()
+        sys.stdout.write("%s: %d target(s) changed\n" % (maf_file, len(changed)))
+    sys.exit(live.publish(args) if live.state["pending"] else 0)
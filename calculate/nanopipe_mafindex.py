@@ -0,0 +1,266 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Sidecar index for the alignments of LAST (calc.lastalign.maf).
+The index is written once after the alignment and records for every alignment block the byte offset of its "a"
+line, the target ID, the target start and end (0-based, end exclusive), the number of alignment columns, the
+score and the byte offset of its "p" quality line. The blocks are sorted by target and start, so the blocks
+overlapping a target region are found by binary search. The MAF file is memory-mapped and only the selected
+blocks are read.
+
+Build the index (default: calc.lastalign.maf.idx):
+
+    nanopipe_mafindex.py calc.lastalign.maf [index file]"""
+
+
+import sys
+import os
+import mmap
+import struct
+import bisect
+from collections import namedtuple
+
+
+# Header of the index files: magic, version, number of blocks, number of targets, size of the target names and
+# size of the indexed MAF file
+MAGIC = b"NPMAFIDX"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIQ")
+
+# Offset of blocks without quality line
+NO_QUALITY = 2 ** 64 - 1
+
+# An alignment block of the index
+MAFBlock = namedtuple("MAFBlock", ["offset", "target", "start", "end", "columns", "score", "p_offset"])
+
+
+class MappedColumn(object):
+
+    """Read only array of fixed size items on a memory-mapped buffer. Supports len() and indexing, which is
+    sufficient for bisect."""
+
+    def __init__(self, buf, start, count, item):
+        self.buf = buf
+        self.start = start
+        self.count = count
+        self.item = struct.Struct(item)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("index out of range")
+        return self.item.unpack_from(self.buf, self.start + index * self.item.size)[0]
+
+
+def toStr(data):
+    """Returns the bytes of the MAF file as str."""
+    if not isinstance(data, str):
+        data = data.decode("ascii")
+    return data
+
+
+def scanMAF(maf_file):
+    """Reads a MAF file once. Yields every alignment block as MAFBlock with the target name as target. The first
+    "s" line of a block is the target, a "p" line following the target and query line is the quality line."""
+
+    offset = 0
+    block = None
+    s_counter = 0
+
+    with open(maf_file, "rb") as maf:
+        for line in maf:
+            if line.startswith(b"a"):
+                if block is not None and block[1] is not None:
+                    yield MAFBlock(*block)
+                score = 0.0
+                for field in toStr(line).split()[1:]:
+                    if field.startswith("score="):
+                        score = float(field[6:])
+                block = [offset, None, 0, 0, 0, score, NO_QUALITY]
+                s_counter = 0
+
+            elif block is not None and line.startswith(b"s"):
+                if s_counter == 0:
+                    line_data = toStr(line).split()
+                    block[1] = line_data[1]
+                    block[2] = int(line_data[2])
+                    block[3] = block[2] + int(line_data[3])
+                    block[4] = len(line_data[-1])
+                s_counter += 1
+
+            elif block is not None and line.startswith(b"p"):
+                if s_counter == 2 and block[6] == NO_QUALITY:
+                    block[6] = offset
+
+            offset += len(line)
+
+    if block is not None and block[1] is not None:
+        yield MAFBlock(*block)
+
+
+def buildIndex(maf_file, index_file=None):
+    """Writes the index of a MAF file (default: maf_file + ".idx"). Returns the number of blocks."""
+
+    if index_file is None:
+        index_file = maf_file + ".idx"
+    maf_size = os.path.getsize(maf_file)
+
+    names = []
+    name_ids = {}
+    blocks = []
+    for block in scanMAF(maf_file):
+        if block.target not in name_ids:
+            name_ids[block.target] = len(names)
+            names.append(block.target)
+        blocks.append(block._replace(target=name_ids[block.target]))
+
+    # Stable sort, blocks with equal starts keep the order of the MAF file
+    blocks.sort(key=lambda block: (block.target, block.start))
+    count = len(blocks)
+
+    # First block and maximum length of the blocks per target
+    first = [0] * (len(names) + 1)
+    span = [0] * len(names)
+    for block in blocks:
+        first[block.target + 1] += 1
+        span[block.target] = max(span[block.target], block.end - block.start)
+    for i in range(len(names)):
+        first[i + 1] += first[i]
+
+    name_data = "\n".join(names).encode("ascii")
+    padding = b"\0" * (-(HEADER.size + len(name_data)) % 8)
+
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "wb") as out:
+        out.write(HEADER.pack(MAGIC, VERSION, count, len(names), len(name_data), maf_size))
+        out.write(name_data + padding)
+        for field, item in (("offset", "Q"), ("p_offset", "Q"), ("score", "d"), ("start", "I"), ("end", "I"),
+                            ("columns", "I")):
+            out.write(struct.pack("<%d%s" % (count, item), *[getattr(block, field) for block in blocks]))
+        out.write(struct.pack("<%dI" % (len(names) + 1), *first))
+        out.write(struct.pack("<%dI" % len(names), *span))
+    os.rename(tmp_file, index_file)
+
+    return count
+
+
+class MAFIndex(object):
+
+    """Memory-mapped MAF file and its index. The blocks overlapping a target region are yielded by blocks(), the
+    text and the quality symbols of a block are read by text() and quality()."""
+
+    def __init__(self, maf_file, index_file=None):
+        if index_file is None:
+            index_file = maf_file + ".idx"
+
+        with open(index_file, "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, name_count, name_size, maf_size = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC or version != VERSION:
+            self.index.close()
+            raise ValueError("Not a valid MAF index: %s" % index_file)
+        if maf_size != os.path.getsize(maf_file):
+            self.index.close()
+            raise ValueError("MAF index does not match %s: %s" % (maf_file, index_file))
+
+        self.count = count
+        position = HEADER.size
+        name_data = toStr(self.index[position:position + name_size])
+        self.names = name_data.split("\n") if name_count else []
+        self.name_ids = dict([(name, i) for i, name in enumerate(self.names)])
+        position += name_size + (-(HEADER.size + name_size) % 8)
+
+        columns = {}
+        for field, item in (("offset", "<Q"), ("p_offset", "<Q"), ("score", "<d"), ("start", "<I"), ("end", "<I"),
+                            ("columns", "<I")):
+            columns[field] = MappedColumn(self.index, position, count, item)
+            position += count * struct.calcsize(item)
+        self.columns = columns
+        self.first = MappedColumn(self.index, position, name_count + 1, "<I")
+        self.span = MappedColumn(self.index, position + (name_count + 1) * 4, name_count, "<I")
+
+        self.maf = None
+        if maf_size:
+            with open(maf_file, "rb") as f:
+                self.maf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def block(self, index, target=None):
+        """Returns the block at index (sorted by target and start) as MAFBlock."""
+        columns = self.columns
+        if target is None:
+            target = self.names[bisect.bisect_right(self.first, index) - 1]
+        return MAFBlock(columns["offset"][index], target, columns["start"][index], columns["end"][index],
+                        columns["columns"][index], columns["score"][index], columns["p_offset"][index])
+
+    def blocks(self, target, start=0, end=None):
+        """Yields the blocks of a target, which overlap the region [start, end) (0-based, default: the whole
+        target), sorted by start. Blocks with equal starts keep the order of the MAF file."""
+
+        if target not in self.name_ids:
+            return
+        target_id = self.name_ids[target]
+        first = self.first[target_id]
+        last = self.first[target_id + 1]
+        starts = self.columns["start"]
+        ends = self.columns["end"]
+
+        # Blocks starting more than the longest block before the region can't overlap it
+        low = bisect.bisect_right(starts, start - self.span[target_id], first, last)
+        high = last if end is None else bisect.bisect_left(starts, end, low, last)
+        for index in range(low, high):
+            if ends[index] > start:
+                yield self.block(index, target)
+
+    def text(self, block):
+        """Returns the lines of a block as str."""
+        stop = self.maf.find(b"\na", block.offset)
+        if stop < 0:
+            stop = len(self.maf)
+        return toStr(self.maf[block.offset:stop + 1])
+
+    def quality(self, block):
+        """Returns the quality symbols of a block ("p" line) or None."""
+        if block.p_offset == NO_QUALITY:
+            return None
+        stop = self.maf.find(b"\n", block.p_offset)
+        if stop < 0:
+            stop = len(self.maf)
+        return toStr(self.maf[block.p_offset:stop]).split()[-1]
+
+    def close(self):
+        if self.maf is not None:
+            self.maf.close()
+            self.maf = None
+        self.index.close()
+
+
+def openIndex(maf_file, index_file=None):
+    """Returns the MAFIndex of a MAF file, if the index exists and is not older than the MAF file, else None."""
+
+    if index_file is None:
+        index_file = maf_file + ".idx"
+    if not os.path.isfile(index_file) or os.path.getmtime(index_file) < os.path.getmtime(maf_file):
+        return None
+    try:
+        return MAFIndex(maf_file, index_file)
+    except (ValueError, struct.error):
+        return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: %s maf_file [index_file]\n" % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+
+    maf_file = sys.argv[1]
+    index_file = sys.argv[2] if len(sys.argv) > 2 else None
+    count = buildIndex(maf_file, index_file)
+    sys.stdout.write("%s: %d blocks\n" % (maf_file, count))
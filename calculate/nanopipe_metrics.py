@@ -0,0 +1,88 @@
+"""Metrics of the phases of the polymorphism step.
+For every phase the wall time, the CPU time, the number of calls, the peak memory (RSS of the process after the
+phase) and item counts are collected. Phases can be started and stopped several times (e.g. once per file), the
+values are summed up. Phases running in worker processes are measured there and added by add(). The metrics are
+saved as JSON file."""
+
+
+import os
+import sys
+import json
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def getCPU():
+    """Returns the CPU time (user + system) of the process in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def getPeakRSS(who="self"):
+    """Returns the peak RSS in MB of the process ("self") or of its finished children ("children")."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # Linux reports KB, macOS bytes
+    return usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+class Metrics(object):
+
+    """Collects the metrics of the phases in the order of their first start. Further values (e.g. network round
+    trips) are kept in a separate dictionary by set()."""
+
+    def __init__(self):
+        self.start_wall = time.time()
+        self.start_cpu = getCPU()
+        self.phases = {}
+        self.order = []
+        self.running = {}
+        self.values = {}
+
+    def getPhase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {"wall": 0.0, "cpu": 0.0, "calls": 0}
+            self.order.append(name)
+        return self.phases[name]
+
+    def start(self, name):
+        """Starts a phase."""
+        self.getPhase(name)
+        self.running[name] = (time.time(), getCPU())
+
+    def stop(self, name, **counts):
+        """Stops a phase and adds the item counts."""
+        start_wall, start_cpu = self.running.pop(name)
+        self.add(name, time.time() - start_wall, getCPU() - start_cpu, **counts)
+        self.phases[name]["peak_rss_mb"] = getPeakRSS()
+
+    def add(self, name, wall=0.0, cpu=0.0, **counts):
+        """Adds the wall and CPU time of a phase measured elsewhere (e.g. in a worker process) and item counts."""
+        phase = self.getPhase(name)
+        phase["wall"] += wall
+        phase["cpu"] += cpu
+        phase["calls"] += 1
+        for key in counts:
+            phase[key] = phase.get(key, 0) + counts[key]
+
+    def set(self, key, value):
+        """Sets a further value."""
+        self.values[key] = value
+
+    def save(self, file_name):
+        """Writes the metrics as JSON file."""
+
+        metrics = {
+            "total": {"wall": time.time() - self.start_wall, "cpu": getCPU() - self.start_cpu,
+                      "peak_rss_mb": getPeakRSS(), "children_peak_rss_mb": getPeakRSS("children")},
+            "phases": [dict(self.phases[name], name=name) for name in self.order],
+            "values": self.values
+        }
+        with open(file_name, "w") as out:
+            json.dump(metrics, out, indent=1, sort_keys=True)
+            out.write("\n")
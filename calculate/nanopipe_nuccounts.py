@@ -0,0 +1,139 @@
+"""Reader for the nucleotide count files of analyze.pm.
+The counts are either written as text (calc.nuccounts.N, one line per position) or in a binary columnar format
+(calc.nuccounts.N.bin): a header with the target ID and the row offsets of the fragments, followed by uint32
+columns for the position and the counts of A, C, G, T and gaps, and byte columns for the consensus and the
+target nucleotide. The binary files are memory-mapped; with NumPy the columns are arrays on the mapped file
+without copying."""
+
+
+import sys
+import mmap
+import array
+import struct
+
+import nanopipe_bgzf
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Header of the binary files: magic, version, number of fragments, number of rows and length of the target ID
+MAGIC = b"NPNUCBIN"
+VERSION = 1
+HEADER = struct.Struct("<8sIIII")
+
+# Extension of the binary files
+BINARY_EXT = ".bin"
+
+
+def isBinary(file_name):
+    """Returns True, if file_name is a binary nucleotide count file."""
+    return file_name.endswith(BINARY_EXT)
+
+
+class NuccountsFile(object):
+
+    """Memory-mapped binary nucleotide count file. With NumPy the columns positions, counts (rows x 4: A, C, G, T),
+    gaps, consensus and target are arrays on the mapped file, else None. fragments holds the row offsets of the
+    fragments (number of fragments + 1)."""
+
+    def __init__(self, file_name):
+        with open(file_name, "rb") as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, fragment_count, rows, name_size = HEADER.unpack_from(self.mapped, 0)
+        if magic != MAGIC or version != VERSION:
+            self.mapped.close()
+            raise ValueError("Not a binary nuccounts file: %s" % file_name)
+
+        position = HEADER.size
+        self.tid = self.mapped[position:position + name_size]
+        if not isinstance(self.tid, str):
+            self.tid = self.tid.decode("ascii")
+        position += name_size + (-name_size % 4)
+        self.fragments = list(struct.unpack_from("<%dI" % (fragment_count + 1), self.mapped, position))
+        position += (fragment_count + 1) * 4
+        self.rows = rows
+
+        # The uint32 columns position, A, C, G, T, gaps and the byte columns consensus and target
+        self.column_start = position
+        self.text_start = position + rows * 24
+        self.positions = self.counts = self.gaps = self.consensus = self.target = None
+        if np is not None:
+            columns = np.frombuffer(self.mapped, dtype="<u4", count=rows * 6, offset=position).reshape(6, rows)
+            self.positions = columns[0]
+            self.counts = columns[1:5].T
+            self.gaps = columns[5]
+            self.consensus = np.frombuffer(self.mapped, dtype="S1", count=rows, offset=self.text_start)
+            self.target = np.frombuffer(self.mapped, dtype="S1", count=rows, offset=self.text_start + rows)
+
+    def __len__(self):
+        return self.rows
+
+    def lines(self):
+        """Yields the lines of the text format: ">tid" for every fragment, then the rows
+        "position A C G T consensus target gaps" (tab separated). Does not need NumPy."""
+
+        rows = self.rows
+        columns = array.array("I")
+        data = self.mapped[self.column_start:self.text_start]
+        if hasattr(columns, "frombytes"):
+            columns.frombytes(data)
+        else:
+            columns.fromstring(data)
+        if sys.byteorder == "big":
+            columns.byteswap()
+
+        consensus = self.mapped[self.text_start:self.text_start + rows]
+        target = self.mapped[self.text_start + rows:self.text_start + 2 * rows]
+        if not isinstance(consensus, str):
+            consensus = consensus.decode("latin-1")
+            target = target.decode("latin-1")
+
+        header = ">%s\n" % self.tid
+        for fragment in range(len(self.fragments) - 1):
+            yield header
+            for row in range(self.fragments[fragment], self.fragments[fragment + 1]):
+                yield "%d\t%d\t%d\t%d\t%d\t%s\t%s\t%d\n" % (columns[row], columns[rows + row],
+                                                          columns[2 * rows + row], columns[3 * rows + row],
+                                                          columns[4 * rows + row], consensus[row], target[row],
+                                                          columns[5 * rows + row])
+
+    def close(self):
+        """Closes the mapped file. The arrays of the columns must not be used any more."""
+        self.positions = self.counts = self.gaps = self.consensus = self.target = None
+        self.mapped.close()
+
+
+class BinaryLines(object):
+
+    """File like access to the lines of a binary nucleotide count file (readlines() and iteration)."""
+
+    def __init__(self, file_name):
+        self.nuccounts = NuccountsFile(file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.nuccounts.lines()
+
+    def readlines(self):
+        return list(self.nuccounts.lines())
+
+    def close(self):
+        self.nuccounts.close()
+
+
+def openNuccounts(file_name):
+    """Opens a text, block-compressed text (.gz) or binary nucleotide count file for reading its lines in the text
+    format."""
+
+    if isBinary(file_name):
+        return BinaryLines(file_name)
+    return nanopipe_bgzf.openText(file_name)
@@ -0,0 +1,441 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Array-backed pileup engine for analyze.pm (config setting engine=numpy in the [analyze] section).
+The alignments of calc.lastalign.maf are counted into preallocated arrays per target (uint32 counts of A, C, G, T
+and gaps and the target nucleotides) instead of the vec blocks of add(). The counted columns of many alignments are
+collected and added in batches. The fragments, the IUPAC consensus and the output files are the same as of
+saveData(): calc.tidmap, calc.nuccounts.N (and/or .bin), calc.consensus.N and the manifest of the overlapped mode.
+
+The memory is fixed by maxmem: the targets are sorted like in analyze.pm and cut into segments, which are counted
+in as many passes over the maf file as needed to keep the arrays of a pass within the budget. The fragments are
+assembled chunk by chunk, a fragment open at the end of a chunk or segment is continued in the next one.
+
+    nanopipe_pileup.py [calc.lastalign.maf] [-mincount 10] [-minlen 40] [-maxgap 20] [-maxN 10] [-equal 0.8]
+                       [-hscore] [-nuccounts text|binary|both] [-manifest file] [-maxmem 4096]"""
+
+import sys
+import os
+import re
+import time
+
+import numpy as np
+
+import nanopipe_live
+import nanopipe_nuccounts
+
+
+USAGE = """Usage: nanopipe_pileup.py [calc.lastalign.maf] [-mincount 10] [-minlen 40] [-maxgap 20] [-maxN 10]
+                          [-equal 0.8] [-hscore] [-nuccounts text|binary|both] [-manifest file] [-maxmem 4096]
+"""
+
+LAST_FILE = "calc.lastalign.maf"
+TIDMAP_FILE = "calc.tidmap"
+NUCCOUNTS_FILE = "calc.nuccounts"
+CONSENSUS_FILE = "calc.consensus"
+
+# Default parameters like analyze.pm
+PARAMS = {"mincount": 10, "minlen": 40, "maxgap": 20, "maxN": 10, "equal": 0.8, "hscore": False,
+          "nuccounts": "text", "manifest": None, "maxmem": 4096}
+
+BLOCKSIZE = nanopipe_live.BLOCKSIZE
+
+# Bytes of the arrays per target position: counts of ACGT- (uint32) and the target nucleotide
+POSITION_BYTES = 5 * 4 + 1
+
+# Memory (MB) kept from maxmem for the batches and the chunks
+RESERVED = 256
+
+# Counted columns collected before they are added to the arrays
+BATCH_SIZE = 1 << 22
+
+# Positions of a chunk, whose fragments are assembled at once
+CHUNK_SIZE = 1000 * BLOCKSIZE
+
+SCORE = re.compile(r"score=(\d+)")
+
+
+def readAlignments(maf_file):
+    """Yields the alignments of a maf file: (score, target id, start, target size (at least the end of the
+    alignment), target sequence, query sequence)."""
+
+    alignment = None
+    with open(maf_file, "r") as maf:
+        for line in maf:
+            if line.startswith("a"):
+                match = SCORE.search(line)
+                alignment = [int(match.group(1)) if match else None]
+            elif line.startswith("s") and alignment is not None:
+                line_data = line.split()
+                if len(alignment) == 1:
+                    start = int(line_data[2])
+                    size = max(int(line_data[5]), start + int(line_data[3]))
+                    alignment.extend([line_data[1], start, size, line_data[6]])
+                else:
+                    yield tuple(alignment) + (line_data[6],)
+                    alignment = None
+
+
+def scanTargets(maf_file):
+    """Returns the sizes and the highest scores of the targets in the maf file."""
+
+    sizes = {}
+    scores = {}
+    for score, tid, _, size, _, _ in readAlignments(maf_file):
+        sizes[tid] = max(size, sizes.get(tid, 0))
+        if score is not None and score > scores.get(tid, -1):
+            scores[tid] = score
+    return sizes, scores
+
+
+def getPasses(sizes, maxmem):
+    """Returns the passes over the maf file: lists of segments (tid, start, stop) in the order of the sorted
+    targets, whose arrays fit together into the memory budget."""
+
+    budget = max(maxmem - RESERVED, 1) * (1 << 20) // POSITION_BYTES
+    budget = max(CHUNK_SIZE, budget - budget % BLOCKSIZE)
+
+    passes = [[]]
+    used = 0
+    for tid in sorted(sizes):
+        if not tid or tid == "0":
+            continue
+        for start in range(0, sizes[tid], budget):
+            stop = min(sizes[tid], start + budget)
+            if used + stop - start > budget:
+                passes.append([])
+                used = 0
+            passes[-1].append((tid, start, stop))
+            used += stop - start
+    return [segments for segments in passes if segments]
+
+
+def getColumns(start, tseq, qseq):
+    """Returns the target positions, the query nucleotide indices (ACGT-) and the target nucleotides of the counted
+    columns of an alignment like add() of analyze.pm."""
+
+    tseq = np.frombuffer(tseq.encode("ascii"), dtype=np.uint8)
+    nucs = nanopipe_live.NUC_INDEX[np.frombuffer(qseq.encode("ascii"), dtype=np.uint8)]
+
+    # Target gaps are skipped, every other column is the next target position
+    isTarget = tseq != ord("-")
+    positions = start + np.cumsum(isTarget) - 1
+    use = isTarget & (nucs != 255)
+    return positions[use], nucs[use], tseq[use]
+
+
+class Segment(object):
+
+    """The arrays of the positions start ... stop - 1 of a target: counts (A, C, G, T, gaps) and target
+    nucleotides. The counted columns are collected in batch and added by flush()."""
+
+    def __init__(self, tid, start, stop):
+        self.tid = tid
+        self.start = start
+        self.stop = stop
+        self.counts = np.zeros((stop - start, 5), dtype=np.uint32)
+        self.target = np.zeros(stop - start, dtype=np.uint8)
+        self.batch = []
+
+    def add(self, positions, nucs, tnucs):
+        """Collects the columns inside the segment. Returns their number."""
+
+        inside = (positions >= self.start) & (positions < self.stop)
+        if not inside.all():
+            positions, nucs, tnucs = positions[inside], nucs[inside], tnucs[inside]
+        positions = positions - self.start
+        self.batch.append(positions * 5 + nucs)
+        self.target[positions] = tnucs
+        return len(positions)
+
+    def flush(self):
+        if not self.batch:
+            return
+        cells, counts = np.unique(np.concatenate(self.batch), return_counts=True)
+        self.counts.reshape(-1)[cells] += counts.astype(np.uint32)
+        self.batch = []
+
+    def getRows(self, lo, hi):
+        """Returns the rows of the defined positions (blocks with a count like in analyze.pm) of lo ... hi - 1
+        (relative, block aligned): positions, counts, consensus, target nucleotides and the covered flags."""
+
+        counts = self.counts[lo:hi]
+        blocks = np.arange(hi - lo) // BLOCKSIZE
+        defined = np.zeros((hi - lo + BLOCKSIZE - 1) // BLOCKSIZE, dtype=bool)
+        defined[blocks[counts.any(axis=1)]] = True
+        index = np.nonzero(defined[blocks])[0]
+
+        counts = counts[index]
+        nucs = counts[:, :4].astype(np.int64)
+        gaps = counts[:, 4]
+        total = nucs.sum(axis=1)
+        covered = (total >= params["mincount"]) & (total > gaps)
+
+        # Consensus: the nucleotides with counts >= highest * equal
+        top = nucs >= (nucs.max(axis=1) * params["equal"])[:, None]
+        consensus = nanopipe_live.CONSENSUS[np.dot(top, [1, 2, 4, 8])]
+        consensus[total < params["mincount"]] = b"N"
+        consensus[gaps > total] = b"-"
+
+        rows = (self.start + lo + index, counts, consensus, self.target[lo:hi][index])
+        return rows, covered
+
+
+def sliceRows(rows, lo, hi):
+    return tuple(column[lo:hi] for column in rows)
+
+
+def joinRows(parts):
+    return tuple(np.concatenate([part[i] for part in parts]) for i in range(4))
+
+
+def toText(data):
+    return data if isinstance(data, str) else data.decode("latin-1")
+
+
+class FragmentWriter(object):
+
+    """Assembles the fragments of the rows of a target like saveData() of analyze.pm and writes the accepted ones.
+    The rows are added chunk by chunk in the order of the positions. An open fragment keeps its rows up to the last
+    covered position (parts) and the uncovered rows after it (tail), until the next covered position shows whether
+    the gap is wider than maxgap."""
+
+    def __init__(self, nuccounts="text", manifest=None):
+        self.savetext = nuccounts != "binary"
+        self.savebinary = nuccounts in ("binary", "both")
+        self.tidmap = open(TIDMAP_FILE, "w")
+        self.manifest = manifest
+        self.tidcount = 0
+        self.tid = None
+        self.isNew = False
+        self.nuccounts = self.consensus = None
+        self.binfragments = []
+        self.parts = []
+        self.tail = []
+        self.gap = 0
+
+    def startTarget(self, tid):
+        self.tid = tid
+        self.isNew = True
+        self.parts = []
+        self.tail = []
+        self.gap = 0
+
+    def add(self, rows, covered):
+        """Adds the next rows of the current target and saves the fragments completed by them."""
+
+        maxgap = params["maxgap"]
+        covered = np.nonzero(covered)[0]
+        count = len(rows[0])
+
+        if self.parts:
+            first = covered[0] if len(covered) else count
+            if self.gap + first > maxgap:
+                self.closeFragment()
+            elif not len(covered):
+                self.tail.append(rows)
+                self.gap += count
+                return
+        if not len(covered):
+            return
+
+        # Covered positions with more than maxgap rows between them separate the fragments
+        breaks = np.nonzero(np.diff(covered) - 1 > maxgap)[0]
+        starts = covered[np.concatenate(([0], breaks + 1))]
+        stops = covered[np.concatenate((breaks, [len(covered) - 1]))]
+        for start, stop in zip(starts, stops):
+            if self.parts:
+                self.parts.extend(self.tail)
+                self.parts.append(sliceRows(rows, 0, stop + 1))
+            else:
+                self.parts = [sliceRows(rows, start, stop + 1)]
+            self.tail = []
+            if stop != stops[-1]:
+                self.closeFragment()
+
+        self.tail = [sliceRows(rows, stops[-1] + 1, count)]
+        self.gap = count - stops[-1] - 1
+
+    def closeFragment(self):
+        if self.parts:
+            self.saveFragment(joinRows(self.parts))
+        self.parts = []
+        self.tail = []
+        self.gap = 0
+
+    def saveFragment(self, rows):
+        """Writes a fragment, if it has the minimum length and not too many N."""
+
+        positions, counts, consensus, target = rows
+        length = len(positions)
+        consensus = consensus.tostring()
+        if length < params["minlen"] or int(consensus.count(b"N") * 100.0 / length) > params["maxN"]:
+            return
+
+        if self.isNew:
+            self.closeTarget()
+            self.tidcount += 1
+            self.tidmap.write("%s\t%d\n" % (self.tid, self.tidcount))
+            if self.savetext:
+                self.nuccounts = open("%s.%d" % (NUCCOUNTS_FILE, self.tidcount), "w")
+            self.consensus = open("%s.%d" % (CONSENSUS_FILE, self.tidcount), "w")
+            self.isNew = False
+
+        consensus = toText(consensus)
+        self.consensus.write(">%s (%d:%d)\n%s\n" % (self.tid, positions[0] + 1, positions[-1] + 1, consensus))
+
+        if self.savetext:
+            columns = [(positions + 1).tolist()] + [counts[:, i].tolist() for i in range(4)] + \
+                [list(consensus), list(toText(target.tostring())), counts[:, 4].tolist()]
+            self.nuccounts.write(">%s\n" % self.tid)
+            self.nuccounts.write("".join(["%d\t%d\t%d\t%d\t%d\t%s\t%s\t%d\n" % row for row in zip(*columns)]))
+        if self.savebinary:
+            self.binfragments.append(rows)
+
+    def saveBinary(self):
+        """Writes the binary nucleotide count file of the current tid (layout: see saveBinary() of analyze.pm)."""
+
+        positions, counts, consensus, target = joinRows(self.binfragments)
+        offsets = np.cumsum([0] + [len(fragment[0]) for fragment in self.binfragments])
+        tid = self.tid.encode("ascii")
+
+        with open("%s.%d%s" % (NUCCOUNTS_FILE, self.tidcount, nanopipe_nuccounts.BINARY_EXT), "wb") as out:
+            out.write(nanopipe_nuccounts.HEADER.pack(nanopipe_nuccounts.MAGIC, nanopipe_nuccounts.VERSION,
+                                                     len(self.binfragments), len(positions), len(tid)))
+            out.write(tid + b"\0" * (-len(tid) % 4))
+            out.write(offsets.astype("<u4").tostring())
+            out.write((positions + 1).astype("<u4").tostring())
+            for i in range(5):
+                out.write(counts[:, i].astype("<u4").tostring())
+            out.write(consensus.tostring())
+            out.write(target.tostring())
+        self.binfragments = []
+
+    def endTarget(self):
+        """Saves the open fragment (without the uncovered rows after it) and closes the files of the target."""
+
+        self.closeFragment()
+        if not self.isNew:
+            self.closeTarget()
+
+    def closeTarget(self):
+        if self.consensus is None:
+            return
+        self.consensus.close()
+        self.consensus = None
+        if self.savetext:
+            self.nuccounts.close()
+            self.nuccounts = None
+        if self.savebinary:
+            self.saveBinary()
+        if self.manifest is not None:
+            self.manifest.write("%s\t%d\n" % (self.tid, self.tidcount))
+            self.manifest.flush()
+
+    def close(self):
+        self.closeTarget()
+        self.tidmap.close()
+
+
+def countPass(maf_file, segments, scores):
+    """Counts the alignments of the maf file into the arrays of the segments."""
+
+    by_tid = {}
+    for segment in segments:
+        by_tid.setdefault(segment.tid, []).append(segment)
+
+    batched = 0
+    for score, tid, start, _, tseq, qseq in readAlignments(maf_file):
+        if tid not in by_tid:
+            continue
+
+        # Skip if highest score is active but the score does not fit
+        if params["hscore"] and scores.get(tid) != score:
+            continue
+
+        positions, nucs, tnucs = getColumns(start, tseq, qseq)
+        if not len(positions):
+            continue
+        for segment in by_tid[tid]:
+            if positions[0] < segment.stop and positions[-1] >= segment.start:
+                batched += segment.add(positions, nucs, tnucs)
+
+        if batched >= BATCH_SIZE:
+            for segment in segments:
+                segment.flush()
+            batched = 0
+
+    for segment in segments:
+        segment.flush()
+
+
+def run(maf_file, manifest=None):
+    """Counts the alignments and writes the output files. A line is appended to the open manifest for every written
+    target. Returns the number of written targets."""
+
+    starttime = time.time()
+    sizes, scores = scanTargets(maf_file)
+    passes = getPasses(sizes, params["maxmem"])
+    print "Targets: %d, passes: %d (%.1f seconds)" % (len(sizes), len(passes), time.time() - starttime)
+
+    writer = FragmentWriter(params["nuccounts"], manifest)
+    for segments in passes:
+        starttime = time.time()
+        segments = [Segment(tid, start, stop) for tid, start, stop in segments]
+        countPass(maf_file, segments, scores)
+        counttime = time.time() - starttime
+
+        for segment in segments:
+            if segment.start == 0:
+                writer.startTarget(segment.tid)
+            for lo in range(0, segment.stop - segment.start, CHUNK_SIZE):
+                writer.add(*segment.getRows(lo, min(segment.stop - segment.start, lo + CHUNK_SIZE)))
+            if segment.stop == sizes[segment.tid]:
+                writer.endTarget()
+        print "Pass: %d segment(s), count %.1f seconds, save %.1f seconds" % \
+            (len(segments), counttime, time.time() - starttime - counttime)
+        del segments
+
+    writer.close()
+    return writer.tidcount
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+params = dict(PARAMS)
+
+if __name__ == "__main__":
+    arg_list = sys.argv[1:]
+    if "-h" in arg_list:
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    for option, convert in [("mincount", int), ("minlen", int), ("maxgap", int), ("maxN", float),
+                            ("equal", float), ("nuccounts", str), ("manifest", str), ("maxmem", int)]:
+        params[option] = getOption(arg_list, "-" + option, PARAMS[option], convert)
+    params["hscore"] = "-hscore" in arg_list
+
+    maf_file = arg_list[0] if arg_list and not arg_list[0].startswith("-") else LAST_FILE
+
+    # The manifest is always closed, with "#error" if the counting failed, so a follower does not wait forever
+    manifest = open(params["manifest"], "w") if params["manifest"] else None
+    isComplete = False
+    try:
+        if not os.path.isfile(maf_file):
+            sys.stderr.write("No maf file: %s\n" % maf_file)
+            sys.exit(1)
+        print "Targets written: %d" % run(maf_file, manifest)
+        isComplete = True
+    finally:
+        if manifest is not None:
+            manifest.write("#end\n" if isComplete else "#error\n")
+            manifest.close()
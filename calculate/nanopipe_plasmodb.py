@@ -0,0 +1,224 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Compiled position index for the local PlasmoDB SNP database (SNPdbPlasf).
+Each chromosome file <chr>.txt is compiled once into <chr>.idx. The index holds the sorted SNP positions as
+uint32 array, followed by the offsets into an allele table (dbID, major allele and frequency, minor allele and
+frequency). Index files are memory-mapped, so candidate SNPs are found by binary search without reading the
+text files again.
+
+Build the index files:
+
+    nanopipe_plasmodb.py /path/to/SNPdbPlasf"""
+
+
+import sys
+import os
+import mmap
+import struct
+import bisect
+
+
+# Header of the index files: magic, version and number of rows
+MAGIC = b"NPPDBIDX"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+
+# Already opened indices: path -> PlasmoIndex
+index_cache = {}
+
+
+class PlasmoIndex(object):
+
+    """Sorted positions of a SNPdbPlasf chromosome file and the allele table of its rows. The offsets of the rows
+    point into table. The data is either memory-mapped from an index file or read directly from the text file."""
+
+    def __init__(self, positions, offsets, table, mapped=None):
+        self.positions = positions
+        self.offsets = offsets
+        self.table = table
+        self.mapped = mapped
+
+    def __len__(self):
+        return len(self.positions)
+
+    def row(self, index):
+        """Returns the row at index as tuple (dbID, dbMaj, dbMajF, dbMin, dbMinF)."""
+        line = self.table[self.offsets[index]:self.offsets[index + 1]]
+        if not isinstance(line, str):
+            line = line.decode("ascii")
+        return tuple(line.rstrip("\n").split("\t"))
+
+    def lookup(self, positions):
+        """Returns all rows for the given positions (int) as dictionary: position -> [row, ...]. The rows of a
+        position keep the order of the database file."""
+        result = {}
+        count = len(self.positions)
+        for pos in sorted(positions):
+            index = bisect.bisect_left(self.positions, pos)
+            while index < count and self.positions[index] == pos:
+                if pos in result:
+                    result[pos].append(self.row(index))
+                else:
+                    result[pos] = [self.row(index)]
+                index += 1
+        return result
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class MappedArray(object):
+
+    """Read only uint32 array on a memory-mapped buffer. Supports len() and indexing, which is sufficient for
+    bisect."""
+
+    ITEM = struct.Struct("<I")
+
+    def __init__(self, buf, start, count):
+        self.buf = buf
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("index out of range")
+        return self.ITEM.unpack_from(self.buf, self.start + index * 4)[0]
+
+
+def readDB(db_file):
+    """Reads a SNPdbPlasf text file. Returns a list of (position, row) sorted by position, where row is the tuple
+    (dbID, dbMaj, dbMajF, dbMin, dbMinF). Rows with equal positions keep their order."""
+
+    rows = []
+    with open(db_file, "r") as plasmDB:
+        for line in plasmDB:
+
+            # Skip header
+            if "[" in line[0]:
+                continue
+
+            line_data = line.rstrip("\n").split("\t")
+            if len(line_data) < 5:
+                continue
+            dbID = line_data[0]
+            rows.append((int(dbID.split(".")[-1]), tuple(line_data[:5])))
+
+    # Stable sort, the files should already be sorted
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def compileRows(rows, table_start=0):
+    """Returns the positions, the offsets (starting at table_start) and the allele table for the rows of readDB()."""
+
+    positions = []
+    offsets = [table_start]
+    table = []
+    for pos, row in rows:
+        line = ("\t".join(row) + "\n").encode("ascii")
+        positions.append(pos)
+        offsets.append(offsets[-1] + len(line))
+        table.append(line)
+
+    return positions, offsets, b"".join(table)
+
+
+def buildIndex(db_file, index_file=None):
+    """Compiles a SNPdbPlasf text file into an index file (default: same name with extension .idx)."""
+
+    if index_file is None:
+        index_file = os.path.splitext(db_file)[0] + ".idx"
+
+    rows = readDB(db_file)
+    count = len(rows)
+
+    # The offsets point directly into the index file
+    table_start = HEADER.size + count * 4 + (count + 1) * 4
+    positions, offsets, table = compileRows(rows, table_start)
+
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "wb") as out:
+        out.write(HEADER.pack(MAGIC, VERSION, count))
+        out.write(struct.pack("<%dI" % count, *positions))
+        out.write(struct.pack("<%dI" % (count + 1), *offsets))
+        out.write(table)
+    os.rename(tmp_file, index_file)
+
+    return count
+
+
+def openIndex(index_file):
+    """Memory-maps an index file and returns a PlasmoIndex."""
+
+    with open(index_file, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, count = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION:
+        mapped.close()
+        raise ValueError("Not a valid PlasmoDB index: %s" % index_file)
+
+    positions = MappedArray(mapped, HEADER.size, count)
+    offsets = MappedArray(mapped, HEADER.size + count * 4, count + 1)
+
+    return PlasmoIndex(positions, offsets, mapped, mapped)
+
+
+def loadIndex(db_dir, chr_numb):
+    """Returns the PlasmoIndex of a chromosome. The compiled index is used, if it exists and is not older than the
+    text file. Otherwise the text file is read into memory. Indices are cached for further lookups."""
+
+    db_file = os.path.join(db_dir, chr_numb + ".txt")
+    index_file = os.path.join(db_dir, chr_numb + ".idx")
+
+    if os.path.isfile(index_file) and (not os.path.isfile(db_file) or
+                                       os.path.getmtime(index_file) >= os.path.getmtime(db_file)):
+        path = index_file
+    else:
+        path = db_file
+
+    if path in index_cache:
+        return index_cache[path]
+
+    if path == index_file:
+        index = openIndex(index_file)
+    else:
+        positions, offsets, table = compileRows(readDB(db_file))
+        index = PlasmoIndex(positions, offsets, table)
+
+    index_cache[path] = index
+    return index
+
+
+def lookup(db_dir, chr_numb, snp_list):
+    """Checks candidate SNP positions (strings) in the local PlasmoDB database. Returns a dictionary:
+    outdict[snp]=[(dbID, [dbMaj: dbMajF, dbMin: dbMinF])]"""
+
+    outdict = {}
+    index = loadIndex(db_dir, chr_numb)
+    snp_dict = dict([(int(snp), snp) for snp in snp_list])
+    for pos, rows in index.lookup(snp_dict.keys()).items():
+        outdict[snp_dict[pos]] = [(dbID, [dbMaj + ":" + dbMajF, dbMin + ":" + dbMinF])
+                                  for dbID, dbMaj, dbMajF, dbMin, dbMinF in rows]
+    return outdict
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: %s SNPdbPlasf_directory\n" % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+
+    db_dir = sys.argv[1]
+    for file_name in sorted(os.listdir(db_dir)):
+        if file_name.endswith(".txt"):
+            count = buildIndex(os.path.join(db_dir, file_name))
+            sys.stdout.write("%s: %d positions\n" % (file_name, count))
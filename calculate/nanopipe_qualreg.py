@@ -0,0 +1,194 @@
+"""Alignment quality of SNP positions.
+For every SNP the quality symbols (MAF "p" lines) of a region of at max 20 nucleotides around the SNP are taken
+from all alignments covering it. The symbols are translated to p-errors and averaged over all alignments. The
+alignments are kept per target sorted by their start and the SNPs are walked in sorted order, so only the
+alignments overlapping the current SNP are visited. The alignments are read from the index of the maf file (see
+nanopipe_mafindex.py), if it is available. For the streaming mode of the polymorphism step the SNPs of a target can
+be given in ascending chunks, while its alignments are read on demand (QualityScanner, iterAlignments)."""
+
+
+import heapq
+
+import nanopipe_mafindex
+
+
+# p-error for every quality symbol: 10 ** -((ascII - 33) / 10)
+P_ERROR = [10 ** -((ascII - 33) / 10.0) for ascII in range(256)]
+
+
+def loadMAF(maf_file, targets=None):
+    """Loads the alignments of a maf file: chr -> [(start, end, quality), ...] sorted by start (stable). The
+    chromosome/transcriptome IDs lose a leading "chr". Only alignments with a quality line are taken. If targets
+    is given, only these IDs are loaded."""
+
+    maf_index = nanopipe_mafindex.openIndex(maf_file)
+    if maf_index is not None:
+        try:
+            return loadIndexedMAF(maf_index, targets)
+        finally:
+            maf_index.close()
+
+    maf_dict = {}
+    s_counter = 0
+    align_start = 0
+    align_end = 0
+    chr = None
+
+    with open(maf_file, "r") as maf:
+        for line in maf:
+
+            # Choose lines starting with s...
+            if line.startswith("s ") or line.startswith("s\t"):
+                if s_counter == 0:
+                    line_data = line.split()
+                    chr = line_data[1]
+                    if chr.startswith("chr"):
+                        chr = chr[3:]
+                    align_start = int(line_data[2])
+                    align_end = len(line_data[-1]) + align_start - 1
+                s_counter += 1
+
+            # ... and quality lines following the target and query line
+            elif line.startswith("p ") or line.startswith("p\t"):
+                if s_counter == 2:
+                    s_counter = 0
+                    if targets is None or chr in targets:
+                        quality = line.split()[-1]
+                        if chr in maf_dict:
+                            maf_dict[chr].append((align_start, align_end, quality))
+                        else:
+                            maf_dict[chr] = [(align_start, align_end, quality)]
+
+    for chr in maf_dict:
+        maf_dict[chr].sort(key=lambda alignment: alignment[0])
+
+    return maf_dict
+
+
+def loadIndexedMAF(maf_index, targets=None):
+    """Loads the alignments like loadMAF() by the index of the maf file. Only the quality lines of the targets are
+    read."""
+
+    maf_dict = {}
+    for name in maf_index.names:
+        chr = name[3:] if name.startswith("chr") else name
+        if targets is not None and chr not in targets:
+            continue
+        if chr not in maf_dict:
+            maf_dict[chr] = []
+        for block in maf_index.blocks(name):
+            quality = maf_index.quality(block)
+            if quality is not None:
+                maf_dict[chr].append((block.start, block.offset, block.start + block.columns - 1, quality))
+
+    # Target IDs with and without "chr" are merged in the order of the maf file
+    for chr in maf_dict:
+        maf_dict[chr].sort()
+        maf_dict[chr] = [(align_start, align_end, quality) for align_start, _, align_end, quality in maf_dict[chr]]
+
+    return maf_dict
+
+
+def getQualRegion(quality, snp, align_start, align_end):
+    """Returns the quality symbols of a region of at max 20 nucleotides around the SNP (10 before and 10 after);
+    the SNP itself is skipped."""
+
+    qualPos = snp - align_start
+    if qualPos >= 10:
+        region = quality[qualPos - 10:qualPos]
+    else:
+        # Start at beginning of quality string
+        region = quality[:qualPos]
+
+    if align_end - snp > 10:
+        return region + quality[qualPos + 1:qualPos + 11]
+    # The string to the end is taken
+    return region + quality[qualPos + 1:]
+
+
+class QualityScanner(object):
+
+    """Average p-errors of SNPs, which are given in ascending chunks. The alignments (an iterable sorted by start, see
+    loadMAF) are read on demand and only the ones overlapping the current SNP are kept."""
+
+    def __init__(self, alignments):
+        self.alignments = iter(alignments)
+        self.next = next(self.alignments, None)
+        self.active = []
+
+    def getQualities(self, snps):
+        """Returns the average p-error for every SNP position (int) as formatted string: snp -> "0.1234". The SNPs
+        must be bigger than the ones of the former calls. SNPs without any quality symbol get "N/A"."""
+
+        result = {}
+        for snp in sorted(snps):
+
+            # Alignments starting at or before the SNP become active; ended alignments are dropped, because the
+            # following SNPs are bigger
+            while self.next is not None and self.next[0] <= snp:
+                self.active.append(self.next)
+                self.next = next(self.alignments, None)
+            self.active = [alignment for alignment in self.active if alignment[1] >= snp]
+
+            quality_str = "".join([getQualRegion(quality, snp, align_start, align_end)
+                                   for align_start, align_end, quality in self.active])
+
+            # Average p_error over all alignments of a single SNP
+            if quality_str:
+                ave_p_err = 0
+                for ascII in quality_str:
+                    ave_p_err = ave_p_err + P_ERROR[ord(ascII)]
+                result[snp] = "%.4f" % (ave_p_err / len(quality_str))
+            else:
+                result[snp] = "N/A"
+
+        return result
+
+
+def getQualities(alignments, snps):
+    """Returns the average p-error for every SNP position (int) as formatted string: snp -> "0.1234". The
+    alignments are sorted by start (see loadMAF). SNPs without any quality symbol get "N/A"."""
+    return QualityScanner(alignments).getQualities(snps)
+
+
+def iterAlignments(maf_file, chr):
+    """Yields the alignments of one target (without "chr") like loadMAF() by start. With the index of the maf file
+    only the alignments of the target overlapping the current position are held in memory, else the alignments of
+    the target are loaded."""
+
+    maf_index = nanopipe_mafindex.openIndex(maf_file)
+    if maf_index is None:
+        for alignment in loadMAF(maf_file, set([chr])).get(chr, []):
+            yield alignment
+        return
+
+    try:
+        # Target IDs with and without "chr" are merged in the order of the maf file
+        names = [name for name in maf_index.names if (name[3:] if name.startswith("chr") else name) == chr]
+        blocks = heapq.merge(*[((block.start, block.offset, block) for block in maf_index.blocks(name))
+                               for name in names])
+        for align_start, _, block in blocks:
+            quality = maf_index.quality(block)
+            if quality is not None:
+                yield align_start, align_start + block.columns - 1, quality
+    finally:
+        maf_index.close()
+
+
+def addQuality(res_dict, maf_file):
+    """Adds the p-error column (in front of the raw counts) to every SNP of res_dict[chr][pos]."""
+
+    targets = set([chr for chr in res_dict if chr != "**header**"])
+    maf_dict = loadMAF(maf_file, targets)
+
+    insertQualities(res_dict, dict([(chr, getQualities(maf_dict.get(chr, []), [int(pos) for pos in res_dict[chr]]))
+                                    for chr in targets]))
+
+
+def insertQualities(res_dict, p_errors):
+    """Adds the p-error column of p_errors[chr][snp] (formatted like getQualities) to every SNP of res_dict."""
+
+    for chr in res_dict:
+        if chr != "**header**":
+            for pos in res_dict[chr]:
+                res_dict[chr][pos].insert(-4, p_errors[chr][int(pos)] + "\t")
@@ -0,0 +1,425 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Streaming ingestion of the query (see query.pm).
+The query of a request is a fasta or fastq file (plain, gzip or bzip2 compressed) or a tar (also compressed) or zip
+archive of such files, whose members may be compressed again. It is read in one pass into input.query: the
+members are decompressed by reader threads (several members of a zip or plain tar archive at the same time, a
+compressed tar archive is one stream) and cut into chunks of whole records. The chunks are converted from fastq to
+fasta and filtered by the minimum length in worker processes and written in the order of the archive. Members,
+which are no fasta or fastq files, are skipped. The queues between the stages are bounded, so the memory does not
+depend on the size of the query.
+
+The number of reads, the kept reads and bases and the lengths of the kept reads are printed along the way and
+written to the statistics file (-stats).
+
+    nanopipe_query.py query [-o input.query] [-minlen 10] [-j workers] [-stats calc.querystats]"""
+
+import sys
+import os
+import time
+import zlib
+import bz2
+import string
+import tarfile
+import zipfile
+import threading
+import collections
+import multiprocessing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+USAGE = """Usage: nanopipe_query.py query [-o input.query] [-minlen 10] [-j workers] [-stats calc.querystats]
+"""
+
+QUERY_FILE = "input.query"
+
+# Reads with fewer letters in the sequence are skipped (< 1: no filter)
+MINLEN = 10
+
+# Worker processes converting and filtering the chunks, also the number of members read ahead
+WORKERS = 2
+
+# Bytes read at once and (about) bytes of a chunk of records
+READ_SIZE = 1 << 20
+CHUNK_SIZE = 4 << 20
+
+# Compressed bytes of bzip2 decompressed at once
+BZIP2_PART = 1 << 16
+
+# Chunks waiting per reader thread and per worker process
+QUEUE_CHUNKS = 4
+PENDING_CHUNKS = 2
+
+# Seconds between the progress messages
+PROGRESS = 10
+
+GZIP_MAGIC = b"\x1f\x8b"
+BZIP2_MAGIC = b"BZh"
+ZIP_MAGIC = b"PK\x03\x04"
+
+# Record starts of fasta and fastq
+FASTA = b">"
+FASTQ = b"@"
+
+# Deleted when the letters of a sequence are counted (like tr/A-Za-z// in perl)
+NON_LETTERS = bytes(bytearray([c for c in range(256) if chr(c) not in string.ascii_letters]))
+
+
+def isTar(data):
+    return len(data) >= 262 and data[257:262] == b"ustar"
+
+
+def iterBlocks(f, size=READ_SIZE):
+    block = f.read(size)
+    while block:
+        yield block
+        block = f.read(size)
+
+
+def iterGzip(blocks):
+    """Yields the decompressed data of gzip blocks (also of several members like bgzip). The output per call is
+    limited, so a high compression does not blow up the memory."""
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for block in blocks:
+        while block:
+            data = decompressor.decompress(block, READ_SIZE)
+            if data:
+                yield data
+            block = decompressor.unconsumed_tail
+
+            # The member ended, the rest is the next member (python 2 may keep it in unconsumed_tail, too)
+            if decompressor.unused_data:
+                block = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                # Padding after the last member
+                if block[:2] != GZIP_MAGIC:
+                    return
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iterBzip2(blocks):
+    """Yields the decompressed data of bzip2 blocks (also of several streams like pbzip2)."""
+
+    decompressor = bz2.BZ2Decompressor()
+    for block in blocks:
+        pos = 0
+        while pos < len(block):
+            # Small parts limit the output per call
+            part = block[pos:pos + BZIP2_PART]
+            pos += len(part)
+            try:
+                data = decompressor.decompress(part)
+            except EOFError:
+                # The stream ended with the former part
+                if part[:3] != BZIP2_MAGIC:
+                    return
+                decompressor = bz2.BZ2Decompressor()
+                data = decompressor.decompress(part)
+            if data:
+                yield data
+            if decompressor.unused_data:
+                block = decompressor.unused_data + block[pos:]
+                pos = 0
+                if block[:3] != BZIP2_MAGIC:
+                    return
+                decompressor = bz2.BZ2Decompressor()
+
+
+def peekBlocks(blocks):
+    """Returns the first block and an iterator of all blocks."""
+
+    for block in blocks:
+        return block, iterChain(block, blocks)
+    return b"", iter([])
+
+
+def iterChain(first, blocks):
+    yield first
+    for block in blocks:
+        yield block
+
+
+def iterDecompressed(blocks):
+    """Yields the decompressed data of blocks, which are gzip or bzip2 compressed or plain."""
+
+    first, blocks = peekBlocks(blocks)
+    if first[:2] == GZIP_MAGIC:
+        return iterGzip(blocks)
+    if first[:3] == BZIP2_MAGIC:
+        return iterBzip2(blocks)
+    return blocks
+
+
+def getSources(query):
+    """Returns the sources of the query, which can be read at the same time: ("file", path), ("zip", path, member
+    name), ("tar", path, offset, size) for the members of a plain tar archive and ("tarstream", path) for a
+    compressed tar archive."""
+
+    with open(query, "rb") as f:
+        head = f.read(512)
+    if head[:4] == ZIP_MAGIC:
+        with zipfile.ZipFile(query) as archive:
+            return [("zip", query, info.filename) for info in archive.infolist() if not info.filename.endswith("/")]
+    if isTar(head):
+        with tarfile.open(query, "r:") as archive:
+            return [("tar", query, info.offset_data, info.size) for info in archive.getmembers() if info.isfile()]
+    if head[:2] == GZIP_MAGIC or head[:3] == BZIP2_MAGIC:
+        with open(query, "rb") as f:
+            first, _ = peekBlocks(iterDecompressed(iterBlocks(f, 1 << 16)))
+        if isTar(first):
+            return [("tarstream", query)]
+    return [("file", query)]
+
+
+def iterSource(source):
+    """Yields the members of a source as (name, iterator of the decompressed data)."""
+
+    kind, path = source[:2]
+    if kind == "file":
+        with open(path, "rb") as f:
+            yield path, iterDecompressed(iterBlocks(f))
+    elif kind == "zip":
+        with zipfile.ZipFile(path) as archive:
+            member = archive.open(source[2])
+            yield source[2], iterDecompressed(iterBlocks(member))
+            member.close()
+    elif kind == "tar":
+        with open(path, "rb") as f:
+            f.seek(source[2])
+            yield "%s:%d" % (path, source[2]), iterDecompressed(iterMember(f, source[3]))
+    else:
+        with tarfile.open(path, "r|*") as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info.name, iterDecompressed(iterBlocks(archive.extractfile(info)))
+
+
+def iterMember(f, size):
+    """Yields the blocks of the next size bytes of a file."""
+
+    while size > 0:
+        block = f.read(min(size, READ_SIZE))
+        if not block:
+            break
+        size -= len(block)
+        yield block
+
+
+def getCut(data, fmt):
+    """Returns the end of the last whole record in data (0: none). A fastq record has four lines."""
+
+    if fmt == FASTA:
+        return data.rfind(b"\n" + FASTA) + 1
+    end = data.rfind(b"\n") + 1
+    for _ in range(data.count(b"\n", 0, end) % 4):
+        end = data.rfind(b"\n", 0, end - 1) + 1
+    return end
+
+
+def iterChunks(blocks):
+    """Yields the chunks (format, data) of whole records of the decompressed data of a member. Nothing is yielded
+    for a member, which is not a fasta or fastq file."""
+
+    first, blocks = peekBlocks(blocks)
+    fmt = first[:1]
+    if fmt not in (FASTA, FASTQ):
+        return
+
+    parts = []
+    size = 0
+    for block in blocks:
+        parts.append(block)
+        size += len(block)
+        if size >= CHUNK_SIZE:
+            data = b"".join(parts)
+            cut = getCut(data, fmt)
+            if cut:
+                yield fmt, data[:cut]
+                data = data[cut:]
+            parts = [data]
+            size = len(data)
+
+    data = b"".join(parts)
+    if data:
+        yield fmt, data if data.endswith(b"\n") else data + b"\n"
+
+
+def processChunk(fmt, data, minlen):
+    """Converts a chunk to fasta and skips the reads with less than minlen letters in the sequence. Returns the
+    output, the number of reads, of kept reads and of kept bases and the lengths of the kept reads: length ->
+    count."""
+
+    output = []
+    lengths = {}
+    reads = 0
+
+    if fmt == FASTQ:
+        lines = data.split(b"\n")
+        count = len(lines) - 1
+        for header, seq in zip(lines[0:count:4], lines[1:count:4]):
+            reads += 1
+            length = len(seq.translate(None, NON_LETTERS))
+            if length >= minlen or minlen < 1:
+                output.extend((header.replace(FASTQ, FASTA, 1), b"\n", seq, b"\n"))
+                lengths[length] = lengths.get(length, 0) + 1
+    else:
+        for record in data[1:-1].split(b"\n" + FASTA):
+            reads += 1
+            end = record.find(b"\n")
+            length = len(record[end + 1:].translate(None, NON_LETTERS)) if end >= 0 else 0
+            if length >= minlen or minlen < 1:
+                output.extend((FASTA, record, b"\n"))
+                lengths[length] = lengths.get(length, 0) + 1
+
+    return b"".join(output), reads, sum(lengths.values()), sum([l * n for l, n in lengths.items()]), lengths
+
+
+class SourceReader(threading.Thread):
+
+    """Reads the chunks of a source into a bounded queue, None marks the end, an exception is passed on."""
+
+    def __init__(self, source):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source = source
+        self.queue = queue.Queue(QUEUE_CHUNKS)
+
+    def run(self):
+        try:
+            for _, blocks in iterSource(self.source):
+                for chunk in iterChunks(blocks):
+                    self.queue.put(chunk)
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+
+class Statistics(object):
+
+    """Read counts and lengths of the kept reads."""
+
+    def __init__(self):
+        self.reads = 0
+        self.kept = 0
+        self.bases = 0
+        self.lengths = collections.defaultdict(int)
+        self.starttime = time.time()
+
+    def add(self, reads, kept, bases, lengths):
+        self.reads += reads
+        self.kept += kept
+        self.bases += bases
+        for length, count in lengths.items():
+            self.lengths[length] += count
+
+    def getN50(self):
+        half = 0
+        for length in sorted(self.lengths, reverse=True):
+            half += length * self.lengths[length]
+            if half * 2 >= self.bases:
+                return length
+        return 0
+
+    def printProgress(self):
+        print "Reads: %d, kept: %d, bases: %d (%.1f seconds)" % (self.reads, self.kept, self.bases,
+                                                                  time.time() - self.starttime)
+
+    def write(self, file_name):
+        lengths = sorted(self.lengths)
+        with open(file_name, "w") as f:
+            f.write("%d\tNumber of reads in the query\n" % self.reads)
+            f.write("%d\tNumber of reads kept\n" % self.kept)
+            f.write("%d\tNumber of bases kept\n" % self.bases)
+            if lengths:
+                f.write("%d\tShortest read kept\n" % lengths[0])
+                f.write("%d\tLongest read kept\n" % lengths[-1])
+                f.write("%d\tN50 of the reads kept\n" % self.getN50())
+                f.write("\t".join(["%d:%d" % (length, self.lengths[length]) for length in lengths]) + "\n")
+
+
+def ingest(query, output_file, minlen=MINLEN, workers=WORKERS):
+    """Reads the query into the fasta file output_file. Returns the statistics."""
+
+    sources = getSources(query)
+    statistics = Statistics()
+    pool = multiprocessing.Pool(workers)
+    readers = collections.deque()
+    pending = collections.deque()
+    lastprint = time.time()
+
+    def writeResult(result):
+        out.write(result[0])
+        statistics.add(*result[1:])
+
+    try:
+        with open(output_file, "wb") as out:
+            index = 0
+            while readers or index < len(sources):
+                # Members of the next sources are read ahead
+                while len(readers) < workers and index < len(sources):
+                    readers.append(SourceReader(sources[index]))
+                    readers[-1].start()
+                    index += 1
+
+                chunk = readers[0].queue.get()
+                if chunk is None:
+                    readers.popleft()
+                    continue
+                if isinstance(chunk, Exception):
+                    raise chunk
+                pending.append(pool.apply_async(processChunk, chunk + (minlen,)))
+
+                while len(pending) > workers * PENDING_CHUNKS:
+                    writeResult(pending.popleft().get())
+                if time.time() - lastprint >= PROGRESS:
+                    statistics.printProgress()
+                    lastprint = time.time()
+
+            while pending:
+                writeResult(pending.popleft().get())
+    finally:
+        pool.terminate()
+
+    return statistics
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+if __name__ == "__main__":
+    arg_list = sys.argv[1:]
+    if not arg_list or arg_list[0].startswith("-"):
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    query = arg_list[0]
+    if not os.path.isfile(query):
+        sys.stderr.write("Query %s is not a file!\n" % query)
+        sys.exit(1)
+
+    stats_file = getOption(arg_list, "-stats", None)
+    statistics = ingest(query, getOption(arg_list, "-o", QUERY_FILE), getOption(arg_list, "-minlen", MINLEN, int),
+                        max(1, getOption(arg_list, "-j", WORKERS, int)))
+    statistics.printProgress()
+    if stats_file:
+        statistics.write(stats_file)
+    if not statistics.reads:
+        sys.stderr.write("No fasta or fastq data in the query %s!\n" % query)
+        sys.exit(1)
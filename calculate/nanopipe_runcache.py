@@ -0,0 +1,109 @@
+"""Incremental re-run cache of the polymorphism step.
+The cache is a SQLite database in the run directory. The call set of a nucleotide count file (the candidate SNPs
+after the coverage cutoff) is stored under a key made of the content hash of the file and the calling parameters,
+so a re-run calls only the files, whose content or parameters changed. The PlasmoDB matches of a call set are
+stored under the key of the call set and the version of the database file, so the annotation of unchanged call
+sets is reapplied from the cache until the database is refreshed. A few keys are kept per file, so the call sets of
+several parameter sets (of a sweep) do not replace each other."""
+
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Version of the cached data, part of every key
+VERSION = 1
+
+# Bytes read at once for the content hash
+BLOCK_SIZE = 1 << 20
+
+# Keys (e.g. parameter sets) kept per kind and name
+KEYS = 8
+
+
+def hashFile(file_name):
+    """Returns the SHA-1 hash of the content of a file."""
+
+    sha = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        block = f.read(BLOCK_SIZE)
+        while block:
+            sha.update(block)
+            block = f.read(BLOCK_SIZE)
+    return sha.hexdigest()
+
+
+def makeKey(*parts):
+    """Returns the key for the parts (strings, numbers and dictionaries of these)."""
+    return hashlib.sha1(json.dumps([VERSION] + list(parts), sort_keys=True).encode("ascii")).hexdigest()
+
+
+def getCallKey(file_name, params):
+    """Returns the key of the call set of a nucleotide count file for the calling parameters."""
+    return makeKey(hashFile(file_name), params)
+
+
+def getDBVersion(db_file):
+    """Returns the version of a database file (size and modification time), "" if the file is missing."""
+    if not os.path.isfile(db_file):
+        return ""
+    stat = os.stat(db_file)
+    return "%d:%.6f" % (stat.st_size, stat.st_mtime)
+
+
+class RunCache(object):
+
+    """Cached results: (kind, name, key) -> value. The values of several keys of a name are kept side by side
+    (e.g. the call sets of the parameter sets of a sweep), at most max_keys per kind and name; the least recently
+    used ones are evicted. Counts the hits and misses of the lookups."""
+
+    def __init__(self, path, max_keys=KEYS):
+        self.path = path
+        self.max_keys = max_keys
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.text_factory = str
+        with self.connection:
+            # The table of the first version held a single key per name
+            self.connection.execute("DROP TABLE IF EXISTS result")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                    "(kind TEXT NOT NULL, name TEXT NOT NULL, key TEXT NOT NULL, "
+                                    "value BLOB NOT NULL, atime REAL NOT NULL, PRIMARY KEY (kind, name, key))")
+
+    def get(self, kind, name, key):
+        """Returns the value stored for name and key or None."""
+
+        with self.connection:
+            row = self.connection.execute("SELECT value FROM results WHERE kind = ? AND name = ? AND key = ?",
+                                          (kind, name, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE results SET atime = ? WHERE kind = ? AND name = ? AND key = ?",
+                                    (time.time(), kind, name, key))
+        self.hits += 1
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, kind, name, key, value):
+        """Stores value for name and key and evicts the least recently used keys of the name."""
+
+        data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results (kind, name, key, value, atime) "
+                                    "VALUES (?, ?, ?, ?, ?)", (kind, name, key, data, time.time()))
+            self.connection.execute("DELETE FROM results WHERE kind = ? AND name = ? AND key NOT IN "
+                                    "(SELECT key FROM results WHERE kind = ? AND name = ? "
+                                    "ORDER BY atime DESC LIMIT ?)", (kind, name, kind, name, self.max_keys))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,202 @@
+"""Array based SNP calling for calc.nuccounts files.
+The nucleotide counts of a whole file are loaded into NumPy arrays and the candidate polymorphisms are found in
+batch: the target fraction test, the poly_threshold test, the weighting of transitions vs. transversions and the
+rescaling to 1. The results have the same layout as in the per line calling of nanopipe_calc_polymorphism.py.
+Binary nuccounts files are used without parsing, the counts are arrays on the mapped file (see
+nanopipe_nuccounts.py)."""
+
+from __future__ import division
+
+import itertools
+
+import nanopipe_nuccounts
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Column order of the nucleotide counts
+NUCS = ["a", "c", "g", "t"]
+
+# Order in which the weighted occurences are summed up. This is the iteration order of the poly_dict in the
+# per line calling and keeps the floating point sums identical.
+SUM_ORDER = [0, 1, 3, 2]
+
+# Special consensus symbols according to IUPAC and "X"
+SPECIAL_CHARS = "mrwsykvhdbx"
+
+
+def isAvailable():
+    """Returns True, if NumPy could be imported."""
+    return np is not None
+
+
+def roundArray(values, ndigits):
+    """Rounds an array like the builtin round(), meaning half away from zero on the decimal value of the float.
+    np.round() rounds half to even on the scaled value, so the (rare) values close to a tie are rounded one by one."""
+    scale = 10 ** ndigits
+    scaled = values * scale
+    rounded = np.rint(scaled) / scale
+    ties = np.nonzero(np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6)
+    for index in zip(*ties):
+        rounded[index] = round(float(values[index]), ndigits)
+    return rounded
+
+
+def loadNuccounts(file_name):
+    """Reads a nuccounts file into arrays. Header lines of the fragments (">tid") are skipped.
+    Returns the positions (strings as in the file or integers), the counts of A, C, G, T (n x 4), the consensus and
+    the target nucleotides (lower case)."""
+
+    if nanopipe_nuccounts.isBinary(file_name):
+        nuccounts = nanopipe_nuccounts.NuccountsFile(file_name)
+        if not len(nuccounts):
+            return None
+        return (nuccounts.positions, nuccounts.counts, np.char.lower(nuccounts.consensus),
+                np.char.lower(nuccounts.target))
+
+    with nanopipe_nuccounts.openNuccounts(file_name) as alignment_file:
+        lines = [line for line in alignment_file if line[0] != ">"]
+
+    if not lines:
+        return None
+
+    col_count = len(lines[0].split("\t"))
+    table = np.array("".join(lines).split(), dtype=str).reshape(-1, col_count)
+
+    positions = table[:, 0]
+    counts = table[:, 1:5].astype(np.int64)
+    consensus = np.char.lower(table[:, 5])
+    target = np.char.lower(table[:, 6])
+
+    return positions, counts, consensus, target
+
+
+def iterNuccounts(file_name, chunk_size):
+    """Yields the arrays of loadNuccounts() for chunks of at most chunk_size positions of a nuccounts file, so a file
+    is called with a bounded amount of memory."""
+
+    if nanopipe_nuccounts.isBinary(file_name):
+        nuccounts = nanopipe_nuccounts.NuccountsFile(file_name)
+        try:
+            for start in range(0, len(nuccounts), chunk_size):
+                stop = start + chunk_size
+                yield (np.array(nuccounts.positions[start:stop]), np.array(nuccounts.counts[start:stop]),
+                       np.char.lower(nuccounts.consensus[start:stop]), np.char.lower(nuccounts.target[start:stop]))
+        finally:
+            nuccounts.close()
+        return
+
+    with nanopipe_nuccounts.openNuccounts(file_name) as alignment_file:
+        lines = (line for line in alignment_file if line[0] != ">")
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            col_count = len(chunk[0].split("\t"))
+            table = np.array("".join(chunk).split(), dtype=str).reshape(-1, col_count)
+            yield table[:, 0], table[:, 1:5].astype(np.int64), np.char.lower(table[:, 5]), np.char.lower(table[:, 6])
+
+
+def restrictCounts(data, regions):
+    """Returns the arrays of loadNuccounts() for the positions in the regions (see nanopipe_bed.py) or None, if
+    no position is left."""
+
+    if data is None:
+        return None
+    mask = regions.mask(data[0])
+    if not mask.any():
+        return None
+    return tuple([column[mask] for column in data])
+
+
+def callNuccounts(file_name, target_threshold, poly_threshold, tt_ratio, regions=None):
+    """Calls the polymorphisms of one nuccounts file. Returns (print_dict, cover_dict, raw_cov_dict) like the
+    per line calling. As all positions are evaluated at once, cover_dict only holds the highest coverage of the
+    file and the coverages of the polymorphic positions, which is sufficient for the coverage cutoff. With
+    regions only the positions in the regions are called."""
+
+    data = loadNuccounts(file_name)
+    if regions is not None:
+        data = restrictCounts(data, regions)
+    return callCounts(data, target_threshold, poly_threshold, tt_ratio)
+
+
+def callCounts(data, target_threshold, poly_threshold, tt_ratio):
+    """Calls the polymorphisms of the arrays of loadNuccounts() like callNuccounts(). The arrays are not changed,
+    so they can be called with several parameter sets."""
+
+    print_dict = {}
+    cover_dict = {}
+    raw_cov_dict = {}
+
+    if data is None:
+        return print_dict, cover_dict, raw_cov_dict
+    positions, counts, consensus, target = data
+
+    # Total amount of nucleotides per position
+    total_nuc = counts.sum(axis=1)
+    cover_dict[int(total_nuc.max())] = []
+
+    # Index of the target nucleotide, -1 for non-DNA characters
+    target_index = np.full(len(target), -1, dtype=np.int64)
+    for index, nuc in enumerate(NUCS):
+        target_index[target == nuc] = index
+    isDNA = target_index >= 0
+
+    # SNP is accepted if: (1) target nuc <= 0.8 [isPoly]; (2) one other nuc >= 0.2 [poly_threshold]
+    ## Special consensus symbols pass (1) automatically. A non-DNA target can't be weighted and is skipped.
+    isSpecial = np.in1d(consensus, list(SPECIAL_CHARS))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_target = counts[np.arange(len(counts)), np.where(isDNA, target_index, 0)] / total_nuc
+        isPoly = isDNA & (consensus != "-") & (consensus != "n") & (isSpecial | (rel_target <= target_threshold))
+
+    rows = np.nonzero(isPoly)[0]
+    if not len(rows):
+        return print_dict, cover_dict, raw_cov_dict
+
+    # Check for condition (2)
+    rel_nuc = roundArray(counts[rows] / total_nuc[rows][:, None].astype(np.float64), 3)
+    isPass = rel_nuc >= poly_threshold
+
+    # Score for mutation of target to query nucleotide, based on p(transition) = tt_ratio * p(transversion)
+    nuc_index = np.arange(4)
+    distance = nuc_index[None, :] - target_index[rows][:, None]
+    score = np.where(distance % 2 == 0, tt_ratio, 1)
+    score[distance == 0] = 0
+
+    # Give weight to the relative occurence of a nuc, rescale weighted rel. occurences to 1
+    weighted = np.where(isPass, rel_nuc * score, 0.0)
+    weight_factor = np.zeros(len(rows))
+    for index in SUM_ORDER:
+        weight_factor = weight_factor + weighted[:, index]
+
+    isCalled = isPass.any(axis=1) & (weight_factor != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        resc_prob = roundArray(weighted / weight_factor[:, None], 3)
+
+    for k in np.nonzero(isCalled)[0]:
+        row = rows[k]
+        pos_start = str(positions[row])
+
+        print_list = []
+        for index in range(4):
+            if isPass[k, index] and resc_prob[k, index] > 0:
+                print_list.append(str(float(resc_prob[k, index])) + "\t")
+            else:
+                print_list.append("-\t")
+        print_list.append(str(target[row]) + "\t")
+        print_list.append("\n")
+        print_dict[pos_start] = print_list
+
+        raw_cov_dict[pos_start] = dict(zip(NUCS, [int(count) for count in counts[row]]))
+
+        coverage = int(total_nuc[row])
+        if coverage in cover_dict:
+            cover_dict[coverage].append(pos_start)
+        else:
+            cover_dict[coverage] = [pos_start]
+
+    return print_dict, cover_dict, raw_cov_dict
@@ -0,0 +1,317 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Local variant database built from a VCF file, for the annotation of the SNPs of any organism without network
+access. The VCF file is converted once into a directory with one store per chromosome (<chr>.vdb): the sorted
+positions as uint32 array, the offsets into a table of the variants (ID, reference and alternative alleles), an
+optional Bloom filter of the positions and the table. The stores are memory-mapped; the SNPs of a target are
+looked up in sorted order as a merge with the positions, the Bloom filter skips most SNPs without a variant before
+the positions are searched. Chromosome names lose "chr" like in calc.tidmap. Only SNVs are taken from the VCF.
+
+Build the database (plain or gzip compressed VCF, sorted by chromosome and position):
+
+    nanopipe_vcfdb.py variants.vcf.gz /path/to/vcfdb [-bloom bits per variant]"""
+
+
+import sys
+import os
+import gzip
+import math
+import mmap
+import array
+import struct
+import bisect
+
+import nanopipe_plasmodb
+
+
+# Header of the store files: magic, version, number of variants, bits and hash functions of the Bloom filter
+MAGIC = b"NPVCFVDB"
+VERSION = 1
+HEADER = struct.Struct("<8sIIII")
+
+# Extension of the store files
+STORE_EXT = ".vdb"
+
+# Default bits per variant of the Bloom filter (about 1% false positives), 0: no filter
+BLOOM_BITS = 10
+
+# Variants buffered before they are written to the temporary files of a store
+BUFFER_SIZE = 65536
+
+# Nucleotides of the SNVs
+NUCS = set(["A", "C", "G", "T"])
+
+# Already opened stores: path -> VariantStore
+store_cache = {}
+
+
+def getBloomBits(pos, bits, hashes):
+    """Returns the bits of the Bloom filter for a position (double hashing)."""
+    h1 = (pos * 0x9E3779B1) & 0xFFFFFFFF
+    h2 = ((pos * 0x85EBCA77) & 0xFFFFFFFF) | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class VariantStore(object):
+
+    """The variants of one chromosome on a memory-mapped store file: sorted positions, the offsets of their rows
+    in the table and the Bloom filter (bloom_bits == 0: no filter)."""
+
+    def __init__(self, mapped, positions, offsets, table_start, bloom_start=0, bloom_bits=0, bloom_hashes=0):
+        self.mapped = mapped
+        self.positions = positions
+        self.offsets = offsets
+        self.table_start = table_start
+        self.bloom_start = bloom_start
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+
+    def __len__(self):
+        return len(self.positions)
+
+    def mayContain(self, pos):
+        """Returns False, if the position has no variant for sure."""
+        if not self.bloom_bits:
+            return True
+        for bit in getBloomBits(pos, self.bloom_bits, self.bloom_hashes):
+            byte = self.mapped[self.bloom_start + (bit >> 3)]
+            if not isinstance(byte, int):
+                byte = ord(byte)
+            if not byte & (1 << (bit & 7)):
+                return False
+        return True
+
+    def row(self, index):
+        """Returns the row at index as tuple (ID, REF, ALT)."""
+        line = self.mapped[self.table_start + self.offsets[index]:self.table_start + self.offsets[index + 1]]
+        if not isinstance(line, str):
+            line = line.decode("ascii")
+        return tuple(line.rstrip("\n").split("\t"))
+
+    def lookup(self, positions):
+        """Returns all rows for the given positions (int) as dictionary: position -> [row, ...]. The positions are
+        walked in sorted order, every search starts at the index of the former position. The rows of a position
+        keep the order of the VCF file."""
+
+        result = {}
+        count = len(self.positions)
+        index = 0
+        for pos in sorted(positions):
+            if not self.mayContain(pos):
+                continue
+            index = bisect.bisect_left(self.positions, pos, index)
+            while index < count and self.positions[index] == pos:
+                if pos in result:
+                    result[pos].append(self.row(index))
+                else:
+                    result[pos] = [self.row(index)]
+                index += 1
+        return result
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class StoreWriter(object):
+
+    """Writes the store of one chromosome. The variants are appended in position order to temporary files, which
+    are joined with the header and the Bloom filter by close()."""
+
+    def __init__(self, store_file, bits_per_variant=BLOOM_BITS):
+        self.store_file = store_file
+        self.bits_per_variant = bits_per_variant
+        self.count = 0
+        self.last_pos = 0
+        self.table_size = 0
+        self.positions = array.array("I")
+        self.offsets = array.array("I", [0])
+        self.table = []
+        self.files = dict([(part, open(store_file + "." + part + ".tmp", "wb")) for part in ["pos", "off", "tab"]])
+
+    def add(self, pos, row):
+        """Appends a variant, row is the tuple (ID, REF, ALT)."""
+
+        if pos < self.last_pos:
+            raise ValueError("VCF not sorted by position: %s, %d" % (os.path.basename(self.store_file), pos))
+        line = ("\t".join(row) + "\n").encode("ascii")
+        self.table_size += len(line)
+        self.positions.append(pos)
+        self.offsets.append(self.table_size)
+        self.table.append(line)
+        self.last_pos = pos
+        self.count += 1
+        if len(self.positions) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        for part, data in [("pos", self.positions), ("off", self.offsets)]:
+            if sys.byteorder == "big":
+                data.byteswap()
+            data.tofile(self.files[part])
+        self.files["tab"].write(b"".join(self.table))
+        self.positions = array.array("I")
+        self.offsets = array.array("I")
+        self.table = []
+
+    def getBloom(self):
+        """Returns the Bloom filter of the written positions, the number of bits and of hash functions."""
+
+        if not self.bits_per_variant or not self.count:
+            return b"", 0, 0
+        bits = (self.count * self.bits_per_variant + 7) // 8 * 8
+        hashes = max(1, int(round(self.bits_per_variant * math.log(2))))
+        bloom = bytearray(bits // 8)
+        with open(self.store_file + ".pos.tmp", "rb") as f:
+            while True:
+                positions = array.array("I")
+                try:
+                    positions.fromfile(f, BUFFER_SIZE)
+                except EOFError:
+                    pass
+                if not positions:
+                    break
+                if sys.byteorder == "big":
+                    positions.byteswap()
+                for pos in positions:
+                    for bit in getBloomBits(pos, bits, hashes):
+                        bloom[bit >> 3] |= 1 << (bit & 7)
+        return bytes(bloom), bits, hashes
+
+    def close(self):
+        """Writes the store file and removes the temporary files. Returns the number of variants."""
+
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        bloom, bits, hashes = self.getBloom()
+
+        tmp_file = self.store_file + ".tmp"
+        with open(tmp_file, "wb") as out:
+            out.write(HEADER.pack(MAGIC, VERSION, self.count, bits, hashes))
+            for part in ["pos", "off"]:
+                with open(self.store_file + "." + part + ".tmp", "rb") as f:
+                    copyFile(f, out)
+            out.write(bloom)
+            with open(self.store_file + ".tab.tmp", "rb") as f:
+                copyFile(f, out)
+        for part in self.files:
+            os.remove(self.store_file + "." + part + ".tmp")
+        os.rename(tmp_file, self.store_file)
+
+        return self.count
+
+
+def copyFile(source, target, block_size=1 << 20):
+    block = source.read(block_size)
+    while block:
+        target.write(block)
+        block = source.read(block_size)
+
+
+def readVCF(vcf_file):
+    """Yields the SNVs of a VCF file as (chromosome without "chr", position, (ID, REF, ALT)). Alternative alleles,
+    which are not a single nucleotide, are dropped; records without any SNV are skipped."""
+
+    opener = gzip.open if vcf_file.endswith(".gz") else open
+    with opener(vcf_file, "rb") as vcf:
+        for line in vcf:
+            if not isinstance(line, str):
+                line = line.decode("ascii")
+            if line.startswith("#"):
+                continue
+            line_data = line.rstrip("\n").split("\t")
+            if len(line_data) < 5:
+                continue
+            ref = line_data[3].upper()
+            alts = [alt for alt in line_data[4].upper().split(",") if alt in NUCS and alt != ref]
+            if ref not in NUCS or not alts:
+                continue
+            yield line_data[0].replace("chr", ""), int(line_data[1]), (line_data[2], ref, ",".join(alts))
+
+
+def buildDB(vcf_file, db_dir, bits_per_variant=BLOOM_BITS):
+    """Converts a VCF file into a store per chromosome in db_dir. Returns a dictionary: chromosome -> number of
+    variants. The records of a chromosome have to be sorted by position and must not be split up."""
+
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+
+    counts = {}
+    writer = None
+    chr = None
+    for vcf_chr, pos, row in readVCF(vcf_file):
+        if vcf_chr != chr:
+            if writer is not None:
+                counts[chr] = writer.close()
+            if vcf_chr in counts:
+                raise ValueError("VCF not sorted by chromosome: %s" % vcf_chr)
+            chr = vcf_chr
+            writer = StoreWriter(os.path.join(db_dir, chr + STORE_EXT), bits_per_variant)
+        writer.add(pos, row)
+    if writer is not None:
+        counts[chr] = writer.close()
+
+    return counts
+
+
+def openStore(store_file):
+    """Memory-maps a store file and returns a VariantStore."""
+
+    with open(store_file, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, count, bits, hashes = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION:
+        mapped.close()
+        raise ValueError("Not a valid VCF store: %s" % store_file)
+
+    positions = nanopipe_plasmodb.MappedArray(mapped, HEADER.size, count)
+    offsets = nanopipe_plasmodb.MappedArray(mapped, HEADER.size + count * 4, count + 1)
+    bloom_start = HEADER.size + count * 4 + (count + 1) * 4
+
+    return VariantStore(mapped, positions, offsets, bloom_start + bits // 8, bloom_start, bits, hashes)
+
+
+def hasTarget(db_dir, chr_numb):
+    """Returns True, if the database has a store for the chromosome/transcriptome ID."""
+    return os.path.isfile(os.path.join(db_dir, chr_numb.replace("chr", "") + STORE_EXT))
+
+
+def loadStore(db_dir, chr_numb):
+    """Returns the VariantStore of a chromosome. Stores are cached for further lookups."""
+
+    path = os.path.join(db_dir, chr_numb.replace("chr", "") + STORE_EXT)
+    if path not in store_cache:
+        store_cache[path] = openStore(path)
+    return store_cache[path]
+
+
+def lookup(db_dir, chr_numb, snp_list):
+    """Checks candidate SNP positions (strings) in the VCF database. Returns a dictionary:
+    outdict[snp]=[(ID, [REF, ALT, ...])]"""
+
+    outdict = {}
+    store = loadStore(db_dir, chr_numb)
+    snp_dict = dict([(int(snp), snp) for snp in snp_list])
+    for pos, rows in store.lookup(snp_dict.keys()).items():
+        outdict[snp_dict[pos]] = [(vcf_ID, [ref] + alt.split(",")) for vcf_ID, ref, alt in rows]
+    return outdict
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: %s variants.vcf[.gz] vcfdb_directory [-bloom bits per variant]\n" %
+                         os.path.basename(sys.argv[0]))
+        sys.exit(1)
+
+    bits_per_variant = BLOOM_BITS
+    if "-bloom" in sys.argv:
+        bits_per_variant = int(sys.argv[sys.argv.index("-bloom") + 1])
+
+    counts = buildDB(sys.argv[1], sys.argv[2], bits_per_variant)
+    for chr in sorted(counts):
+        sys.stdout.write("%s: %d variants\n" % (chr, counts[chr]))
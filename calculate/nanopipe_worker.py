@@ -0,0 +1,225 @@
+#!/bin/sh
+''''exec python -u -- "$0" ${1+"$@"} # '''
+# vi: syntax=python
+
+"""Resident worker for the polymorphism step (nanopipe_calc_polymorphism.py).
+The worker imports the modules and loads the PlasmoDB indices once, then takes jobs from a spool directory. A job
+is a file <id>.job with the run directory in the first line and the arguments of nanopipe_calc_polymorphism.py in
+the second line. The worker claims a job by renaming it to <id>.run and runs the script in a forked process in
+the run directory, so the loaded databases are shared and the .poly files are the same as of a separate process.
+The output of the script is written to <id>.out and <id>.err, the exit status to <id>.done. The process ID of
+the worker is kept in worker.pid in the spool directory.
+
+Start the worker:
+
+    nanopipe_worker.py spool_directory [-d SNPdbPlasf] [-j jobs] [-poll seconds]"""
+
+
+import sys
+import os
+import time
+import shlex
+import signal
+import runpy
+import traceback
+
+# Imported once for all jobs
+import nanopipe_dbsnp
+import nanopipe_plasmodb
+import nanopipe_qualreg
+import nanopipe_snpcall
+import nanopipe_vcfdb
+
+
+USAGE = """Usage: nanopipe_worker.py spool_directory [-d SNPdbPlasf] [-j jobs] [-poll seconds]
+"""
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nanopipe_calc_polymorphism.py")
+
+# Files in the spool directory
+PID_FILE = "worker.pid"
+JOB_EXT = ".job"
+RUN_EXT = ".run"
+DONE_EXT = ".done"
+OUT_EXT = ".out"
+ERR_EXT = ".err"
+
+# Default number of parallel jobs and seconds between looking for new jobs
+JOBS = 2
+POLL = 1.0
+
+
+def getDBVersions(db_dir):
+    """Returns the versions (size and modification time) of the files of the PlasmoDB database."""
+
+    versions = {}
+    if db_dir and os.path.isdir(db_dir):
+        for file_name in os.listdir(db_dir):
+            stat = os.stat(os.path.join(db_dir, file_name))
+            versions[file_name] = (stat.st_size, stat.st_mtime)
+    return versions
+
+
+def loadDB(db_dir):
+    """Loads the indices of all chromosomes of the PlasmoDB database into the cache of nanopipe_plasmodb. Returns
+    the number of loaded chromosomes."""
+
+    nanopipe_plasmodb.index_cache.clear()
+    count = 0
+    if db_dir and os.path.isdir(db_dir):
+        for file_name in sorted(os.listdir(db_dir)):
+            if file_name.endswith(".txt"):
+                nanopipe_plasmodb.loadIndex(db_dir, file_name[:-4])
+                count += 1
+    return count
+
+
+def readJob(job_file):
+    """Returns the run directory and the arguments of a job file."""
+
+    with open(job_file, "r") as f:
+        lines = f.read().split("\n")
+    return lines[0], shlex.split(lines[1] if len(lines) > 1 else "")
+
+
+def runJob(job, run_dir, args):
+    """Runs nanopipe_calc_polymorphism.py in a forked process. Returns the process ID."""
+
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # Child: a SIGTERM ends the job by the signal, not by the handler of the worker (a successful exit)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Output to the spool directory, the script runs in the run directory
+    status = 1
+    try:
+        out = os.open(job + OUT_EXT, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        err = os.open(job + ERR_EXT, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(out, 1)
+        os.dup2(err, 2)
+        os.close(out)
+        os.close(err)
+
+        os.chdir(run_dir)
+        sys.argv = [SCRIPT] + args
+        try:
+            runpy.run_path(SCRIPT, run_name="__main__")
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def finishJob(job, status):
+    """Writes the exit status of a job and removes the claimed job file."""
+
+    with open(job + DONE_EXT + ".tmp", "w") as f:
+        f.write("%d\n" % status)
+    os.rename(job + DONE_EXT + ".tmp", job + DONE_EXT)
+    if os.path.exists(job + RUN_EXT):
+        os.remove(job + RUN_EXT)
+
+
+def claimJob(spool_dir):
+    """Claims the oldest job of the spool directory. Returns the path of the job without extension or None."""
+
+    for file_name in sorted(os.listdir(spool_dir)):
+        if file_name.endswith(JOB_EXT):
+            job = os.path.join(spool_dir, file_name[:-len(JOB_EXT)])
+            try:
+                os.rename(job + JOB_EXT, job + RUN_EXT)
+            except OSError:
+                # Claimed by another worker or withdrawn
+                continue
+            return job
+    return None
+
+
+def serve(spool_dir, db_dir=None, jobs=JOBS, poll=POLL):
+    """Takes the jobs from the spool directory and runs up to jobs of them in parallel, until the worker is
+    terminated."""
+
+    sys.stdout.write("PlasmoDB: %d chromosome(s) loaded\n" % loadDB(db_dir))
+    db_versions = getDBVersions(db_dir)
+    running = {}
+
+    while True:
+        # Finished jobs
+        while running:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            job = running.pop(pid)
+            # A job ended by a signal failed: 128 + signal like the shell
+            status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+            finishJob(job, status)
+            sys.stdout.write("%s: finished (%d)\n" % (os.path.basename(job), status))
+
+        job = claimJob(spool_dir) if len(running) < jobs else None
+        if job is None:
+            time.sleep(poll)
+            continue
+
+        # Reload the database after an update
+        versions = getDBVersions(db_dir)
+        if versions != db_versions:
+            sys.stdout.write("PlasmoDB: %d chromosome(s) reloaded\n" % loadDB(db_dir))
+            db_versions = versions
+
+        try:
+            run_dir, args = readJob(job + RUN_EXT)
+        except (IOError, ValueError) as e:
+            sys.stdout.write("%s: invalid job (%s)\n" % (os.path.basename(job), e))
+            finishJob(job, 1)
+            continue
+        running[runJob(job, run_dir, args)] = job
+        sys.stdout.write("%s: %s %s\n" % (os.path.basename(job), run_dir, " ".join(args)))
+
+
+def getOption(arg_list, option, default, convert=str):
+    """Returns the value following option in the command line arguments, converted by convert."""
+    if option in arg_list:
+        try:
+            return convert(arg_list[arg_list.index(option) + 1])
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+def stop(signum, frame):
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    arg_list = sys.argv[1:]
+    if not arg_list or arg_list[0].startswith("-"):
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    spool_dir = arg_list[0]
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir)
+    pid_file = os.path.join(spool_dir, PID_FILE)
+    with open(pid_file, "w") as f:
+        f.write("%d\n" % os.getpid())
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        serve(spool_dir, getOption(arg_list, "-d", None), getOption(arg_list, "-j", JOBS, int),
+              getOption(arg_list, "-poll", POLL, float))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(pid_file)
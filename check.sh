@@ -8,7 +8,7 @@ PERL=`which perl`
 if [ "$PERL" = "" ]; then
 	echo "Missing perl interpreter"
 else
-	for MODULE in File::Basename File::Copy File::Path Getopt::Long Time::HiRes JSON::Tiny Proc::ProcessTable File::Touch; do
+	for MODULE in File::Basename File::Copy File::Path Getopt::Long Time::HiRes Proc::ProcessTable File::Touch; do
 		$PERL -M$MODULE -e 'exit' 2>/dev/null
 		if [ "$?" != 0 ]; then
 			echo "Missing perl modul $MODULE"
@@ -6,9 +6,9 @@
 # ========================================================================
 #
 
-if [ $# != 2 ]; then
+if [ $# != 2 ] && [ $# != 3 ]; then
 	cat <<EOF
-Usage: $0 targetname fastafile
+Usage: $0 targetname fastafile [vcffile]
 EOF
 	exit 0
 fi
@@ -17,9 +17,11 @@ PWD=`pwd`
 
 TARGET=$1
 FASTA=$2
+VCF=$3
 
 [ "$NANOPIPE" = "" ] && echo "Please set environment variable NANOPIPE!" && exit 1
 [ ! -f "$FASTA" ] && echo "Cannot find fasta file $FASTA!" && exit 1
+[ "$VCF" != "" ] && [ ! -f "$VCF" ] && echo "Cannot find vcf file $VCF!" && exit 1
 [ ! -d $NANOPIPE/targets ] && echo "Missing $NANOPIPE/targets directory!" && exit 1
 [ -d $NANOPIPE/targets/$TARGET ] && echo "Target $TARGET exists already!" && exit 1
 
@@ -34,4 +36,10 @@ cd $NANOPIPE/targets/$TARGET
 $NANOPIPE/tools/bin/lastdb target target.fasta
 cd -
 
+if [ "$VCF" != "" ]; then
+	echo "Create variant database..."
+	$NANOPIPE/calculate/nanopipe_vcfdb.py $VCF $NANOPIPE/targets/$TARGET/vcfdb
+	echo "Set annotation=vcf in the [polymorphism] section of the target config to use it."
+fi
+
 echo "Target $TARGET is created."
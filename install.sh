@@ -38,6 +38,12 @@ rm $FILE.tmp
 
 chmod a+x calculate/*
 
+# ------------------------------------------------------------------------
+# Compile the index of the local PlasmoDB database
+# ------------------------------------------------------------------------
+
+calculate/nanopipe_plasmodb.py SNPdbPlasf
+
 # ========================================================================
 # Install tools
 # ========================================================================
@@ -146,7 +152,6 @@ if [ "$ANSWER" = "Y" ]; then
 	sudo perl -MCPAN -e "install File::Path"
 	sudo perl -MCPAN -e "install Getopt::Long"
 	sudo perl -MCPAN -e "install Time::HiRes"
-	sudo perl -MCPAN -e "install JSON::Tiny"
 	sudo perl -MCPAN -e "install Proc::ProcessTable"
 	sudo perl -MCPAN -e "install File::Touch"
 fi
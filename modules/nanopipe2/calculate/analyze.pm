@@ -6,6 +6,9 @@ package nanopipe2::calculate::analyze;
 # (locations / hot spots) of target alignments.
 #
 # Changes
+# [2026-10-17] Optional array-backed pileup engine (nanopipe_pileup.py)
+# [2026-10-17] Manifest of the finished targets for the overlapped mode
+# [2026-10-17] Optional binary nucleotid count files
 # [2018-01-10] Act with vec
 # [2018-01-09] Count gaps
 # [2018-01-09] Add highest score
@@ -49,6 +52,10 @@ my $CELLCOUNT = 6;
 # The size of the second (inner) block
 my $BLOCKBYTES = $BLOCKSIZE * $CELLCOUNT * $BYTESIZE;
 
+# The header of the binary nucleotid count files
+my $BINARYMAGIC   = "NPNUCBIN";
+my $BINARYVERSION = 1;
+
 # The index for every nuceotid, mapping nuc -> index
 my %NUCINDEX = ("A" => 0, "C" => 1, "G" => 2, "T" => 3, "-" => 4);
 
@@ -122,6 +129,19 @@ my $equal = 0.8;
 # Take highest score?
 my $hscore;
 
+# The format of the nucleotid count files: text, binary or both
+my $nuccounts = "text";
+
+# The manifest file: a line "tid<TAB>tidcount" is appended, when the
+# files of a tid are written, and "#end" after the last tid ("#error",
+# if the pileup engine failed; empty: no manifest)
+my $manifest;
+
+# The engine counting the nucleotids and saving the output: perl (vec
+# blocks) or numpy (arrays in nanopipe_pileup.py, reads the maf file
+# again)
+my $engine = "perl";
+
 # ------------------------------------------------------------------------
 # Runtime
 # ------------------------------------------------------------------------
@@ -129,6 +149,13 @@ my $hscore;
 my $newtid   = 1;
 my $tidcount = 0;
 
+# Write text and/or binary nucleotid count files
+my ($savetext, $savebinary) = (1, 0);
+
+# The tid and the fragments (binary columns) of the binary file
+my $bintid;
+my @binfragments;
+
 my $metagenomics;
 
 # ------------------------------------------------------------------------
@@ -278,7 +305,7 @@ sub analyze {
 			elsif ($index == 3) {
 				my @a = split(/\s+/, $line);
 				if (!$metagenomics) {
-					add($tid, $tstart, $tseq, $a[6]) if ($tid);
+					add($tid, $tstart, $tseq, $a[6]) if ($tid && $engine ne "numpy");
 				}
 
 				# Set target counts (per target and query id)
@@ -350,7 +377,7 @@ sub saveNuccountsHelp {
 	print "==> Save Nucleotid Counts Helper\n";
 	my $starttime = time;
 
-	my @files = <$NUCCOUNTSFILE.*>;
+	my @files = grep {m/\.\d+$/} <$NUCCOUNTSFILE.*>;
 	for my $file (@files) {
 		open(NUCCOUNTS,     "<", $file);
 		open(NUCCOUNTSHELP, ">", "$file.help");
@@ -414,14 +441,12 @@ sub saveFragment {
 	return if ($l < $minlen || int($n * 100.0 / $l) > $maxN);
 
 	if ($newtid) {
-		if ($tidcount > 0) {
-			close(CONSENSUS);
-			close(NUCCOUNTS);
-		}
+		closeNuccounts() if ($tidcount > 0);
 		$tidcount++;
 		print TIDMAP qq($tid\t$tidcount\n);
-		open(NUCCOUNTS, ">", "$NUCCOUNTSFILE.$tidcount");
+		open(NUCCOUNTS, ">", "$NUCCOUNTSFILE.$tidcount") if ($savetext);
 		open(CONSENSUS, ">", "$CONSENSUSFILE.$tidcount");
+		$bintid = $tid;
 		$newtid = 0;
 	}
 
@@ -432,8 +457,68 @@ sub saveFragment {
 	print CONSENSUS qq(>$tid ($start1:$end1)\n);
 	print CONSENSUS $_[3], qq(\n);
 
-	print NUCCOUNTS qq(>$tid\n);
-	print NUCCOUNTS $_[4];
+	if ($savetext) {
+		print NUCCOUNTS qq(>$tid\n);
+		print NUCCOUNTS $_[4];
+	}
+	push(@binfragments, [@{$_[5]}]) if ($savebinary);
+}
+
+#
+# ------------------------------------------------------------------------
+# Append a row to the binary columns: position, counts of ACGT-,
+# consensus and target nucleotid
+# ------------------------------------------------------------------------
+#
+sub addBinaryRow {
+	my ($columns, @row) = @_;
+
+	for (my $i = 0 ; $i < 6 ; $i++) {
+		$columns->[$i] .= pack("V", $row[$i]);
+	}
+	$columns->[6] .= $row[6];
+	$columns->[7] .= $row[7];
+}
+
+#
+# ------------------------------------------------------------------------
+# Save the binary nucleotid count file of the current tid.
+#
+# Layout (little endian): header (magic, version, number of fragments,
+# number of rows, length of the tid), tid (padded to 4 bytes), row
+# offsets of the fragments (uint32), the uint32 columns position, A, C,
+# G, T and gaps and the byte columns consensus and target nucleotid.
+# ------------------------------------------------------------------------
+#
+sub saveBinary {
+	my @offsets = (0);
+	my @columns = ("") x 8;
+	for my $fragment (@binfragments) {
+		push(@offsets, $offsets[-1] + length($fragment->[6]));
+		map {$columns[$_] .= $fragment->[$_]} (0 .. 7);
+	}
+
+	my $padding = "\0" x ((4 - length($bintid) % 4) % 4);
+
+	open(BINARY, ">", "$NUCCOUNTSFILE.$tidcount.bin");
+	binmode(BINARY);
+	print BINARY pack("a8VVVV", $BINARYMAGIC, $BINARYVERSION, scalar(@binfragments), $offsets[-1], length($bintid));
+	print BINARY $bintid, $padding, pack("V*", @offsets), @columns;
+	close(BINARY);
+
+	@binfragments = ();
+}
+
+#
+# ------------------------------------------------------------------------
+# Close the output files of the current tid
+# ------------------------------------------------------------------------
+#
+sub closeNuccounts {
+	close(CONSENSUS);
+	close(NUCCOUNTS) if ($savetext);
+	saveBinary()     if ($savebinary);
+	print MANIFEST qq($bintid\t$tidcount\n) if ($manifest);
 }
 
 #
@@ -455,6 +540,7 @@ sub saveData {
 		$newtid = 1;
 
 		my ($start, $stop, $gap, $consseq, $consseqtmp, $nuccount, $nuccounttmp) = (-1, -1, 0, "", "", "", "");
+		my (@bincolumns, @bincolumnstmp);
 
 		my @a = @{$nuccountsdata{$tid}};
 		for (my $i = 0 ; $i < @a ; $i++) {
@@ -502,10 +588,12 @@ sub saveData {
 
 				# If the gap is too wide: the sequence is at end
 				if ($gap > $maxgap) {
-					saveFragment($tid, $start, $stop, $consseq, $nuccount);
+					saveFragment($tid, $start, $stop, $consseq, $nuccount, \@bincolumns);
 
 					# Initialize to enable start again
 					($start, $stop, $consseq, $consseqtmp, $nuccount, $nuccounttmp) = (-1, -1, "", "", "", "");
+					@bincolumns    = ();
+					@bincolumnstmp = ();
 				}
 
 				# We are still in the sequence
@@ -515,9 +603,18 @@ sub saveData {
 						my $pos1 = $pos + 1;
 						$consseq  .= $consseqtmp  if ($consseqtmp);
 						$consseq  .= $cons;
-						$nuccount .= $nuccounttmp if ($nuccounttmp);
-						$nuccount .= qq($pos1\t$A\t$C\t$G\t$T\t$cons\t$tnuc\t$qgaps\n);
+						if ($savetext) {
+							$nuccount .= $nuccounttmp if ($nuccounttmp);
+							$nuccount .= qq($pos1\t$A\t$C\t$G\t$T\t$cons\t$tnuc\t$qgaps\n);
+						}
+						if ($savebinary) {
+							if (@bincolumnstmp) {
+								map {$bincolumns[$_] .= $bincolumnstmp[$_]} (0 .. 7);
+							}
+							addBinaryRow(\@bincolumns, $pos1, $A, $C, $G, $T, $qgaps, $cons, $tnuc);
+						}
 						($consseqtmp, $nuccounttmp) = ("", "");
+						@bincolumnstmp = ();
 					}
 
 					# There is a gap: store in temporary
@@ -526,24 +623,47 @@ sub saveData {
 					else {
 						my $pos1 = $pos + 1;
 						$consseqtmp  .= $cons;
-						$nuccounttmp .= qq($pos1\t$A\t$C\t$G\t$T\t$cons\t$tnuc\t$qgaps\n);
+						$nuccounttmp .= qq($pos1\t$A\t$C\t$G\t$T\t$cons\t$tnuc\t$qgaps\n) if ($savetext);
+						addBinaryRow(\@bincolumnstmp, $pos1, $A, $C, $G, $T, $qgaps, $cons, $tnuc) if ($savebinary);
 					}
 				}
 			}
 		}
 
-		saveFragment($tid, $start, $stop, $consseq, $nuccount);
+		saveFragment($tid, $start, $stop, $consseq, $nuccount, \@bincolumns);
 	}
 
-	if ($tidcount > 0) {
-		close(CONSENSUS);
-		close(NUCCOUNTS);
-	}
+	closeNuccounts() if ($tidcount > 0);
 	close(TIDMAP);
 
 	print "Time: " . (time - $starttime) . " seconds\n";
 }
 
+#
+# ------------------------------------------------------------------------
+# Save the output with the array-backed pileup engine: the same files
+# as saveData (and the manifest) are written by nanopipe_pileup.py
+# ------------------------------------------------------------------------
+#
+sub pileup {
+	print "==> Pileup\n";
+	my $starttime = time;
+
+	my $command =
+	  qq($nanopipe2::paths::CALCDIR/nanopipe_pileup.py $LASTFILE -mincount $mincount -minlen $minlen -maxgap $maxgap)
+	  . qq( -maxN $maxN -equal $equal -maxmem $maxmem -nuccounts $nuccounts);
+	$command .= qq( -hscore)             if ($hscore);
+	$command .= qq( -manifest $manifest) if ($manifest);
+
+	my ($res, $error) = nanopipe2::utils::execute($command);
+	if ($res > 0 || $error) {
+		nanopipe2::utils::printError($command, $res, $error);
+		die qq(Pileup of $LASTFILE failed!\n) if ($res > 0);
+	}
+
+	print "Time: " . (time - $starttime) . " seconds\n";
+}
+
 #
 # ------------------------------------------------------------------------
 # Save a debuuging output from nuccountsdata
@@ -667,6 +787,20 @@ sub run {
 	setConfig($maxN,         $params->{maxN});
 	setConfig($equal,        $params->{equal});
 	setConfig($hscore,       $params->{hscore} eq "Y"       ? 1 : 0);
+	setConfig($nuccounts,    $params->{nuccounts});
+	setConfig($manifest,     $params->{manifest});
+	setConfig($engine,       $params->{engine});
+
+	$savetext   = $nuccounts ne "binary";
+	$savebinary = $nuccounts eq "binary" || $nuccounts eq "both";
+
+	# The pileup engine writes the manifest itself
+	my $pileup = $engine eq "numpy" && !$metagenomics;
+
+	if ($manifest && !$pileup) {
+		open(MANIFEST, ">", $manifest);
+		select((select(MANIFEST), $| = 1)[0]);
+	}
 
 	if ($hscore) {
 		fillScores();
@@ -676,9 +810,20 @@ sub run {
 	saveTargetCounts();
 	saveQueryLens();
 	if (!$metagenomics) {
-		saveData();
+		if ($pileup) {
+			pileup();
+		}
+		else {
+			saveData();
+			print MANIFEST qq(#end\n) if ($manifest);
+		}
 		saveNuccountsHelp();
 	}
+
+	if ($manifest && !$pileup) {
+		print MANIFEST qq(#end\n) if ($metagenomics);
+		close(MANIFEST);
+	}
 }
 
 1;
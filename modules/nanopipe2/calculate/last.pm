@@ -15,6 +15,7 @@ use nanopipe2::messages;
 my $LASTAL    = "$nanopipe2::paths::TOOLSDIR/bin/lastal";
 my $LASTDB    = "$nanopipe2::paths::TOOLSDIR/bin/lastdb";
 my $LASTSPLIT = "$nanopipe2::paths::TOOLSDIR/bin/last-split";
+my $MAFINDEX  = "$nanopipe2::paths::CALCDIR/nanopipe_mafindex.py";
 
 my $LASTPARAMSFILE    = qq(input.lastparams);
 my $QUERYFILE         = qq(input.query);
@@ -22,6 +23,7 @@ my $SUBSTMATRIXFILE   = qq(input.substmatrix);
 my $TARGETFILE_UPLOAD = qq(input.targetfile);
 
 my $LASTFILE        = qq(calc.lastalign.maf);
+my $LASTINDEXFILE   = qq(calc.lastalign.maf.idx);
 my $TARGETDB_UPLOAD = qq(calc.targetdb);
 
 my $targetdb;
@@ -34,6 +36,7 @@ my $metagenomics;
 my $query;
 my $target;
 my $threads;
+my $shards;
 my $lastparams;
 my $substmatrix;
 
@@ -155,38 +158,172 @@ sub setConfig {
 
 #
 # ------------------------------------------------------------------------
-# Execute lastal and last-split command to generate a maf/tab file.
+# Set the parameters and prepare the target database
 # ------------------------------------------------------------------------
 #
-sub run {
+sub init {
 	my ($params) = @_;
 
-	print "==> Align with last\n";
-
-	my $start = time;
-
 	setConfig($metagenomics, $params->{metagenomics} eq "Y");
 	setConfig($query,        $params->{query});
 	setConfig($target,       $params->{target});
 	setConfig($threads,      $params->{threads});
+	setConfig($shards,       $params->{shards});
 	setConfig($lastparams,   -f $LASTPARAMSFILE ? nanopipe2::utils::readFile($LASTPARAMSFILE) : $params->{params});
 	setConfig($substmatrix,  $params->{substmatrix});
 
 	$threads = 2 if (!$threads);
 	$threads = 4 if ($threads > 4);
+	$shards  = 1 if (!$shards || $shards < 1);
 
 	createMatrixfile();
 	initTargetdb();
+}
+
+#
+# ------------------------------------------------------------------------
+# Returns the command to align a query file with lastal and last-split
+# into a maf file
+# ------------------------------------------------------------------------
+#
+sub alignCommand {
+	my ($queryfile, $maffile) = @_;
 
 	my $p = {-P => $threads, -k => "2"};
 	$p->{-p} = $SUBSTMATRIXFILE if (-f $SUBSTMATRIXFILE);
-	$p->{-Q} = nanopipe2::utils::readPraefix($query, 1) eq ">" ? "0" : "1";
+	$p->{-Q} = nanopipe2::utils::readPraefix($queryfile, 1) eq ">" ? "0" : "1";
 	addParams($p, s2hash($lastparams));
 
 	my $splitcommand = $LASTSPLIT;
 	$splitcommand .= " -m1" if ($metagenomics);
 	$splitcommand .= " -m1 -n" if ($target =~ m/Human_transcriptome/);
-	my $command = "$LASTAL " . params2s($p) . " $targetdb $query | $splitcommand >$LASTFILE";
+	return "$LASTAL " . params2s($p) . " $targetdb $queryfile | $splitcommand >$maffile";
+}
+
+#
+# ------------------------------------------------------------------------
+# Split a query file (fasta or fastq) into at most count shard files
+# with about the same number of bases.  The sequences keep their order:
+# a shard holds the sequences following the ones of the shard before.
+# Returns the shard files.
+# ------------------------------------------------------------------------
+#
+sub splitQuery {
+	my ($queryfile, $prefix, $count) = @_;
+
+	my $fastq = nanopipe2::utils::readPraefix($queryfile, 1) ne ">";
+
+	# The total number of bases
+	my $total = 0;
+	my $index = 0;
+	open(IN, "<", $queryfile);
+	while (my $line = <IN>) {
+		$total += $line =~ tr/A-Za-z// if ($fastq ? $index == 1 : !($line =~ m/^>/));
+		$index = ($index + 1) % 4;
+	}
+	close(IN);
+
+	# A new shard is started with the first sequence after the bases of
+	# the former shards reached their share of the total
+	my @files;
+	my $bases = 0;
+	$index = 0;
+	open(IN, "<", $queryfile);
+	while (my $line = <IN>) {
+		if ($fastq ? $index == 0 : $line =~ m/^>/) {
+			if (!@files || ($bases >= $total * @files / $count && @files < $count)) {
+				close(OUT) if (@files);
+				push(@files, $prefix . @files . ".query");
+				open(OUT, ">", $files[-1]);
+			}
+		}
+		elsif (!$fastq || $index == 1) {
+			$bases += $line =~ tr/A-Za-z//;
+		}
+		print OUT $line if (@files);
+		$index = ($index + 1) % 4;
+	}
+	close(OUT) if (@files);
+	close(IN);
+
+	return @files;
+}
+
+#
+# ------------------------------------------------------------------------
+# Merge the maf files of the shards in their order: the header comments
+# of the first file, then the alignments of all files
+# ------------------------------------------------------------------------
+#
+sub mergeMAF {
+	my ($maffile, @maffiles) = @_;
+
+	open(OUT, ">", $maffile);
+	for (my $i = 0 ; $i < @maffiles ; $i++) {
+		my $header = $i == 0;
+		open(IN, "<", $maffiles[$i]);
+		while (my $line = <IN>) {
+			$header = 0 if (!($line =~ m/^#/));
+			print OUT $line if ($header || !($line =~ m/^#/));
+		}
+		close(IN);
+	}
+	close(OUT);
+}
+
+#
+# ------------------------------------------------------------------------
+# Align a query file into a maf file: with more than one shard the query
+# is split and the shards are aligned in parallel processes against the
+# same target database
+# ------------------------------------------------------------------------
+#
+sub align {
+	my ($queryfile, $maffile) = @_;
+
+	if ($shards < 2) {
+		my $command = alignCommand($queryfile, $maffile);
+		my ($res, $error) = nanopipe2::utils::execute($command);
+		if ($res > 0 || $error) {
+			nanopipe2::utils::printError($command, $res, $error);
+		}
+		return;
+	}
+
+	my @queryfiles = splitQuery($queryfile, qq($maffile.shard), $shards);
+	my @maffiles = map {my $file = $_; $file =~ s/\.query$/.maf/; $file} @queryfiles;
+	my @commands = map {alignCommand($queryfiles[$_], $maffiles[$_])} (0 .. $#queryfiles);
+	print "Shards: " . scalar(@queryfiles) . "\n";
+
+	my @results = nanopipe2::utils::executeParallel(@commands);
+	for (my $i = 0 ; $i < @results ; $i++) {
+		my ($res, $error) = @{$results[$i]};
+		if ($res > 0 || $error) {
+			nanopipe2::utils::printError($commands[$i], $res, $error);
+		}
+	}
+
+	mergeMAF($maffile, @maffiles);
+	unlink(@queryfiles, @maffiles);
+}
+
+#
+# ------------------------------------------------------------------------
+# Execute lastal and last-split command to generate a maf/tab file.
+# ------------------------------------------------------------------------
+#
+sub run {
+	my ($params) = @_;
+
+	print "==> Align with last\n";
+
+	my $start = time;
+
+	init($params);
+	align($query, $LASTFILE);
+
+	# Index the alignment blocks for region and quality lookups
+	my $command = qq($MAFINDEX $LASTFILE $LASTINDEXFILE);
 	my ($res, $error) = nanopipe2::utils::execute($command);
 	if ($res > 0 || $error) {
 		nanopipe2::utils::printError($command, $res, $error);
@@ -194,4 +331,23 @@ sub run {
 	print "Time: " . (time - $start) . " seconds\n";
 }
 
+#
+# ------------------------------------------------------------------------
+# Align a batch of reads of a live run into its own maf file (the maf
+# file of the run and its index are not changed)
+# ------------------------------------------------------------------------
+#
+sub runBatch {
+	my ($params, $maffile) = @_;
+
+	print "==> Align batch with last\n";
+
+	my $start = time;
+
+	init($params);
+	align($query, $maffile);
+
+	print "Time: " . (time - $start) . " seconds\n";
+}
+
 1;
@@ -8,7 +8,9 @@ package nanopipe2::utils;
 
 use strict;
 
+use Cwd;
 use Fcntl;
+use POSIX ();
 use Proc::ProcessTable;
 
 #
@@ -113,6 +115,114 @@ sub execute {
 	return ($res, $error);
 }
 
+#
+# ------------------------------------------------------------------------
+# Execute commands in parallel processes.  Every command has its own
+# error file.  Returns a list of [$res, $error] like execute in the
+# order of the commands.
+# ------------------------------------------------------------------------
+#
+sub executeParallel {
+	my (@commands) = @_;
+
+	my @pids = map {executeBackground($commands[$_], qq(calc.execute.error.$_))} (0 .. $#commands);
+
+	return map {[waitBackground($pids[$_], qq(calc.execute.error.$_))]} (0 .. $#pids);
+}
+
+#
+# ------------------------------------------------------------------------
+# Execute a command in a background process with its own error file.
+# Returns the process id for waitBackground.
+# ------------------------------------------------------------------------
+#
+sub executeBackground {
+	my ($command, $errorfile) = @_;
+
+	print qq(--> Execute: $command\n);
+	my $pid = fork();
+	die qq(Cannot fork: $!\n) if (!defined($pid));
+	if (!$pid) {
+		exec("$command 2>$errorfile");
+		POSIX::_exit(127);
+	}
+
+	return $pid;
+}
+
+#
+# ------------------------------------------------------------------------
+# Wait for a command started by executeBackground.  Returns ($res,
+# $error) like execute.
+# ------------------------------------------------------------------------
+#
+sub waitBackground {
+	my ($pid, $errorfile) = @_;
+
+	waitpid($pid, 0);
+	my $res   = $?;
+	my $error = readFile($errorfile) if ((stat($errorfile))[7] > 0);
+	unlink($errorfile);
+
+	return ($res, $error);
+}
+
+#
+# ------------------------------------------------------------------------
+# Checks if a resident worker (nanopipe_worker.py) serves the spool
+# directory
+# ------------------------------------------------------------------------
+#
+sub isWorkerRunning {
+	my ($spooldir) = @_;
+
+	my $pid = readFile(qq($spooldir/worker.pid));
+	return 0 if (!$pid);
+	chomp($pid);
+
+	return kill(0, $pid);
+}
+
+#
+# ------------------------------------------------------------------------
+# Run a job by the resident worker: the run directory (the current
+# directory) and the arguments are written to <job>.job in the spool
+# directory, the worker writes the exit status to <job>.done.  Returns
+# ($res, $error) like execute, $res is undefined, if the worker stopped
+# before finishing the job.
+# ------------------------------------------------------------------------
+#
+sub submitJob {
+	my ($spooldir, $args) = @_;
+
+	my $job = sprintf(qq(%s/%d.%d), $spooldir, time, $$);
+	print qq(--> Submit: $args\n);
+
+	writeFile(qq($job.tmp), getcwd() . "\n$args\n");
+	rename(qq($job.tmp), qq($job.job));
+
+	my $res;
+	while (!defined($res)) {
+		if (-e qq($job.done)) {
+			$res = readFile(qq($job.done));
+			chomp($res);
+		}
+		elsif (!isWorkerRunning($spooldir)) {
+			last;
+		}
+		else {
+			sleep(1);
+		}
+	}
+
+	my $output = readFile(qq($job.out));
+	print $output if ($output);
+	my $error = readFile(qq($job.err)) if ((stat(qq($job.err)))[7] > 0);
+	unlink(map {qq($job.$_)} qw(job run done out err));
+
+	return ($res, $error);
+}
+
 #
 # ------------------------------------------------------------------------
 # Print the error